@@ -0,0 +1,200 @@
+"""
+Signed access and refresh tokens.
+
+Tokens use the JWT compact format with HS256 (HMAC-SHA256 over
+base64url(header).base64url(claims)), implemented with the standard library.
+Verifying one costs a hash and a JSON parse, with no database work, and
+verified tokens are cached until they expire so repeat requests skip even that.
+
+AUTH_SECRET holds one or more comma-separated secrets: the first signs, and all
+of them verify, which allows rotation without logging everyone out. Without it
+the process refuses to start, unless AUTH_DEV_SECRET=1 opts into a fixed,
+publicly known development secret, which every worker and restart shares.
+"""
+from collections import OrderedDict
+from typing import Dict, List
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+AUTH_ACCESS_TTL = int(os.getenv("AUTH_ACCESS_TTL", "900"))  # Seconds
+AUTH_REFRESH_TTL = int(os.getenv("AUTH_REFRESH_TTL", str(30 * 86400)))
+AUTH_VERIFY_CACHE_SIZE = int(os.getenv("AUTH_VERIFY_CACHE_SIZE", "10000"))
+AUTH_LEEWAY = 30  # Seconds of clock skew tolerated between nodes
+AUTH_DEV_SECRET = os.getenv("AUTH_DEV_SECRET", "0") == "1"  # Development only: sign with a well-known secret
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+class TokenSigner:
+    def __init__(self, keys: List[bytes], access_ttl: int = AUTH_ACCESS_TTL,
+                 refresh_ttl: int = AUTH_REFRESH_TTL, cache_size: int = AUTH_VERIFY_CACHE_SIZE):
+        if not keys:
+            raise ValueError("At least one signing secret is required")
+        self.keys = keys
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+        self.cache_size = cache_size
+        self._header = _b64encode(json.dumps({"alg": "HS256", "typ": "JWT"}, separators=(",", ":")).encode())
+        self._cache: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, account: dict, credentials: str) -> Dict[str, object]:
+        """
+        Issue an access/refresh pair for account (needs 'id' and 'username').
+        credentials is the stored password hash; refresh tokens carry a
+        fingerprint of it, so changing the password revokes them.
+        """
+        now = int(time.time())
+        access = self.sign({
+            'sub': str(account['id']),
+            'usr': account['username'],
+            'typ': 'access',
+            'iat': now,
+            'exp': now + self.access_ttl
+        })
+        refresh = self.sign({
+            'sub': str(account['id']),
+            'typ': 'refresh',
+            'pwd': self.fingerprint(credentials),
+            'jti': secrets.token_urlsafe(12),
+            'iat': now,
+            'exp': now + self.refresh_ttl
+        })
+        return {
+            'access_token': access,
+            'refresh_token': refresh,
+            'token_type': 'bearer',
+            'expires_in': self.access_ttl
+        }
+
+    def sign(self, claims: dict) -> str:
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        signing_input = f"{self._header}.{payload}"
+        return f"{signing_input}.{self._signature(self.keys[0], signing_input)}"
+
+    def verify(self, token: str, token_type: str = "access") -> dict:
+        """Return the claims of a valid, unexpired token of token_type. Raises ValueError otherwise."""
+        now = time.time()
+        with self._lock:
+            claims = self._cache.get(token)
+            if claims is not None:
+                self._cache.move_to_end(token)
+        if claims is None:
+            claims = self._decode(token)
+        if claims.get('typ') != token_type:
+            raise ValueError("Wrong token type")
+        if claims.get('exp', 0) + AUTH_LEEWAY < now:
+            with self._lock:
+                self._cache.pop(token, None)
+            raise ValueError("Token expired")
+        with self._lock:
+            if token not in self._cache:
+                self._cache[token] = claims
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return claims
+
+    def fingerprint(self, credentials: str) -> str:
+        return self._signature(self.keys[0], f"pwd:{credentials}")[:16]
+
+    def _decode(self, token: str) -> dict:
+        try:
+            header, payload, signature = token.split(".")
+        except (AttributeError, ValueError):
+            raise ValueError("Malformed token")
+        signing_input = f"{header}.{payload}"
+        if header != self._header or not any(
+            hmac.compare_digest(signature, self._signature(key, signing_input)) for key in self.keys
+        ):
+            raise ValueError("Invalid token signature")
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            raise ValueError("Malformed token")
+        if not isinstance(claims, dict):
+            raise ValueError("Malformed token")
+        return claims
+
+    def _signature(self, key: bytes, signing_input: str) -> str:
+        return _b64encode(hmac.new(key, signing_input.encode(), hashlib.sha256).digest())
+
+def load_keys(dev_secret: bool = AUTH_DEV_SECRET) -> List[bytes]:
+    configured = [key.strip() for key in os.getenv("AUTH_SECRET", "").split(",") if key.strip()]
+    if configured:
+        return [key.encode() for key in configured]
+    if not dev_secret:
+        raise RuntimeError(
+            "AUTH_SECRET is not set. Set it to a random value shared by every worker "
+            "(e.g. python -c 'import secrets; print(secrets.token_urlsafe(32))'), "
+            "or set AUTH_DEV_SECRET=1 on a development machine"
+        )
+    logger.warning("AUTH_SECRET is not set; AUTH_DEV_SECRET=1 signs tokens with a well-known development "
+                   "secret, which anyone can use to forge them")
+    return [hashlib.sha256(b"backend-fastapi development secret").digest()]
+
+tokens = TokenSigner(load_keys())
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class TestTokenSigner(unittest.TestCase):
+        def setUp(self):
+            self.signer = TokenSigner([b"current", b"previous"])
+            self.account = {'id': 7, 'username': "alice"}
+
+        def test_issue_and_verify(self):
+            issued = self.signer.issue(self.account, "hash")
+            claims = self.signer.verify(issued['access_token'])
+            self.assertEqual((claims['sub'], claims['usr']), ("7", "alice"))
+            self.assertEqual(self.signer.verify(issued['refresh_token'], "refresh")['pwd'], self.signer.fingerprint("hash"))
+            with self.assertRaises(ValueError):
+                self.signer.verify(issued['refresh_token'], "access")
+
+        def test_load_keys(self):
+            secret = os.environ.pop("AUTH_SECRET", None)
+            try:
+                with self.assertRaises(RuntimeError):
+                    load_keys(dev_secret=False)
+                self.assertEqual(load_keys(dev_secret=True), load_keys(dev_secret=True))
+                os.environ["AUTH_SECRET"] = "new, old"
+                self.assertEqual(load_keys(dev_secret=False), [b"new", b"old"])
+            finally:
+                os.environ.pop("AUTH_SECRET", None)
+                if secret is not None:
+                    os.environ["AUTH_SECRET"] = secret
+
+        def test_tampering_and_rotation(self):
+            token = self.signer.issue(self.account, "hash")['access_token']
+            header, payload, signature = token.split(".")
+            forged = _b64encode(json.dumps({'sub': "1", 'typ': "access", 'exp': 2 ** 40}).encode())
+            with self.assertRaises(ValueError):
+                self.signer.verify(f"{header}.{forged}.{signature}")
+            # Tokens signed with a retired secret still verify while it is listed
+            old = TokenSigner([b"previous"]).issue(self.account, "hash")['access_token']
+            self.assertEqual(self.signer.verify(old)['sub'], "7")
+            with self.assertRaises(ValueError):
+                TokenSigner([b"other"]).verify(token)
+
+        def test_expiry_evicts_cache(self):
+            token = self.signer.sign({'sub': "7", 'typ': "access", 'exp': int(time.time()) + 60})
+            self.signer.verify(token)
+            self.assertIn(token, self.signer._cache)
+            self.signer._cache[token] = dict(self.signer._cache[token], exp=0)
+            with self.assertRaises(ValueError):
+                self.signer.verify(token)
+            self.assertNotIn(token, self.signer._cache)
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,161 @@
+"""
+Group commit for small, frequent writes.
+
+Request handlers run in the threadpool, each with its own session and its own
+commit. Under a burst of review or hashtag writes most of that time is round
+trips and commit flushes rather than work. A WriteCoalescer queues the items
+instead: one flusher thread takes whatever arrived within
+WRITE_BATCH_MAX_DELAY_MS (or the first WRITE_BATCH_MAX_ITEMS of it), hands the
+batch to a handler that writes it with multi-row statements in a single
+transaction, and resolves each caller with its own result or error.
+
+Batching is off unless WRITE_BATCHING=1. With it on, a lone write waits at
+most the delay before it is flushed; under load the wait overlaps the previous
+batch's commit, so it costs little latency and saves most of the commits.
+"""
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Sequence
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCHING = os.getenv("WRITE_BATCHING", "0") == "1"
+WRITE_BATCH_MAX_ITEMS = int(os.getenv("WRITE_BATCH_MAX_ITEMS", "64"))
+WRITE_BATCH_MAX_DELAY_MS = float(os.getenv("WRITE_BATCH_MAX_DELAY_MS", "2"))
+# Longest a caller waits for its batch before giving up (concurrent.futures.TimeoutError)
+WRITE_BATCH_TIMEOUT = float(os.getenv("WRITE_BATCH_TIMEOUT", "30"))
+
+class WriteCoalescer:
+    """
+    Collects items submitted from many threads and flushes them in batches.
+
+    handler(items) is called on the flusher thread and returns one entry per
+    item, in order: the item's result, or the exception to raise in its caller.
+    If the handler itself raises, every caller in the batch gets that error;
+    callers it returned no entry for get a RuntimeError.
+    """
+
+    def __init__(self, name: str, handler: Callable[[List[Any]], Sequence[Any]],
+                 max_items: int = WRITE_BATCH_MAX_ITEMS, max_delay_ms: float = WRITE_BATCH_MAX_DELAY_MS):
+        self.name = name
+        self.handler = handler
+        self.max_items = max_items
+        self.max_delay = max_delay_ms / 1000
+        self.counters = {'batches': 0, 'items': 0, 'largest': 0}
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, item, timeout: Optional[float] = WRITE_BATCH_TIMEOUT):
+        """
+        Queue item and block until its batch is written; returns its result or raises its error.
+        A timeout only stops the wait: the item may still be written afterwards.
+        """
+        future = Future()
+        self._start()
+        self._queue.put((item, future))
+        return future.result(timeout)
+
+    def stats(self) -> dict:
+        batches = self.counters['batches']
+        return {**self.counters, 'average': round(self.counters['items'] / batches, 2) if batches else 0.0}
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"coalescer-{self.name}", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_items:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch: list):
+        futures = [future for _, future in batch]
+        try:
+            results = list(self.handler([item for item, _ in batch]))
+        except Exception as e:
+            logger.error(f"Write batch {self.name} of {len(batch)} failed: {str(e)}")
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.counters['batches'] += 1
+        self.counters['items'] += len(batch)
+        self.counters['largest'] = max(self.counters['largest'], len(batch))
+        if len(results) != len(batch):
+            logger.error(f"Write batch {self.name} returned {len(results)} results for {len(batch)} items")
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        for future in futures[len(results):]:
+            future.set_exception(RuntimeError(f"Write batch {self.name} returned no result for this item"))
+
+
+if __name__ == "__main__":
+    import unittest
+    from concurrent.futures import ThreadPoolExecutor
+
+    class TestWriteCoalescer(unittest.TestCase):
+        def test_batches_and_errors(self):
+            sizes = []
+
+            def handler(items):
+                sizes.append(len(items))
+                time.sleep(0.01)  # Like a commit; later submissions queue up meanwhile
+                return [ValueError(f"bad {item}") if item % 7 == 0 else item * 2 for item in items]
+
+            coalescer = WriteCoalescer("test", handler, max_items=16, max_delay_ms=5)
+
+            def call(item):
+                try:
+                    return coalescer.submit(item, timeout=5)
+                except ValueError as e:
+                    return str(e)
+
+            with ThreadPoolExecutor(32) as pool:
+                results = list(pool.map(call, range(1, 101)))
+            self.assertEqual(results, [f"bad {i}" if i % 7 == 0 else i * 2 for i in range(1, 101)])
+            self.assertEqual(sum(sizes), 100)
+            self.assertLessEqual(max(sizes), 16)
+            self.assertLess(len(sizes), 50)
+
+        def test_handler_failure(self):
+            def handler(items):
+                raise RuntimeError("database went away")
+
+            with self.assertRaises(RuntimeError):
+                WriteCoalescer("failing", handler, max_delay_ms=0).submit(1, timeout=5)
+
+        def test_missing_results(self):
+            def handler(items):
+                return items[:1]  # One result for a batch of two
+
+            coalescer = WriteCoalescer("short", handler, max_items=2, max_delay_ms=1000)
+
+            def call(item):
+                try:
+                    return coalescer.submit(item, timeout=5)
+                except RuntimeError:
+                    return None
+
+            with ThreadPoolExecutor(2) as pool:
+                results = list(pool.map(call, [1, 2]))
+            self.assertEqual(results.count(None), 1)
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,540 @@
+"""
+Process-local caches kept coherent across workers with Postgres LISTEN/NOTIFY.
+
+Each worker holds its own LocalCache instances (accounts, services, ratings,
+...). A write calls notify_invalidation() inside its transaction. That runs
+pg_notify, which Postgres delivers to every listening connection only if the
+transaction commits, and the writing worker evicts its own entries right
+after the commit. Every worker runs InvalidationListener.run() in lifespan; it
+LISTENs on CACHE_CHANNEL and evicts the keys named in each message.
+
+Messages can be lost while the listener is disconnected, so every
+(re)connect flushes all caches, and entries also expire after CACHE_TTL as a
+last line of defence. Loads that overlap an invalidation, or run within
+CACHE_SETTLE_SECONDS of one (replicas may not have replayed the write yet),
+are returned but not cached.
+
+Query results (searches) cannot be invalidated by key, since a write does not
+know which queries it affects. A ResultCache instead tags each entry with the
+generation counters of the tables it read; its "keys" are table names, and
+invalidating one bumps that table's counter, retiring every entry that read it.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event, text
+
+from src.db import SessionLocal, engine, DB_REPLICA_HOSTS, DB_REPLICA_MAX_LAG
+
+logger = logging.getLogger(__name__)
+
+CACHE_CHANNEL = "cache_invalidation"
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))  # Seconds an entry may live without an invalidation
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))  # Per cache
+CACHE_SETTLE_SECONDS = float(os.getenv("CACHE_SETTLE_SECONDS", str(DB_REPLICA_MAX_LAG if DB_REPLICA_HOSTS else 0)))
+CACHE_LISTEN_KEEPALIVE = float(os.getenv("CACHE_LISTEN_KEEPALIVE", "30"))  # Seconds between liveness checks
+CACHE_RECONNECT_MAX_DELAY = 30.0
+NOTIFY_MAX_PAYLOAD = 7900  # Postgres rejects payloads of 8000 bytes or more
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))
+# Entries hit after this fraction of their TTL are recomputed in the background
+RESULT_CACHE_REFRESH_AHEAD = float(os.getenv("RESULT_CACHE_REFRESH_AHEAD", "0.75"))
+RESULT_CACHE_REFRESH_WORKERS = 2
+
+class LocalCache:
+    """Thread-safe LRU cache with a TTL. Cached values must be treated as read-only."""
+
+    def __init__(self, name: str, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL,
+                 settle: float = CACHE_SETTLE_SECONDS):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.settle = settle
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'flushes': 0}
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._invalidated: Dict[Hashable, float] = {}  # Key -> time of its last invalidation
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]):
+        """Cached value for key, or loader()'s result. None results are not cached."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+
+        value = loader()
+        if value is not None:
+            with self._lock:
+                self._put(key, value, now)
+        return value
+
+    def get_many(self, keys: Iterable[Hashable], loader: Callable[[List[Hashable]], Dict[Hashable, Any]]) -> Dict[Hashable, Any]:
+        """Cached values for keys. The missing ones are loaded with one loader(missing) call returning a dict."""
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[1]
+                else:
+                    missing.append(key)
+            self.counters['hits'] += len(found)
+            self.counters['misses'] += len(missing)
+
+        if missing:
+            loaded = loader(missing)
+            with self._lock:
+                for key, value in loaded.items():
+                    if value is not None:
+                        self._put(key, value, now)
+            found.update(loaded)
+        return found
+
+    def _put(self, key: Hashable, value, started: float):
+        # Skip caching if an invalidation could have raced with the load
+        cutoff = started - self.settle
+        if self._flushed_at >= cutoff or self._invalidated.get(key, 0) >= cutoff:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, keys: Optional[Iterable[Hashable]] = None):
+        """Evict keys, or everything when keys is None."""
+        now = time.monotonic()
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+                self._invalidated.clear()
+                self._flushed_at = now
+                self.counters['flushes'] += 1
+                return
+            for key in keys:
+                self._entries.pop(key, None)
+                self._invalidated[key] = now
+                self.counters['invalidations'] += 1
+            if len(self._invalidated) > self.max_entries:
+                cutoff = now - self.settle
+                self._invalidated = {key: at for key, at in self._invalidated.items() if at >= cutoff}
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), **self.counters}
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of query results, validated by table generations.
+
+    get_or_load(key, tables, loader) serves an entry only while the
+    generations of tables are what they were when it was loaded, and for at
+    most ttl. A hit past refresh_ahead of the ttl returns the entry and
+    reloads it in the background, so hot queries do not miss on expiry.
+    Cached values must be treated as read-only.
+    """
+
+    def __init__(self, name: str, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = RESULT_CACHE_TTL,
+                 refresh_ahead: float = RESULT_CACHE_REFRESH_AHEAD, settle: float = CACHE_SETTLE_SECONDS):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.settle = settle
+        self.counters = {'hits': 0, 'misses': 0, 'refreshes': 0, 'invalidations': 0, 'flushes': 0}
+        # Key -> (generations, expires at, refresh after, value)
+        self._entries: "OrderedDict[Hashable, Tuple[tuple, float, float, Any]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._bumped: Dict[str, float] = {}  # Table -> time of its last bump
+        self._flushed_at = 0.0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, tables: Sequence[str], loader: Callable[[], Any]):
+        """Cached value for key, or loader()'s result. None results are not cached."""
+        now = time.monotonic()
+        with self._lock:
+            generations = self._snapshot(tables)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generations and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                if now < entry[2] or key in self._refreshing:
+                    return entry[3]
+                self._refreshing.add(key)
+            else:
+                entry = None
+                self.counters['misses'] += 1
+
+        if entry is not None:
+            _refresh_pool().submit(self._refresh, key, tables, loader)
+            return entry[3]
+        value = loader()
+        self._put(key, tables, generations, now, value)
+        return value
+
+    def invalidate(self, keys: Optional[Iterable[str]] = None):
+        """Bump the generations of the tables named by keys, or drop everything when keys is None."""
+        now = time.monotonic()
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+                self._flushed_at = now
+                self.counters['flushes'] += 1
+                return
+            for table in keys:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                self._bumped[table] = now
+                self.counters['invalidations'] += 1
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'generations': dict(self._generations), **self.counters}
+
+    def _snapshot(self, tables: Sequence[str]) -> tuple:
+        return tuple(self._generations.get(table, 0) for table in tables)
+
+    def _put(self, key: Hashable, tables: Sequence[str], generations: tuple, started: float, value):
+        if value is None:
+            return
+        with self._lock:
+            # A bump during the load, or within the settle time before it, may not be reflected in value
+            cutoff = started - self.settle
+            if (generations != self._snapshot(tables) or self._flushed_at >= cutoff
+                    or any(self._bumped.get(table, 0) >= cutoff for table in tables)):
+                return
+            now = time.monotonic()
+            self._entries[key] = (generations, now + self.ttl, now + self.ttl * self.refresh_ahead, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _refresh(self, key: Hashable, tables: Sequence[str], loader: Callable[[], Any]):
+        try:
+            started = time.monotonic()
+            with self._lock:
+                generations = self._snapshot(tables)
+            self._put(key, tables, generations, started, loader())
+            self.counters['refreshes'] += 1
+        except Exception as e:
+            logger.warning(f"Refreshing {self.name} cache entry failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+_refresh_executor: Optional[ThreadPoolExecutor] = None
+_refresh_lock = threading.Lock()
+
+def _refresh_pool() -> ThreadPoolExecutor:
+    global _refresh_executor
+    with _refresh_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(RESULT_CACHE_REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+        return _refresh_executor
+
+_caches: Dict[str, Any] = {}  # LocalCache or ResultCache
+
+def local_cache(name: str, **options) -> LocalCache:
+    """The process-wide cache called name, created on first use."""
+    if name not in _caches:
+        _caches[name] = LocalCache(name, **options)
+    return _caches[name]
+
+def result_cache(name: str, **options) -> ResultCache:
+    """The process-wide result cache called name, created on first use."""
+    if name not in _caches:
+        _caches[name] = ResultCache(name, **options)
+    return _caches[name]
+
+_hooks: Dict[str, List[Callable[[Optional[list]], None]]] = {}
+
+def on_invalidation(name: str, callback: Callable[[Optional[list]], None]):
+    """
+    Also call callback(keys) whenever cache name is invalidated, by this worker
+    or another; None means everything. For in-memory structures that are not
+    caches but derive from the same rows. Runs on the listener's event loop,
+    so it must not block.
+    """
+    _hooks.setdefault(name, []).append(callback)
+
+def invalidate(name: str, keys: Optional[Iterable[Hashable]] = None):
+    cache = _caches.get(name)
+    if cache is not None:
+        cache.invalidate(keys)
+    for callback in _hooks.get(name, ()):
+        callback(None if keys is None else list(keys))
+
+def flush_all():
+    for name in set(_caches) | set(_hooks):
+        invalidate(name)
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+def encode_invalidation(name: str, keys: Optional[Iterable[Hashable]]) -> str:
+    """Compact JSON message; falls back to flushing the cache when the keys do not fit."""
+    if keys is not None:
+        payload = json.dumps({'c': name, 'k': list(keys)}, separators=(",", ":"))
+        if len(payload.encode()) <= NOTIFY_MAX_PAYLOAD:
+            return payload
+    return json.dumps({'c': name}, separators=(",", ":"))
+
+def apply_invalidation(payload: str):
+    try:
+        message = json.loads(payload)
+        name = message['c']
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f"Ignoring malformed cache invalidation: {payload[:200]}")
+        return
+    invalidate(name, message.get('k'))
+
+def notify_invalidation(session, name: str, keys: Optional[Iterable[Hashable]] = None):
+    """
+    Invalidate keys of cache name in every worker once session commits.
+    Keys must survive a JSON round trip (ints or strings). None flushes the cache.
+    """
+    keys = None if keys is None else list(keys)
+    if keys == []:
+        return
+    session.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {'channel': CACHE_CHANNEL, 'payload': encode_invalidation(name, keys)}
+    )
+    session.info.setdefault('cache_invalidations', []).append((name, keys))
+
+@event.listens_for(SessionLocal, "after_commit")
+def _invalidate_after_commit(session):
+    # This worker's listener will see the NOTIFY too, but evicting here lets
+    # the writing request read its own write immediately
+    for name, keys in session.info.pop('cache_invalidations', ()):
+        invalidate(name, keys)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_after_rollback(session):
+    session.info.pop('cache_invalidations', None)
+
+class InvalidationListener:
+    """LISTENs for invalidations on a dedicated connection outside the pool."""
+
+    def __init__(self, channel: str = CACHE_CHANNEL):
+        self.channel = channel
+        self.connected = False
+
+    async def run(self, stop: asyncio.Event):
+        delay = 1.0
+        while not stop.is_set():
+            try:
+                connection = await asyncio.to_thread(self._connect)
+            except Exception as e:
+                logger.error(f"Cache invalidation listener cannot connect: {str(e)}")
+                flush_all()
+                if await self._sleep(stop, delay):
+                    return
+                delay = min(delay * 2, CACHE_RECONNECT_MAX_DELAY)
+                continue
+
+            # Anything may have changed while nobody was listening
+            flush_all()
+            self.connected = True
+            delay = 1.0
+            try:
+                await self._listen(connection, stop)
+            except Exception as e:
+                logger.error(f"Cache invalidation listener lost its connection: {str(e)}")
+                flush_all()
+            finally:
+                self.connected = False
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+    def _connect(self):
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        connection = engine.dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        return connection
+
+    async def _listen(self, connection, stop: asyncio.Event):
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(connection.fileno(), readable.set)
+        stopping = asyncio.ensure_future(stop.wait())
+        try:
+            while not stop.is_set():
+                waiting = asyncio.ensure_future(readable.wait())
+                done, _ = await asyncio.wait(
+                    {waiting, stopping}, timeout=CACHE_LISTEN_KEEPALIVE,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                waiting.cancel()
+                if stopping in done:
+                    return
+                if waiting not in done:
+                    # Nothing arrived for a while; make sure the connection is still alive
+                    await asyncio.wait_for(asyncio.to_thread(self._ping, connection), CACHE_LISTEN_KEEPALIVE)
+                readable.clear()
+                connection.poll()
+                while connection.notifies:
+                    apply_invalidation(connection.notifies.pop(0).payload)
+        finally:
+            stopping.cancel()
+            loop.remove_reader(connection.fileno())
+
+    def _ping(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+    async def _sleep(self, stop: asyncio.Event, seconds: float) -> bool:
+        """Wait up to seconds; True if stop was set meanwhile."""
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+invalidation_listener = InvalidationListener()
+
+
+if __name__ == "__main__":
+    import unittest
+    from src.db import get_db_session
+
+    class TestLocalCache(unittest.TestCase):
+        def test_hit_miss_and_invalidate(self):
+            cache = LocalCache("test", settle=0)
+            loads = []
+            load = lambda: loads.append(1) or {'id': 1}
+            cache.get_or_load(1, load)
+            cache.get_or_load(1, load)
+            self.assertEqual(len(loads), 1)
+            cache.invalidate([1])
+            time.sleep(0.001)
+            cache.get_or_load(1, load)
+            self.assertEqual(len(loads), 2)
+            self.assertEqual(cache.stats()['hits'], 1)
+
+        def test_racing_load_not_cached(self):
+            cache = LocalCache("test", settle=0)
+
+            def load():
+                cache.invalidate([1])  # A write lands while the value is being read
+                return "stale"
+
+            self.assertEqual(cache.get_or_load(1, load), "stale")
+            self.assertEqual(cache.stats()['entries'], 0)
+
+        def test_get_many(self):
+            cache = LocalCache("many_test", settle=0)
+            cache.get_or_load(1, lambda: "one")
+            requested = []
+            loader = lambda keys: requested.extend(keys) or {key: f"loaded {key}" for key in keys if key != 3}
+            self.assertEqual(cache.get_many([1, 2, 3], loader), {1: "one", 2: "loaded 2"})
+            self.assertEqual(requested, [2, 3])
+            self.assertEqual(cache.get_many([2], loader), {2: "loaded 2"})
+            self.assertEqual(requested, [2, 3])
+
+        def test_lru_and_ttl(self):
+            cache = LocalCache("test", max_entries=2, ttl=60, settle=0)
+            for key in (1, 2, 3):
+                cache.get_or_load(key, lambda: key)
+            self.assertNotIn(1, cache._entries)
+            cache.ttl = -1
+            cache.get_or_load(4, lambda: 4)
+            self.assertEqual(cache.get_or_load(4, lambda: "reloaded"), "reloaded")
+
+        def test_payload_overflow_flushes(self):
+            self.assertEqual(json.loads(encode_invalidation("services", range(5000))), {'c': "services"})
+            self.assertEqual(json.loads(encode_invalidation("services", [1, 2]))['k'], [1, 2])
+
+    class TestResultCache(unittest.TestCase):
+        def test_generations(self):
+            cache = ResultCache("results_test", settle=0)
+            loads = []
+            load = lambda: loads.append(1) or [1, 2, 3]
+            cache.get_or_load(("q", "design"), ["services", "reviews"], load)
+            cache.get_or_load(("q", "design"), ["services", "reviews"], load)
+            self.assertEqual(len(loads), 1)
+            cache.invalidate(["hashtags"])  # Not read by this entry
+            cache.get_or_load(("q", "design"), ["services", "reviews"], load)
+            self.assertEqual(len(loads), 1)
+            cache.invalidate(["reviews"])
+            cache.get_or_load(("q", "design"), ["services", "reviews"], load)
+            self.assertEqual(len(loads), 2)
+
+        def test_refresh_ahead(self):
+            cache = ResultCache("refresh_test", ttl=0.2, refresh_ahead=0.25, settle=0)
+            values = iter(range(100))
+            load = lambda: next(values)
+            self.assertEqual(cache.get_or_load("k", ["services"], load), 0)
+            time.sleep(0.1)
+            self.assertEqual(cache.get_or_load("k", ["services"], load), 0)  # Stale-soon: served, reloaded behind
+            for _ in range(100):
+                if cache.stats()['refreshes']:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(cache.get_or_load("k", ["services"], load), 1)
+            self.assertEqual(cache.stats()['misses'], 1)
+
+    class TestInvalidationBus(unittest.TestCase):
+        def test_notify_reaches_listener(self):
+            async def scenario():
+                cache = local_cache("bus_test", settle=0)
+                cache.get_or_load(7, lambda: "cached")
+                stop = asyncio.Event()
+                listener = InvalidationListener()
+                task = asyncio.create_task(listener.run(stop))
+                while not listener.connected:
+                    await asyncio.sleep(0.01)
+                cache.get_or_load(7, lambda: "cached")
+                # Simulate a write by another worker: notify without the local after_commit hook
+                with engine.begin() as connection:
+                    connection.execute(
+                        text("SELECT pg_notify(:channel, :payload)"),
+                        {'channel': CACHE_CHANNEL, 'payload': encode_invalidation("bus_test", [7])}
+                    )
+                for _ in range(200):
+                    if cache.stats()['entries'] == 0:
+                        break
+                    await asyncio.sleep(0.01)
+                stop.set()
+                await task
+                return cache.stats()
+
+            stats = asyncio.run(scenario())
+            self.assertEqual(stats['entries'], 0)
+            self.assertEqual(stats['invalidations'], 1)
+
+        def test_rollback_discards(self):
+            cache = local_cache("rollback_test", settle=0)
+            cache.get_or_load(1, lambda: "cached")
+            with self.assertRaises(RuntimeError):
+                with get_db_session() as session:
+                    notify_invalidation(session, "rollback_test", [1])
+                    raise RuntimeError("abort")
+            self.assertEqual(cache.stats()['entries'], 1)
+            with get_db_session() as session:
+                notify_invalidation(session, "rollback_test", [1])
+            self.assertEqual(cache.stats()['entries'], 0)
+
+        def test_hooks(self):
+            seen = []
+            on_invalidation("hook_test", seen.append)
+            with get_db_session() as session:
+                notify_invalidation(session, "hook_test", [3, 4])
+            flush_all()
+            self.assertEqual(seen, [[3, 4], None])
+
+    unittest.main(verbosity=2)
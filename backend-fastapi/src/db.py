@@ -1,9 +1,16 @@
-from typing import List, Dict, Any, Optional, Callable, Generator
+from typing import List, Dict, Any, Optional, Callable, Generator, Iterable
 from uuid import UUID
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
+from sqlalchemy import create_engine, text, inspect, any_, bindparam, cast, event, Integer, Text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, Session, ORMExecuteState, declarative_base
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.elements import TextClause
 from contextlib import contextmanager
+from contextvars import Context, ContextVar
+import asyncio
+import hashlib
+import itertools
 import os
 from dotenv import load_dotenv
 import logging
@@ -18,11 +25,25 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 
+# Read replicas as comma-separated host[:port] entries sharing the primary's credentials
+DB_REPLICA_HOSTS = [host.strip() for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host.strip()]
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))  # Seconds
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "10"))
+
+DB_ECHO = os.getenv("DB_ECHO", "1") == "1"  # Log every SQL statement
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", "5"))  # Connections opened per engine at startup
+# With FAST_START=1 workers skip create_all and the schema upgrade when the stored
+# schema version matches the models, which costs a single query
+FAST_START = os.getenv("FAST_START", "0") == "1"
+SCHEMA_LOCK_KEY = 7211  # pg advisory lock serializing schema setup across workers
+EXTENSION_INDEX_LOCK_KEY = 7212  # pg advisory lock held by the worker building extension indexes
+
 # Create the database URL
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 # Create the SQLAlchemy engine
-engine = create_engine(DATABASE_URL, echo=True)
+engine = create_engine(DATABASE_URL, echo=DB_ECHO)
 
 # Create a sessionmaker
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -33,6 +54,108 @@ Base = declarative_base()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def replica_url(host: str) -> str:
+    if ":" not in host:
+        host = f"{host}:{DB_PORT}"
+    return f"postgresql://{DB_USER}:{DB_PASSWORD}@{host}/{DB_NAME}"
+
+class EngineRegistry:
+    """
+    The primary engine plus any read replicas.
+
+    Replicas are health-checked periodically: a replica that cannot be reached,
+    or whose replay lag exceeds DB_REPLICA_MAX_LAG, stops receiving reads until
+    a later check passes. With no healthy replica, reads go to the primary.
+    """
+
+    def __init__(self, primary: Engine, replica_urls: List[str]):
+        self.primary = primary
+        self.replicas = [create_engine(url, pool_pre_ping=True) for url in replica_urls]
+        self.healthy = {replica: True for replica in self.replicas}
+        self._turn = itertools.count()
+
+    def reader(self) -> Engine:
+        """Next healthy replica in round-robin order, or the primary if there is none."""
+        candidates = [replica for replica in self.replicas if self.healthy[replica]]
+        if not candidates:
+            return self.primary
+        return candidates[next(self._turn) % len(candidates)]
+
+    def mark_down(self, replica: Engine):
+        if self.healthy.get(replica):
+            logger.warning(f"Replica {replica.url.host}:{replica.url.port} marked unhealthy")
+        self.healthy[replica] = False
+
+    def check_replicas(self):
+        for replica in self.replicas:
+            try:
+                with replica.connect() as conn:
+                    lag = conn.execute(text("""
+                        SELECT CASE
+                            WHEN NOT pg_is_in_recovery()
+                              OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                        END
+                    """)).scalar()
+                healthy = float(lag) <= DB_REPLICA_MAX_LAG
+                if healthy and not self.healthy[replica]:
+                    logger.info(f"Replica {replica.url.host}:{replica.url.port} is healthy again")
+                elif not healthy:
+                    logger.warning(f"Replica {replica.url.host}:{replica.url.port} lag {float(lag):.1f}s")
+                self.healthy[replica] = healthy
+            except Exception as e:
+                logger.error(f"Replica health check failed: {str(e)}")
+                self.mark_down(replica)
+
+    async def warm(self, connections: int = DB_POOL_WARM):
+        """Open pooled connections up front so the first requests do not pay for connecting."""
+        async def fill(engine: Engine):
+            count = min(connections, engine.pool.size())
+            try:
+                held = await asyncio.gather(*(asyncio.to_thread(engine.connect) for _ in range(count)))
+            except Exception as e:
+                logger.error(f"Connection pool warm-up failed for {engine.url.host}: {str(e)}")
+                if engine is not self.primary:
+                    self.mark_down(engine)
+                return
+            for connection in held:
+                connection.close()
+
+        await asyncio.gather(*(fill(engine) for engine in [self.primary, *self.replicas]))
+
+    async def run_health_checks(self, stop: asyncio.Event):
+        while not stop.is_set():
+            await asyncio.to_thread(self.check_replicas)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=DB_REPLICA_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+engines = EngineRegistry(engine, [replica_url(host) for host in DB_REPLICA_HOSTS])
+
+# Set for the rest of a request once it has written, or when the client wrote recently
+_prefer_primary: ContextVar[bool] = ContextVar("prefer_primary", default=False)
+
+def prefer_primary():
+    """Send reads in the current context to the primary (read-your-writes)."""
+    _prefer_primary.set(True)
+
+# Leading keywords of textual statements that only read
+_READ_ONLY_SQL = ("SELECT", "SHOW", "EXPLAIN")
+
+@event.listens_for(SessionLocal, "after_flush")
+def _flushed(session: Session, flush_context):
+    # Only fires when the flush had pending changes to write
+    session.info['wrote'] = True
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def _executed(state: ORMExecuteState):
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info['wrote'] = True
+    elif isinstance(state.statement, TextClause):
+        if not state.statement.text.lstrip().upper().startswith(_READ_ONLY_SQL):
+            state.session.info['wrote'] = True
+
 @contextmanager
 def get_db_session() -> Generator[Session, None, None]:
     """Provide a transactional scope around a series of operations."""
@@ -41,6 +164,8 @@ def get_db_session() -> Generator[Session, None, None]:
         logger.info("Database session started")
         yield session
         session.commit()
+        if session.info.get('wrote'):
+            prefer_primary()
         logger.info("Database session committed")
     except SQLAlchemyError as e:
         session.rollback()
@@ -54,24 +179,219 @@ def get_db_session() -> Generator[Session, None, None]:
         session.close()
         logger.info("Database session closed")
 
+@contextmanager
+def get_read_session() -> Generator[Session, None, None]:
+    """Provide a session for read-only work, served by a replica when one is usable."""
+    bind = engine if _prefer_primary.get() else engines.reader()
+    session = SessionLocal(bind=bind)
+    if bind is not engine:
+        try:
+            session.connection()
+        except SQLAlchemyError as e:
+            # Fail over to the primary instead of failing the request
+            logger.error(f"Replica connection failed: {str(e)}")
+            engines.mark_down(bind)
+            session.close()
+            session = SessionLocal()
+    try:
+        yield session
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Database error occurred: {str(e)}")
+        raise
+    except Exception as e:
+        session.rollback()
+        logger.error(f"An unexpected error occurred: {str(e)}")
+        raise
+    finally:
+        session.close()
+
+def any_id(name: str):
+    """
+    ANY over an integer array bound as one text parameter: write
+    column == any_id("ids") and pass {"ids": id_array(ids)}. An expanding IN
+    binds one parameter per id and a list parameter is sent as ARRAY[...] with
+    one constant per id; for thousands of ids both cost several milliseconds
+    that Postgres parsing '{1,2,...}' does not.
+    """
+    return any_(cast(bindparam(name, type_=Text), ARRAY(Integer)))
+
+def id_array(ids: Iterable[int]) -> str:
+    return "{" + ",".join(str(int(i)) for i in ids) + "}"
+
+def upgrade_schema():
+    """Bring tables created by older versions up to the current model.
+
+    create_all() never alters existing tables, so columns added to the models
+    later are added here (and filled by the column's info['backfill'] statement,
+    if it has one), foreign keys created before ON DELETE CASCADE was
+    declared are rebuilt, and missing indexes are created. All steps are no-ops
+    once applied. Indexes needing an extension are left to
+    create_extension_indexes(), since they take long enough to build that
+    they must not run in this transaction.
+    """
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                logger.info(f"Adding column {column.name} to {table.name}")
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=conn.dialect)}'
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                if column.info.get('backfill'):
+                    # Existing rows got the default; derive their real values in the same transaction
+                    logger.info(f"Backfilling {table.name}.{column.name}")
+                    conn.execute(text(column.info['backfill']))
+
+        stale = conn.execute(text("""
+            SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE contype = 'f' AND confdeltype <> 'c'
+              AND conrelid::regclass::text = ANY(:tables)
+        """), {"tables": list(Base.metadata.tables)}).fetchall()
+        for table, name, definition in stale:
+            logger.info(f"Rebuilding foreign key {name} on {table} with ON DELETE CASCADE")
+            conn.execute(text(
+                f'ALTER TABLE "{table}" DROP CONSTRAINT "{name}", '
+                f'ADD CONSTRAINT "{name}" {definition} ON DELETE CASCADE'
+            ))
+
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+def extension_installed(conn, name: str) -> bool:
+    return conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = :name"), {"name": name}).first() is not None
+
+def install_extension(conn, name: str) -> bool:
+    """
+    True if the extension is installed, installing it first when the server has
+    it and we may. conn must be in autocommit mode, so a refusal rolls back nothing else.
+    """
+    if extension_installed(conn, name):
+        return True
+    if not conn.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = :name"), {"name": name}).first():
+        return False
+    try:
+        conn.execute(text(f'CREATE EXTENSION IF NOT EXISTS "{name}"'))
+        return True
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not install extension {name}: {str(e)}")
+        return False
+
+def create_extension_indexes() -> List[str]:
+    """
+    Build the models' extension_indexes with CREATE INDEX CONCURRENTLY, so
+    writes to the tables go on meanwhile. Runs outside any transaction, and in
+    one worker at a time; the others return at once. An index left invalid by
+    an interrupted build is dropped and built again. Returns the extensions
+    whose indexes are in place.
+    """
+    ready = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": EXTENSION_INDEX_LOCK_KEY}).scalar():
+            return ready
+        try:
+            for extension, indexes in Base.metadata.info.get('extension_indexes', {}).items():
+                if not install_extension(conn, extension):
+                    logger.warning(f"Extension {extension} is not available, skipping {len(indexes)} index(es) needing it")
+                    continue
+                for name, statement in indexes.items():
+                    valid = conn.execute(text(
+                        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid"
+                        " WHERE c.relname = :name AND c.relnamespace = current_schema()::regnamespace"
+                    ), {"name": name}).scalar()
+                    if valid:
+                        continue
+                    if valid is False:
+                        logger.info(f"Dropping invalid index {name} left by an interrupted build")
+                        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+                    logger.info(f"Building index {name}")
+                    conn.execute(text(statement))
+                ready.append(extension)
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": EXTENSION_INDEX_LOCK_KEY})
+    return ready
+
 def init_db():
     """Initialize the database."""
     try:
         logger.info("Creating database tables...")
         Base.metadata.create_all(bind=engine)
-        
-        # Test connection
-        with get_db_session() as session:
-            session.execute(text("SELECT 1"))
-            logger.info("Database connection successful")
-            
+        upgrade_schema()
+        record_schema_version()
+        logger.info("Database connection successful")
     except Exception as e:
         logger.error(f"Database initialization failed: {str(e)}")
         raise
 
+def schema_version() -> str:
+    """Fingerprint of the DDL the models describe; any model change gives a new version."""
+    from sqlalchemy.schema import CreateIndex, CreateTable
+    digest = hashlib.sha256()
+    for table in Base.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=engine.dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            digest.update(str(CreateIndex(index).compile(dialect=engine.dialect)).encode())
+    return digest.hexdigest()[:16]
+
+def stored_schema_version(conn) -> Optional[str]:
+    if conn.execute(text("SELECT to_regclass('schema_version')")).scalar() is None:
+        return None
+    return conn.execute(text("SELECT version FROM schema_version")).scalar()
+
+def record_schema_version():
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            " id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1), version text NOT NULL,"
+            " updated_at timestamp NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))"
+        ))
+        conn.execute(text(
+            "INSERT INTO schema_version (id, version) VALUES (1, :version)"
+            " ON CONFLICT (id) DO UPDATE SET version = excluded.version,"
+            " updated_at = now() AT TIME ZONE 'utc'"
+        ), {"version": schema_version()})
+
+def ensure_schema() -> bool:
+    """
+    Fast-start replacement for init_db(): one query when the stored schema version
+    matches the models. Otherwise the first worker to take the advisory lock runs
+    init_db() while the others wait and then find the version current.
+    Returns True if this worker changed the schema.
+    """
+    version = schema_version()
+    with engine.connect() as conn:
+        if stored_schema_version(conn) == version:
+            return False
+    with engine.connect() as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        # The lock is session-level, so it outlives this commit. Checking in a fresh
+        # transaction sees tables created while we were waiting for the lock.
+        lock_conn.commit()
+        try:
+            current = stored_schema_version(lock_conn) == version
+            lock_conn.commit()
+            if current:
+                return False
+            logger.info(f"Schema version {version} not applied yet, initializing")
+            init_db()
+            return True
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            lock_conn.commit()
+
 def drop_db():
     """Drop all tables in the database."""
     Base.metadata.drop_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS schema_version"))
 
 if __name__ == "__main__":
     print("Testing database operations...")
@@ -150,6 +470,65 @@ if __name__ == "__main__":
             print(f"Delete operation failed: {str(e)}")
             raise
 
+    # Test that only sessions which wrote send later reads to the primary
+    def test_prefer_primary_after_writes():
+        print("Testing primary preference after writes...")
+
+        def preferred_after(work):
+            def run():
+                with get_db_session() as session:
+                    work(session)
+                return _prefer_primary.get()
+            return Context().run(run)
+
+        assert not preferred_after(lambda session: session.execute(text("SELECT 1"))), \
+            "A read-only session should not prefer the primary"
+        assert preferred_after(
+            lambda session: session.execute(text("INSERT INTO test_table (name) VALUES ('Primary')"))
+        ), "A textual write should prefer the primary"
+        assert preferred_after(
+            lambda session: session.execute(text("DELETE FROM test_table WHERE name = 'Primary'"))
+        ), "A textual delete should prefer the primary"
+        print("Primary preference after writes successful")
+
+    # Test replica routing (needs DB_REPLICA_HOSTS pointing at a second server)
+    def test_replica_routing():
+        print("Testing replica routing...")
+        if not engines.replicas:
+            print("No replicas configured, skipping")
+            return
+        port_query = text("SELECT current_setting('port')")
+        with engine.connect() as conn:
+            primary_port = conn.execute(port_query).scalar()
+
+        def read_in(context):
+            def read():
+                with get_read_session() as session:
+                    return session.execute(port_query).scalar()
+            return context.run(read)
+
+        def read_port():
+            # Earlier tests wrote in this context, so read from a fresh one
+            return read_in(Context())
+
+        engines.check_replicas()
+        assert all(engines.healthy.values()), "Replicas should be healthy"
+        assert read_port() != primary_port, "Reads should go to a replica"
+
+        def write():
+            with get_db_session() as session:
+                session.execute(text("INSERT INTO test_table (name) VALUES ('Routing')"))
+        context = Context()
+        context.run(write)
+        assert read_in(context) == primary_port, "Reads after a write should go to the primary"
+
+        for replica in engines.replicas:
+            engines.mark_down(replica)
+        assert read_port() == primary_port, "Reads should fail over to the primary"
+        engines.check_replicas()
+        assert read_port() != primary_port, "Recovered replicas should serve reads again"
+        print("Replica routing successful")
+
     # Run tests
     try:
         reset_db()
@@ -158,6 +537,8 @@ if __name__ == "__main__":
         test_query()
         test_update()
         test_delete()
+        test_prefer_primary_after_writes()
+        test_replica_routing()
         print("All tests passed successfully!")
     except Exception as e:
         print(f"Tests failed: {str(e)}")
@@ -0,0 +1,26 @@
+"""
+In-process change events.
+
+Service classes publish a topic after a write commits; in-memory structures such
+as the trending tracker subscribe to keep themselves current without querying
+the database on every request.
+"""
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+_subscribers: Dict[str, List[Callable[..., Any]]] = defaultdict(list)
+
+def subscribe(topic: str, handler: Callable[..., Any]):
+    """Call handler(**payload) whenever topic is published."""
+    _subscribers[topic].append(handler)
+
+def publish(topic: str, **payload):
+    """Notify subscribers of topic. A failing subscriber never fails the write."""
+    for handler in _subscribers.get(topic, ()):
+        try:
+            handler(**payload)
+        except Exception as e:
+            logger.error(f"Event handler for {topic} failed: {str(e)}")
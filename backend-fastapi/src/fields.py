@@ -0,0 +1,45 @@
+"""
+Sparse fieldsets.
+
+Read endpoints accept ?fields=id,title,price. The names are checked against
+the endpoint's whitelist and become the SELECT list, so columns nobody asked
+for are neither read from the database nor serialized. The id is always
+included so clients can key their lists.
+"""
+from typing import List, Optional, Sequence
+
+from sqlalchemy import select
+
+def parse_fields(fields: Optional[str], allowed: Sequence[str]) -> Optional[List[str]]:
+    """Requested fields in whitelist order, or None when the parameter was not given"""
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = sorted(requested.difference(allowed))
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    requested.add('id')
+    return [field for field in allowed if field in requested]
+
+def select_fields(model, fields: Sequence[str]):
+    """SELECT of just these columns of model; rows convert with row._asdict()"""
+    return select(*(getattr(model, field) for field in fields))
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class TestParseFields(unittest.TestCase):
+        allowed = ['id', 'title', 'price', 'description']
+
+        def test_parse(self):
+            self.assertIsNone(parse_fields(None, self.allowed))
+            self.assertEqual(parse_fields("price, title", self.allowed), ['id', 'title', 'price'])
+            self.assertEqual(parse_fields("", self.allowed), ['id'])
+
+        def test_unknown(self):
+            with self.assertRaises(ValueError) as raised:
+                parse_fields("title,hashed_password", self.allowed)
+            self.assertIn("hashed_password", str(raised.exception))
+
+    unittest.main(verbosity=2)
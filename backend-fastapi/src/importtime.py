@@ -0,0 +1,60 @@
+"""
+Import-time report for the application.
+
+Runs `python -X importtime -c "import src.main"` in a fresh interpreter and
+summarizes the result: total time, the top-level packages that cost the most,
+and the slowest individual modules.
+
+    PYTHONPATH=$PWD python -m src.importtime [--target src.main] [--top 15]
+"""
+from typing import List, NamedTuple
+import argparse
+import subprocess
+import sys
+
+class ImportTiming(NamedTuple):
+    module: str
+    depth: int
+    self_us: int
+    cumulative_us: int
+
+def parse(report: str) -> List[ImportTiming]:
+    timings = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        timings.append(ImportTiming(name.strip(), depth, int(self_us), int(cumulative_us)))
+    return timings
+
+def measure(target: str) -> List[ImportTiming]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {target} failed:\n{result.stderr[-2000:]}")
+    return parse(result.stderr)
+
+def report(timings: List[ImportTiming], target: str, top: int) -> str:
+    total = next((t.cumulative_us for t in timings if t.module == target), sum(t.self_us for t in timings))
+    packages = {}
+    for timing in timings:
+        package = timing.module.split(".")[0]
+        packages[package] = packages.get(package, 0) + timing.self_us
+    lines = [f"import {target}: {total / 1000:.1f} ms, {len(timings)} modules", "",
+             "Slowest packages (self time of all their modules):"]
+    for package, cumulative in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        lines.append(f"  {cumulative / 1000:8.1f} ms  {package}")
+    lines += ["", "Slowest modules (self):"]
+    for timing in sorted(timings, key=lambda timing: -timing.self_us)[:top]:
+        lines.append(f"  {timing.self_us / 1000:8.1f} ms  {timing.module}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", default="src.main")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    print(report(measure(args.target), args.target, args.top))
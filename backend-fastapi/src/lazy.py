@@ -0,0 +1,62 @@
+"""
+Deferred imports for heavy, rarely needed modules.
+
+lazy_import("numpy") returns a stand-in module that performs the real import
+on first attribute access, so importing the app does not pay for NumPy and
+SciPy until a code path actually uses them. The real import goes through
+importlib, whose per-module locks make concurrent first use from several
+threads safe (unlike importlib.util.LazyLoader before Python 3.12).
+
+Modules using a lazy import should add `from __future__ import annotations`
+so that annotations such as np.ndarray are not evaluated at import time.
+"""
+import importlib
+import sys
+import types
+
+class LazyModule(types.ModuleType):
+    def __getattr__(self, attribute: str):
+        module = importlib.import_module(self.__name__)
+        value = getattr(module, attribute)
+        # Cache on the stand-in so later lookups skip __getattr__
+        setattr(self, attribute, value)
+        return value
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+def lazy_import(name: str) -> types.ModuleType:
+    return sys.modules.get(name) or LazyModule(name)
+
+
+if __name__ == "__main__":
+    import unittest
+    import threading
+
+    class TestLazyImport(unittest.TestCase):
+        def test_deferred_until_used(self):
+            name = "wave"  # Small stdlib module nothing else here imports
+            sys.modules.pop(name, None)
+            module = lazy_import(name)
+            self.assertNotIn(name, sys.modules)
+            errors = []
+
+            def use():
+                try:
+                    self.assertTrue(callable(module.open))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=use) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertIn(name, sys.modules)
+            self.assertIs(module.open, sys.modules[name].open)
+
+        def test_already_imported(self):
+            self.assertIs(lazy_import("threading"), sys.modules["threading"])
+
+    unittest.main(verbosity=2)
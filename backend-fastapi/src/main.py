@@ -1,12 +1,47 @@
-from fastapi import FastAPI, HTTPException, Query, Path, Body
-from typing import List, Optional
-from src.services.account import AccountService
-from src.services.service import ServiceService
-from src.services.review import ReviewService
-from src.services.hashtag import HashtagService
+from fastapi import FastAPI, HTTPException, Query, Path, Body, Request, Depends
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
+from typing import Iterator, List, Optional
+from src.services.account import (
+    AccountService, ACCOUNT_FIELDS, PROFILE_SERVICES_LIMIT, PROFILE_SERVICES_MAX_LIMIT
+)
+from src.services.service import ServiceService, SERVICE_FIELDS, SERVICE_EXPORT_COLUMNS
+from src.services.review import (
+    ReviewService, REVIEW_FIELDS, REVIEW_EXPORT_COLUMNS, REVIEW_SUMMARY_LATEST, REVIEW_SUMMARY_MAX_LATEST
+)
+from src.services.hashtag import HashtagService, HASHTAG_FIELDS
+from src.services.job import JobService
+from src.services.trending import TrendingService
+from src.services.related import RelatedHashtagService, RELATED_REFRESH_DELAY, RELATED_REBUILD_SECONDS
+from src.services.similar import SimilarServiceIndex
+from src.services.autocomplete import AutocompleteIndex, AUTOCOMPLETE_DEFAULT_LIMIT, AUTOCOMPLETE_MAX_LIMIT
+from src.services.search import SearchService, SEARCH_SORTS
+from src.services.facets import SEARCH_FACETS
+from src.services.hashtag_index import HashtagIndex, HASHTAG_MATCHES
+from src.services.importer import ServiceImportService
+from src.services.media import MediaService
+from src.events import subscribe
+from src.export import EXPORT_FORMATS, stream_export
+from src.fields import parse_fields
+from src.auth import tokens
+from src.cache import invalidation_listener, cache_stats
+from src.media import (
+    store as media_store, render_variants, media_pool, shutdown_media_pool, sniff_content_type,
+    MEDIA_MAX_BYTES, MEDIA_ACCEL_REDIRECT, MEDIA_GC_GRACE
+)
 from pydantic import BaseModel, EmailStr, conint, Field
-from src.db import init_db, get_db_session
+from src.db import (
+    init_db, ensure_schema, create_extension_indexes, get_db_session, engines, prefer_primary,
+    DB_READ_YOUR_WRITES_SECONDS, FAST_START
+)
+from src.middleware import LoadShedMiddleware, load_stats, threadpool_size
+import asyncio
 import logging
+import os
+import tempfile
+import time
+import zlib
+from anyio import to_thread
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -14,17 +49,86 @@ from fastapi.middleware.cors import CORSMiddleware
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Background job workers started per process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", str(threadpool_size())))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(100 * 1024 * 1024)))  # Decompressed upload size
+IMPORT_SPOOL_BYTES = 8 * 1024 * 1024  # Uploads larger than this are spooled to disk
+IMPORT_INFLATE_BYTES = 1024 * 1024  # Most output one decompress call may produce
+
+async def build_extension_indexes():
+    """Build the trigram indexes after startup; on a large table that takes minutes."""
+    try:
+        await asyncio.to_thread(create_extension_indexes)
+    except Exception as e:
+        logger.error(f"Building extension indexes failed: {str(e)}")
+
+async def schedule_related_rebuilds(stop: asyncio.Event):
+    """
+    Keep a full related-hashtag rebuild queued: due at once while no neighbours
+    have been built, then every RELATED_REBUILD_SECONDS. Every worker does this;
+    enqueue_merged folds their jobs into the one already queued.
+    """
+    delay = RELATED_REBUILD_SECONDS
+    try:
+        if await asyncio.to_thread(related_service.is_empty):
+            delay = 0
+    except Exception as e:
+        logger.error(f"Checking related hashtags failed: {str(e)}")
+    while not stop.is_set():
+        try:
+            await asyncio.to_thread(job_service.enqueue_merged, "hashtag_related_rebuild", {}, delay)
+        except Exception as e:
+            logger.error(f"Scheduling the related hashtag rebuild failed: {str(e)}")
+        delay = RELATED_REBUILD_SECONDS
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=RELATED_REBUILD_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifecycle event handler"""
+    started = time.perf_counter()
     logger.info("Initializing database...")
     try:
-        init_db()  # Create tables if they don't exist
-        logger.info("Database initialization complete")
+        if FAST_START:
+            ensure_schema()  # One version query unless the models changed
+        else:
+            init_db()  # Create tables if they don't exist
+        schema_ready = time.perf_counter()
+        await engines.warm()
+        logger.info(
+            f"Database ready in {(time.perf_counter() - started) * 1000:.0f} ms "
+            f"(schema {(schema_ready - started) * 1000:.0f} ms, "
+            f"pool warm-up {(time.perf_counter() - schema_ready) * 1000:.0f} ms)"
+        )
     except Exception as e:
         logger.error(f"Database initialization failed: {str(e)}")
         raise
+
+    # Sync endpoints run on AnyIO's threadpool (40 threads by default); give every
+    # route class's concurrency slots a thread, or admitted requests queue again there
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+    stop_workers = asyncio.Event()
+    workers = [
+        asyncio.create_task(job_service.run_worker(job_service.worker_id(i), stop_workers))
+        for i in range(JOB_WORKERS)
+    ]
+    workers.append(asyncio.create_task(build_extension_indexes()))
+    workers.append(asyncio.create_task(trending_service.run_refresher(stop_workers)))
+    workers.append(asyncio.create_task(schedule_related_rebuilds(stop_workers)))
+    workers.append(asyncio.create_task(similar_index.run_maintenance(stop_workers)))
+    workers.append(asyncio.create_task(autocomplete_index.run_maintenance(stop_workers)))
+    workers.append(asyncio.create_task(hashtag_index.run_maintenance(stop_workers)))
+    workers.append(asyncio.create_task(invalidation_listener.run(stop_workers)))
+    if engines.replicas:
+        workers.append(asyncio.create_task(engines.run_health_checks(stop_workers)))
     yield
+    stop_workers.set()
+    await asyncio.gather(*workers)
+    await asyncio.to_thread(shutdown_media_pool)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -37,11 +141,140 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Clients that wrote within DB_READ_YOUR_WRITES_SECONDS read from the primary. The
+# deadline travels in a cookie so it holds across workers and nodes.
+READ_PRIMARY_COOKIE = "read_primary_until"
+# POSTs that only read, and so should not pin the client to the primary
+READ_ONLY_POSTS = {"/api/login", "/api/token/refresh"}
+
+@app.middleware("http")
+async def read_your_writes(request: Request, call_next):
+    try:
+        if float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time():
+            prefer_primary()
+    except ValueError:
+        pass
+    response = await call_next(request)
+    if (request.method in ("POST", "PUT", "PATCH", "DELETE") and response.status_code < 400
+            and request.url.path not in READ_ONLY_POSTS):
+        response.set_cookie(
+            READ_PRIMARY_COOKIE,
+            str(time.time() + DB_READ_YOUR_WRITES_SECONDS),
+            max_age=int(DB_READ_YOUR_WRITES_SECONDS) + 1,
+            httponly=True
+        )
+    return response
+
+# Per-route-class concurrency limits and shedding (see src/middleware.py). Added
+# last so it runs first and rejects overload before any other work is done.
+# Handlers below are plain functions: they call blocking database and argon2
+# code, so FastAPI must run them in its threadpool rather than on the event loop.
+app.add_middleware(LoadShedMiddleware)
+
 # Initialize services
 account_service = AccountService()
 service_service = ServiceService()
 review_service = ReviewService()
 hashtag_service = HashtagService()
+job_service = JobService()
+trending_service = TrendingService()
+related_service = RelatedHashtagService()
+similar_index = SimilarServiceIndex()
+autocomplete_index = AutocompleteIndex()
+hashtag_index = HashtagIndex()
+search_service = SearchService(hashtag_index=hashtag_index)
+import_service = ServiceImportService()
+media_service = MediaService()
+
+# Background job handlers
+job_service.register(
+    "account_purge",
+    lambda payload: account_service.purge_account(payload['account_id'])
+)
+job_service.register(
+    "hashtag_usage_rebuild",
+    lambda payload: hashtag_service.rebuild_usage_counts()
+)
+job_service.register(
+    "hashtag_related_rebuild",
+    lambda payload: related_service.rebuild()
+)
+job_service.register(
+    "hashtag_related_refresh",
+    lambda payload: related_service.refresh(payload['hashtag_ids'], payload['account_ids'])
+)
+job_service.register(
+    "media_gc",
+    lambda payload: media_service.collect_garbage(payload.get('digests'))
+)
+
+bearer = HTTPBearer(auto_error=False)
+
+def current_account_id(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer)) -> int:
+    """Account ID from a verified access token. Costs no password hashing or database work."""
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return int(tokens.verify(credentials.credentials)['sub'])
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+
+def sparse_fields(allowed: List[str]):
+    """Dependency parsing ?fields= against the whitelist of the endpoint's model"""
+    def dependency(fields: Optional[str] = Query(None, description=f"Comma-separated subset of: {', '.join(allowed)}")):
+        try:
+            return parse_fields(fields, allowed)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return dependency
+
+def export_response(request: Request, name: str, fmt: str, columns: List[str], rows):
+    """Stream rows as an attachment, gzip-compressed when the client accepts it"""
+    if fmt not in EXPORT_FORMATS:
+        rows.close()
+        raise HTTPException(status_code=400, detail=f"Unsupported export format: {fmt}")
+    compress = "gzip" in request.headers.get("accept-encoding", "")
+    headers = {"Content-Disposition": f'attachment; filename="{name}.{fmt}"'}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(
+        stream_export(rows, fmt, columns, gzip=compress),
+        media_type=EXPORT_FORMATS[fmt],
+        headers=headers
+    )
+
+def schedule_related_refresh(account_id: int, hashtags):
+    """Queue a neighbour refresh, folded into the pending one so a burst of edits costs one"""
+    job_service.enqueue_merged(
+        "hashtag_related_refresh",
+        {"hashtag_ids": [hashtag_id for hashtag_id, _ in hashtags], "account_ids": [account_id]},
+        delay=RELATED_REFRESH_DELAY
+    )
+
+def inflate(decompressor, data: bytes) -> Iterator[bytes]:
+    """Decompress data in pieces of at most IMPORT_INFLATE_BYTES, so a small chunk cannot expand unchecked"""
+    while not decompressor.eof:
+        try:
+            piece = decompressor.decompress(data, IMPORT_INFLATE_BYTES)
+        except zlib.error:
+            raise HTTPException(status_code=400, detail="Invalid gzip body")
+        data = decompressor.unconsumed_tail
+        if piece:
+            yield piece
+        # A full piece may leave output pending inside zlib even with no input left
+        if not data and len(piece) < IMPORT_INFLATE_BYTES:
+            return
+    if data:
+        raise HTTPException(status_code=400, detail="Invalid gzip body")  # Data after the end of the stream
+
+def schedule_media_gc(digests: Optional[List[str]]):
+    """Remove files left unreferenced by a deletion once the upload grace period has passed"""
+    if digests:
+        job_service.enqueue("media_gc", {"digests": digests}, delay=MEDIA_GC_GRACE)
+
+subscribe("hashtags.added", schedule_related_refresh)
+subscribe("hashtags.removed", schedule_related_refresh)
 
 # Pydantic models for request validation
 class AccountCreate(BaseModel):
@@ -66,7 +299,7 @@ class ReviewCreate(BaseModel):
 
 # Account endpoints
 @app.post("/api/accounts")
-async def create_account(account: AccountCreate):
+def create_account(account: AccountCreate):
     try:
         result = account_service.create_account(
             username=account.username,
@@ -85,21 +318,43 @@ async def create_account(account: AccountCreate):
         )
 
 @app.post("/api/login")
-async def login(username: str = Body(...), password: str = Body(...)):
+def login(username: str = Body(...), password: str = Body(...)):
     try:
         return account_service.login(username, password)
     except ValueError as e:
         raise HTTPException(status_code=401, detail=str(e))
 
+@app.post("/api/token/refresh")
+def refresh_token(refresh_token: str = Body(..., embed=True)):
+    try:
+        return account_service.refresh_login(refresh_token)
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
 @app.get("/api/accounts/{account_id}")
-async def get_account(account_id: int = Path(...)):
-    account = account_service.get_account_by_id(account_id)
+def get_account(
+    account_id: int = Path(...),
+    fields: Optional[List[str]] = Depends(sparse_fields(ACCOUNT_FIELDS))
+):
+    account = account_service.get_account_by_id(account_id, fields=fields)
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
     return account
 
+@app.get("/api/accounts/{account_id}/profile")
+def get_account_profile(
+    account_id: int,
+    limit: int = Query(PROFILE_SERVICES_LIMIT, ge=1, le=PROFILE_SERVICES_MAX_LIMIT),
+    offset: int = Query(0, ge=0)
+):
+    """Account, hashtags, rating totals and a page of services with their ratings, in one response"""
+    profile = account_service.get_profile(account_id, limit=limit, offset=offset)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return profile
+
 @app.put("/api/accounts/{account_id}")
-async def update_account(account_id: int, update_data: AccountUpdate):
+def update_account(account_id: int, update_data: AccountUpdate):
     try:
         return account_service.update_account(
             id=account_id,
@@ -112,7 +367,7 @@ async def update_account(account_id: int, update_data: AccountUpdate):
 
 # Service endpoints
 @app.post("/api/services")
-async def create_service(
+def create_service(
     account_id: int = Query(...),
     service: ServiceCreate = Body(...)
 ):
@@ -126,35 +381,228 @@ async def create_service(
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get("/api/services/{service_id}")
-async def get_service(service_id: int):
-    service = service_service.get_service_by_id(service_id)
-    if not service:
-        raise HTTPException(status_code=404, detail="Service not found")
-    return service
-
-@app.get("/api/accounts/{account_id}/services")
-async def get_account_services(account_id: int):
-    return service_service.get_services_by_account(account_id)
-
+# Static /api/services/* routes must be declared before /api/services/{service_id}
 @app.get("/api/services/search")
-async def search_services(
+def search_services(
     keyword: Optional[str] = None,
     min_price: Optional[int] = None,
-    max_price: Optional[int] = None
+    max_price: Optional[int] = None,
+    fields: Optional[List[str]] = Depends(sparse_fields(SERVICE_FIELDS))
 ):
     return service_service.search_services(
         keyword=keyword,
         min_price=min_price,
-        max_price=max_price
+        max_price=max_price,
+        fields=fields
+    )
+
+@app.get("/api/services/autocomplete")
+def autocomplete_services(
+    q: str = Query(..., max_length=100),
+    limit: int = Query(AUTOCOMPLETE_DEFAULT_LIMIT, ge=1, le=AUTOCOMPLETE_MAX_LIMIT)
+):
+    """Title suggestions for typeahead, from memory. Uncached prefixes scan under the index lock, so off the event loop."""
+    return autocomplete_index.suggest(q, limit=limit)
+
+@app.get("/api/services/export")
+def export_services(
+    request: Request,
+    format: str = Query("ndjson"),
+    account_id: Optional[int] = None
+):
+    return export_response(
+        request, "services", format, SERVICE_EXPORT_COLUMNS,
+        service_service.iter_services(account_id=account_id)
     )
 
+@app.get("/api/services/{service_id}")
+def get_service(service_id: int, fields: Optional[List[str]] = Depends(sparse_fields(SERVICE_FIELDS))):
+    service = service_service.get_service_by_id(service_id, fields=fields)
+    if not service:
+        raise HTTPException(status_code=404, detail="Service not found")
+    return service
+
+@app.get("/api/services/{service_id}/similar")
+def get_similar_services(
+    service_id: int,
+    limit: int = Query(10, ge=1, le=50),
+    fields: Optional[List[str]] = Depends(sparse_fields(SERVICE_FIELDS))
+):
+    matches = similar_index.similar(service_id, limit=limit)
+    scores = dict(matches)
+    services = service_service.get_services_by_ids(
+        [match_id for match_id, _ in matches], fields=fields
+    )
+    # Services may come from the shared cache, so annotate copies
+    return [dict(service, similarity=round(scores[service['id']], 4)) for service in services]
+
+@app.post("/api/accounts/{account_id}/services/import")
+async def import_services(
+    request: Request,
+    account_id: int,
+    format: str = Query("csv"),
+    on_conflict: str = Query("update"),
+    importer_id: int = Depends(current_account_id)
+):
+    """Bulk-create services from a streamed CSV or NDJSON body, optionally gzip-encoded"""
+    if importer_id != account_id:
+        raise HTTPException(status_code=403, detail="Not authorized to import services for this account")
+    upload = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES)
+    try:
+        gzipped = request.headers.get("content-encoding", "").lower() == "gzip"
+        decompressor = zlib.decompressobj(wbits=47) if gzipped else None  # 47 accepts gzip or zlib
+        size = 0
+        async for chunk in request.stream():
+            for piece in (inflate(decompressor, chunk) if decompressor else [chunk]):
+                size += len(piece)
+                if size > IMPORT_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Upload too large")
+                await asyncio.to_thread(upload.write, piece)
+        # A truncated stream inflates cleanly to a partial file; only the end marker shows it is whole
+        if decompressor and (not decompressor.eof or decompressor.unused_data):
+            raise HTTPException(status_code=400, detail="Invalid gzip body")
+        await asyncio.to_thread(upload.seek, 0)
+        return await asyncio.to_thread(import_service.import_upload, account_id, upload, format, on_conflict)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        upload.close()
+
+@app.get("/api/accounts/{account_id}/services")
+def get_account_services(account_id: int, fields: Optional[List[str]] = Depends(sparse_fields(SERVICE_FIELDS))):
+    return service_service.get_services_by_account(account_id, fields=fields)
+
+# Media endpoints
+@app.post("/api/accounts/{account_id}/media")
+async def upload_media(
+    request: Request,
+    account_id: int,
+    service_id: Optional[int] = None,
+    uploader_id: int = Depends(current_account_id)
+):
+    """
+    Store an image sent as the raw request body (not multipart). It is streamed
+    to disk, then validated and resized in the media process pool. Only reading
+    the body runs on the event loop: file writes and hashing go to the
+    threadpool, decoding to the process pool.
+    """
+    if uploader_id != account_id:
+        raise HTTPException(status_code=403, detail="Not authorized to upload media for this account")
+    if service_id is not None:
+        service = await asyncio.to_thread(service_service.get_service_by_id, service_id)
+        if not service:
+            raise HTTPException(status_code=404, detail="Service not found")
+        if service['account_id'] != account_id:
+            raise HTTPException(status_code=403, detail="Not authorized to add media to this service")
+    if int(request.headers.get("content-length") or 0) > MEDIA_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
+
+    writer = await asyncio.to_thread(media_store.writer)
+    try:
+        async for chunk in request.stream():
+            await asyncio.to_thread(writer.write, chunk)
+            if writer.size > MEDIA_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Upload too large")
+        if not writer.size:
+            raise HTTPException(status_code=400, detail="Empty upload")
+        digest = await asyncio.to_thread(writer.commit)
+    except BaseException:
+        await asyncio.to_thread(writer.abort)
+        raise
+
+    try:
+        info = await asyncio.get_running_loop().run_in_executor(
+            media_pool(), render_variants, media_store.root, digest
+        )
+    except ValueError as e:
+        if writer.created:
+            await asyncio.to_thread(media_store.remove, digest)
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        return await asyncio.to_thread(
+            media_service.create_media, account_id, digest, writer.size, info, service_id
+        )
+    except BaseException as e:
+        # Other media may share these files, so leave them to the collector, which checks
+        digests = [digest] + [variant['sha256'] for variant in info['variants'].values()]
+        await asyncio.to_thread(schedule_media_gc, digests)
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+
+# Static /api/media/files/* must be declared before /api/media/{media_id}
+@app.api_route("/api/media/files/{digest}", methods=["GET", "HEAD"])
+def get_media_file(request: Request, digest: str = Path(..., pattern="^[0-9a-f]{64}$")):
+    """
+    Serve a stored file. Files are immutable and named by their hash, so the hash
+    is the ETag and clients may cache them forever. Range requests are handled
+    by FileResponse, which also uses the server's pathsend (sendfile) extension
+    when available; with MEDIA_ACCEL_REDIRECT set, nginx sends the file instead.
+    """
+    path = media_store.path(digest)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Media not found")
+    headers = {"ETag": f'"{digest}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match == "*" or headers["ETag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    media_type = sniff_content_type(path)
+    if MEDIA_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = MEDIA_ACCEL_REDIRECT + media_store.relative_path(digest)
+        return Response(media_type=media_type, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@app.get("/api/media/{media_id}")
+def get_media(media_id: int):
+    media = media_service.get_media(media_id)
+    if not media:
+        raise HTTPException(status_code=404, detail="Media not found")
+    return media
+
+@app.get("/api/accounts/{account_id}/media")
+def get_account_media(account_id: int):
+    return media_service.get_media_by_account(account_id)
+
+@app.get("/api/services/{service_id}/media")
+def get_service_media(service_id: int):
+    return media_service.get_media_by_service(service_id)
+
+@app.delete("/api/media/{media_id}")
+def delete_media(
+    media_id: int = Path(..., description="ID of the media to delete"),
+    account_id: int = Depends(current_account_id)
+):
+    """
+    Delete media (only by the account that uploaded it). Its files are removed
+    later by the media_gc job, unless other media share them.
+    """
+    try:
+        digests = media_service.delete_media(media_id, account_id)
+        if digests is None:
+            raise HTTPException(status_code=404, detail="Media not found")
+        schedule_media_gc(digests)
+        return {"message": f"Media {media_id} successfully deleted"}
+    except ValueError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
 # Review endpoints
+@app.get("/api/reviews/export")
+def export_reviews(
+    request: Request,
+    format: str = Query("ndjson"),
+    account_id: Optional[int] = None,
+    client_id: Optional[int] = None
+):
+    return export_response(
+        request, "reviews", format, REVIEW_EXPORT_COLUMNS,
+        review_service.iter_reviews(account_id=account_id, client_id=client_id)
+    )
+
 @app.post("/api/services/{service_id}/reviews")
-async def create_review(
+def create_review(
     service_id: int,
-    client_id: int = Query(...),
-    review: ReviewCreate = Body(...)
+    review: ReviewCreate = Body(...),
+    client_id: int = Depends(current_account_id)
 ):
     try:
         return review_service.create_review(
@@ -168,16 +616,26 @@ async def create_review(
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/services/{service_id}/reviews")
-async def get_service_reviews(service_id: int):
-    return review_service.get_reviews_by_service(service_id)
+def get_service_reviews(service_id: int, fields: Optional[List[str]] = Depends(sparse_fields(REVIEW_FIELDS))):
+    return review_service.get_reviews_by_service(service_id, fields=fields)
 
 @app.get("/api/services/{service_id}/rating")
-async def get_service_rating(service_id: int):
+def get_service_rating(service_id: int):
     return {"average_rating": review_service.get_average_rating(service_id=service_id)}
 
+@app.get("/api/services/{service_id}/review-summary")
+def get_service_review_summary(
+    service_id: int,
+    latest: int = Query(REVIEW_SUMMARY_LATEST, ge=0, le=REVIEW_SUMMARY_MAX_LATEST)
+):
+    """Rating count, average and histogram plus the latest reviews, for the service page"""
+    if not service_service.get_service_by_id(service_id):
+        raise HTTPException(status_code=404, detail="Service not found")
+    return review_service.get_review_summary(service_id, latest=latest)
+
 # Hashtag endpoints
 @app.post("/api/accounts/{account_id}/hashtags")
-async def add_hashtags(
+def add_hashtags(
     account_id: int,
     tags: List[str] = Body(...)
 ):
@@ -187,22 +645,30 @@ async def add_hashtags(
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/accounts/{account_id}/hashtags")
-async def get_account_hashtags(account_id: int):
+def get_account_hashtags(account_id: int, fields: Optional[List[str]] = Depends(sparse_fields(HASHTAG_FIELDS))):
     try:
-        return hashtag_service.get_account_hashtags(account_id)
+        return hashtag_service.get_account_hashtags(account_id, fields=fields)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/api/hashtags/search")
-async def search_hashtags(query: str = Query(...)):
-    return hashtag_service.search_hashtags(query)
+def search_hashtags(query: str = Query(...), fields: Optional[List[str]] = Depends(sparse_fields(HASHTAG_FIELDS))):
+    return hashtag_service.search_hashtags(query, fields=fields)
+
+@app.get("/api/hashtags/trending")
+def get_trending_hashtags(limit: int = Query(10, ge=1, le=100)):
+    return trending_service.trending(limit=limit)
+
+@app.get("/api/hashtags/{tag}/related")
+def get_related_hashtags(tag: str, limit: int = Query(10, ge=1, le=100)):
+    return related_service.get_related(tag, limit=limit)
 
 @app.get("/api/hashtags/{tag}/accounts")
-async def get_accounts_by_hashtag(tag: str):
-    return hashtag_service.get_accounts_by_hashtag(tag)
+def get_accounts_by_hashtag(tag: str, fields: Optional[List[str]] = Depends(sparse_fields(ACCOUNT_FIELDS))):
+    return hashtag_service.get_accounts_by_hashtag(tag, fields=fields)
 
 @app.delete("/api/accounts/{account_id}/hashtags/{tag}")
-async def remove_hashtag(
+def remove_hashtag(
     account_id: int = Path(..., description="ID of the account"),
     tag: str = Path(..., description="Hashtag to remove")
 ):
@@ -223,7 +689,7 @@ async def remove_hashtag(
 
 # Combined search endpoint
 @app.get("/api/search")
-async def search_all(
+def search_all(
     query: str = Query(...),
     filter_type: Optional[str] = Query(None, enum=['accounts', 'services', 'hashtags'])
 ):
@@ -251,73 +717,105 @@ async def search_all(
 
 # Advanced search endpoint
 @app.get("/api/search/advanced")
-async def advanced_search(
+def advanced_search(
     query: Optional[str] = None,
     service_type: Optional[str] = None,
     min_price: Optional[int] = None,
     max_price: Optional[int] = None,
     hashtags: List[str] = Query([]),
-    sort: str = Query("relevance", enum=["relevance", "price_low", "price_high", "rating"])
+    match: str = Query("any", enum=HASHTAG_MATCHES, description="Provider must carry any or all of hashtags"),
+    exclude_hashtags: List[str] = Query([]),
+    sort: str = Query("relevance", enum=SEARCH_SORTS),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    facets: List[str] = Query([], description=f"Any of: {', '.join(SEARCH_FACETS)}")
 ):
     """
-    Advanced search with multiple filters and sorting options
+    Advanced search with multiple filters and sorting options.
+    With ?facets=price&facets=hashtags&facets=rating the response becomes
+    {"results": [...], "facets": {...}}, counted over all matches.
     """
-    # Start with service search
-    services = service_service.search_services(
-        keyword=query or service_type,
-        min_price=min_price,
-        max_price=max_price
-    )
-    
-    # Filter by hashtags if specified
-    if hashtags:
-        filtered_services = []
-        for service in services:
-            account_tags = hashtag_service.get_account_hashtags(service['account_id'])
-            account_tag_names = [tag['tag'] for tag in account_tags]
-            if any(tag in account_tag_names for tag in hashtags):
-                filtered_services.append(service)
-        services = filtered_services
-    
-    # Sort results
-    if sort == "price_low":
-        services.sort(key=lambda x: x['price'])
-    elif sort == "price_high":
-        services.sort(key=lambda x: x['price'], reverse=True)
-    elif sort == "rating":
-        services.sort(
-            key=lambda x: review_service.get_average_rating(service_id=x['id']),
-            reverse=True
+    try:
+        return search_service.advanced_search(
+            keyword=query or service_type,
+            min_price=min_price,
+            max_price=max_price,
+            hashtags=hashtags,
+            match=match,
+            exclude_hashtags=exclude_hashtags,
+            sort=sort,
+            limit=limit,
+            facets=facets
         )
-    
-    return services
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # Delete Account
 @app.delete("/api/accounts/{account_id}")
-async def delete_account(account_id: int = Path(..., description="ID of the account to delete")):
+def delete_account(account_id: int = Path(..., description="ID of the account to delete")):
     """
-    Delete an account and all associated services, reviews, and hashtags
+    Delete an account and all associated services, reviews, and hashtags.
+    Large accounts are purged in the background and answered with 202 and a job id.
     """
     try:
+        if not account_service.account_exists(account_id):
+            raise HTTPException(status_code=404, detail="Account not found")
+
+        media_digests = media_service.media_digests(account_id=account_id)
+        if account_service.requires_background_purge(account_id):
+            job = job_service.enqueue("account_purge", {"account_id": account_id})
+            schedule_media_gc(media_digests)
+            return JSONResponse(status_code=202, content={
+                'job_id': job['id'],
+                'status': job['status'],
+                'message': f"Account {account_id} is being deleted in the background"
+            })
+
         result = account_service.delete_account(account_id)
         if result:
+            schedule_media_gc(media_digests)
             return {"message": f"Account {account_id} successfully deleted"}
         raise HTTPException(status_code=404, detail="Account not found")
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# Load shedding statistics per route class
+@app.get("/api/admin/load")
+def get_load_stats():
+    return load_stats()
+
+# Local cache statistics and invalidation listener state
+@app.get("/api/admin/cache")
+def get_cache_stats():
+    return {"listening": invalidation_listener.connected, "caches": cache_stats()}
+
+# Group-commit batch sizes, when WRITE_BATCHING is on
+@app.get("/api/admin/batching")
+def get_batching_stats():
+    coalescers = (review_service.coalescer, hashtag_service.coalescer)
+    return {coalescer.name: coalescer.stats() for coalescer in coalescers if coalescer}
+
+# Job status
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: int):
+    job = job_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 # Delete Service
 @app.delete("/api/services/{service_id}")
-async def delete_service(
+def delete_service(
     service_id: int = Path(..., description="ID of the service to delete"),
-    account_id: int = Query(..., description="ID of the account that owns the service")
+    account_id: int = Depends(current_account_id)
 ):
     """
-    Delete a service and its associated reviews
+    Delete a service and its associated reviews (only by the account that owns it)
     """
     try:
+        media_digests = media_service.media_digests(service_id=service_id)
         result = service_service.delete_service(service_id, account_id)
         if result:
+            schedule_media_gc(media_digests)
             return {"message": f"Service {service_id} successfully deleted"}
         raise HTTPException(status_code=404, detail="Service not found")
     except ValueError as e:
@@ -325,9 +823,9 @@ async def delete_service(
 
 # Delete Review
 @app.delete("/api/reviews/{review_id}")
-async def delete_review(
+def delete_review(
     review_id: int = Path(..., description="ID of the review to delete"),
-    client_id: int = Query(..., description="ID of the client who wrote the review")
+    client_id: int = Depends(current_account_id)
 ):
     """
     Delete a review (only by the client who created it)
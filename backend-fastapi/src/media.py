@@ -0,0 +1,310 @@
+"""
+Content-addressed media storage and image processing.
+
+Uploads are streamed to a temporary file under MEDIA_ROOT while being hashed,
+then renamed to MEDIA_ROOT/ab/cd/<sha256>. Identical uploads share one file,
+and a file never changes once written, so its hash doubles as a strong ETag.
+
+Decoding and resizing are CPU-bound, so they run in a process pool
+(render_variants) rather than on the event loop or in the threadpool, where
+they would hold the GIL. Files no longer referenced by any media row are
+removed by MediaService.collect_garbage() once they are older than
+MEDIA_GC_GRACE, which keeps in-flight uploads safe.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+
+from src.lazy import lazy_import
+
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+logger = logging.getLogger(__name__)
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "var/media")
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(20 * 1024 * 1024)))
+MEDIA_MAX_PIXELS = int(os.getenv("MEDIA_MAX_PIXELS", str(50_000_000)))  # Larger images are rejected before decoding
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", str(min(4, os.cpu_count() or 1))))
+MEDIA_GC_GRACE = float(os.getenv("MEDIA_GC_GRACE", "3600"))  # Seconds before an unreferenced file may be removed
+# When set (e.g. "/protected-media/"), files are handed to the proxy with
+# X-Accel-Redirect so nginx serves them with sendfile
+MEDIA_ACCEL_REDIRECT = os.getenv("MEDIA_ACCEL_REDIRECT", "")
+
+# Longest edge of each generated variant, in pixels
+MEDIA_VARIANTS = {
+    "thumb": 256,
+    "medium": 1024,
+}
+MEDIA_FORMATS = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class MediaStore:
+    def __init__(self, root: str = MEDIA_ROOT):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        if not DIGEST_PATTERN.match(digest):
+            raise ValueError("Invalid media digest")
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def relative_path(self, digest: str) -> str:
+        return os.path.relpath(self.path(digest), self.root)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.isfile(self.path(digest))
+
+    def writer(self) -> "MediaWriter":
+        return MediaWriter(self)
+
+    def put_bytes(self, data: bytes) -> str:
+        writer = self.writer()
+        try:
+            writer.write(data)
+            return writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def remove(self, digest: str, older_than: Optional[float] = None) -> bool:
+        """Delete a stored file, unless it was modified at or after older_than (a timestamp)"""
+        path = self.path(digest)
+        try:
+            if older_than is not None and os.stat(path).st_mtime >= older_than:
+                return False  # Re-uploaded since it was chosen for removal
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def iter_files(self) -> Iterator[Tuple[str, float]]:
+        """Yield (digest, mtime) for every stored file"""
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if DIGEST_PATTERN.match(name):
+                    try:
+                        yield name, os.stat(os.path.join(directory, name)).st_mtime
+                    except FileNotFoundError:
+                        continue
+
+class MediaWriter:
+    """Streams one upload to a temporary file in the store, hashing as it goes."""
+
+    def __init__(self, store: MediaStore):
+        self.store = store
+        self.size = 0
+        self.created = False  # Whether commit() added a new file rather than finding an identical one
+        self._hash = hashlib.sha256()
+        incoming = os.path.join(store.root, "incoming")
+        os.makedirs(incoming, exist_ok=True)
+        # Same filesystem as the final location, so commit() is an atomic rename
+        self._file = tempfile.NamedTemporaryFile(dir=incoming, delete=False)
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> str:
+        """Move the file to its content address and return the sha256 hex digest"""
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self.store.path(digest)
+        if os.path.exists(path):
+            os.unlink(self._file.name)
+            os.utime(path)  # Restart the garbage collection grace period
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._file.name, path)
+            self.created = True
+        return digest
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self._file.name)
+        except FileNotFoundError:
+            pass
+
+def sniff_content_type(path: str) -> str:
+    """Content type of a stored image from its leading bytes"""
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def render_variants(root: str, digest: str, variants: Dict[str, int] = MEDIA_VARIANTS) -> dict:
+    """
+    Validate the stored image and write its resized variants to the store.
+    Runs in the media process pool. Raises ValueError for anything that is not
+    a supported, reasonably sized image.
+    """
+    from PIL import UnidentifiedImageError
+
+    # Pillow only raises past twice this and merely warns below; the size check does the rejecting
+    Image.MAX_IMAGE_PIXELS = MEDIA_MAX_PIXELS
+    store = MediaStore(root)
+    path = store.path(digest)
+    try:
+        with Image.open(path) as image:
+            if image.format not in MEDIA_FORMATS:
+                raise ValueError(f"Unsupported image format: {image.format}")
+            # Open reads only the header, so this rejects before any pixel is decoded
+            if image.size[0] * image.size[1] > MEDIA_MAX_PIXELS:
+                raise ValueError(f"Image too large: {image.size[0]}x{image.size[1]} pixels")
+            image.verify()  # Checks structure without decoding; the image must be reopened afterwards
+        with Image.open(path) as image:
+            fmt = image.format
+            width, height = image.size
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):  # EXIF orientations that rotate by 90 degrees
+                width, height = height, width
+            wanted = {name: edge for name, edge in variants.items() if edge < max(width, height)}
+            if wanted and fmt == "JPEG":
+                # Let the JPEG decoder downscale by a power of two while decoding
+                image.draft("RGB", (max(wanted.values()),) * 2)
+            image = ImageOps.exif_transpose(image)
+            alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+            image = image.convert("RGBA" if alpha else "RGB")
+
+            rendered = {}
+            for name, edge in sorted(wanted.items(), key=lambda item: -item[1]):
+                variant = image.copy()
+                variant.thumbnail((edge, edge), Image.LANCZOS)
+                buffer = io.BytesIO()
+                if alpha:
+                    variant.save(buffer, "PNG", optimize=True)
+                else:
+                    variant.save(buffer, "JPEG", quality=85, optimize=True, progressive=True)
+                data = buffer.getvalue()
+                rendered[name] = {
+                    'sha256': store.put_bytes(data),
+                    'content_type': "image/png" if alpha else "image/jpeg",
+                    'size': len(data),
+                    'width': variant.width,
+                    'height': variant.height
+                }
+                image = variant  # Each smaller variant is resized from the previous one
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise ValueError(f"Invalid image: {e}")
+
+    return {
+        'content_type': MEDIA_FORMATS[fmt],
+        'width': width,
+        'height': height,
+        'variants': rendered
+    }
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def media_pool() -> ProcessPoolExecutor:
+    """The process pool for image work, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # forkserver children do not inherit the parent's threads, event loop or database connections
+            _pool = ProcessPoolExecutor(
+                max_workers=MEDIA_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _pool
+
+def shutdown_media_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+store = MediaStore()
+
+
+if __name__ == "__main__":
+    import unittest
+    import shutil
+
+    class TestMediaStore(unittest.TestCase):
+        def setUp(self):
+            self.root = tempfile.mkdtemp()
+            self.store = MediaStore(self.root)
+
+        def tearDown(self):
+            shutil.rmtree(self.root)
+
+        def test_content_addressing(self):
+            writer = self.store.writer()
+            for chunk in (b"hello ", b"world"):
+                writer.write(chunk)
+            digest = writer.commit()
+            self.assertEqual(digest, hashlib.sha256(b"hello world").hexdigest())
+            self.assertTrue(writer.created)
+            self.assertEqual(self.store.put_bytes(b"hello world"), digest)
+            self.assertEqual([name for name, _ in self.store.iter_files()], [digest])
+            self.assertEqual(os.listdir(os.path.join(self.root, "incoming")), [])
+            with self.assertRaises(ValueError):
+                self.store.path("../../etc/passwd")
+
+        def test_render_variants(self):
+            buffer = io.BytesIO()
+            Image.new("RGB", (2000, 1000), (200, 30, 30)).save(buffer, "JPEG")
+            digest = self.store.put_bytes(buffer.getvalue())
+            info = render_variants(self.root, digest)
+            self.assertEqual((info['content_type'], info['width'], info['height']), ("image/jpeg", 2000, 1000))
+            self.assertEqual(set(info['variants']), {"thumb", "medium"})
+            thumb = info['variants']['thumb']
+            self.assertEqual((thumb['width'], thumb['height']), (256, 128))
+            self.assertEqual(sniff_content_type(self.store.path(thumb['sha256'])), "image/jpeg")
+
+            # Images already smaller than a variant get no variant for it
+            buffer = io.BytesIO()
+            Image.new("RGBA", (100, 50)).save(buffer, "PNG")
+            info = render_variants(self.root, self.store.put_bytes(buffer.getvalue()))
+            self.assertEqual((info['content_type'], info['variants']), ("image/png", {}))
+
+        def test_rejects_non_images(self):
+            digest = self.store.put_bytes(b"<svg onload=alert(1)>")
+            with self.assertRaises(ValueError):
+                render_variants(self.root, digest)
+
+        def test_rejects_too_many_pixels(self):
+            global MEDIA_MAX_PIXELS
+            buffer = io.BytesIO()
+            Image.new("RGB", (1000, 1000)).save(buffer, "PNG")
+            digest = self.store.put_bytes(buffer.getvalue())
+            limit, MEDIA_MAX_PIXELS = MEDIA_MAX_PIXELS, 600_000  # Under twice the size, where Pillow only warns
+            try:
+                with self.assertRaisesRegex(ValueError, "too large"):
+                    render_variants(self.root, digest)
+            finally:
+                MEDIA_MAX_PIXELS = limit
+
+        def test_process_pool(self):
+            buffer = io.BytesIO()
+            Image.new("RGB", (600, 300)).save(buffer, "PNG")
+            digest = self.store.put_bytes(buffer.getvalue())
+            try:
+                info = media_pool().submit(render_variants, self.root, digest).result(timeout=60)
+            finally:
+                shutdown_media_pool()
+            self.assertEqual(info['variants']['thumb']['width'], 256)
+
+    unittest.main(verbosity=2)
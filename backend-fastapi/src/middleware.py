@@ -0,0 +1,297 @@
+"""
+Load shedding for the API.
+
+Requests are grouped into route classes (argon2-heavy auth, scan-heavy search,
+long-running exports, imports and media uploads, everything else). Each class
+has its own concurrency limit and a bounded wait queue, so expensive routes
+cannot occupy every worker thread. New arrivals are shed with 503 and
+Retry-After when the queue is full, when they have waited longer than the
+queue timeout, or when the class's recent latency is above its target and
+requests are already waiting. Expensive classes also have a token bucket per
+client, answered with 429 when empty.
+
+Clients are told apart by socket address. X-Forwarded-For is only believed
+when the request comes from one of LOAD_TRUSTED_PROXIES, otherwise anyone could
+rotate it to get fresh buckets. Every class's slots must be backed by a worker
+thread, so the threadpool is sized to their sum (see threadpool_size()).
+"""
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import ipaddress
+import json
+import logging
+import math
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+def _setting(name: str, route_class: str, default: float) -> float:
+    return float(os.getenv(f"LOAD_{name}_{route_class.upper()}", os.getenv(f"LOAD_{name}", default)))
+
+# (method or None for any, path pattern, route class), first match wins
+ROUTE_CLASSES: List[Tuple[Optional[str], "re.Pattern", str]] = [
+    ("POST", re.compile(r"^/api/login$"), "auth"),
+    ("POST", re.compile(r"^/api/accounts$"), "auth"),
+    ("GET", re.compile(r"^/api/search(/|$)"), "search"),
+    ("GET", re.compile(r"^/api/(services|hashtags)/search$"), "search"),
+    ("GET", re.compile(r"^/api/(services|reviews)/export$"), "export"),
+    ("POST", re.compile(r"^/api/accounts/\d+/services/import$"), "import"),
+    ("POST", re.compile(r"^/api/accounts/\d+/media$"), "upload"),
+]
+DEFAULT_ROUTE_CLASS = "default"
+
+# Defaults per class: concurrency, queue length, latency target (ms), client rate (req/s), burst
+DEFAULT_LIMITS = {
+    "auth": (8, 32, 1000, 2, 10),
+    "search": (16, 64, 500, 10, 30),
+    "export": (4, 8, 30000, 0.2, 3),  # Streams hold a slot and a DB connection for their whole duration
+    "import": (2, 4, 60000, 0.1, 2),
+    "upload": (8, 16, 10000, 1, 10),  # Bounded by client bandwidth, then by the media process pool
+    "default": (32, 256, 250, 0, 0),
+}
+LOAD_QUEUE_TIMEOUT = float(os.getenv("LOAD_QUEUE_TIMEOUT", "2.0"))  # Seconds a request may wait for a slot
+LOAD_MAX_CLIENTS = 100000  # Token buckets kept per route class
+# Comma-separated addresses or networks of reverse proxies whose X-Forwarded-For is believed
+LOAD_TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.getenv("LOAD_TRUSTED_PROXIES", "").split(",") if entry.strip()
+]
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+
+class RouteClassLimiter:
+    """Concurrency limit, wait queue, latency tracking and client buckets for one route class."""
+
+    def __init__(self, name: str):
+        concurrency, queue, latency_ms, rate, burst = DEFAULT_LIMITS.get(name, DEFAULT_LIMITS["default"])
+        self.name = name
+        self.limit = int(_setting("CONCURRENCY", name, concurrency))
+        self.max_queue = int(_setting("QUEUE", name, queue))
+        self.latency_target = _setting("LATENCY_MS", name, latency_ms) / 1000
+        self.rate = _setting("RATE", name, rate)
+        self.burst = _setting("BURST", name, burst)
+        self.in_flight = 0
+        self.latency = 0.0  # Exponentially weighted moving average, seconds
+        self.counters = {'admitted': 0, 'queued': 0, 'shed': 0, 'rate_limited': 0}
+        self._waiters: deque = deque()
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def allow_client(self, client: str) -> float:
+        """Take a token for client. Returns 0 if allowed, otherwise seconds until a token is available."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.burst, now)
+            if len(self._buckets) > LOAD_MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0
+        self.counters['rate_limited'] += 1
+        return (1 - bucket.tokens) / self.rate
+
+    async def acquire(self) -> bool:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self.counters['admitted'] += 1
+            return True
+        overloaded = self.latency > self.latency_target
+        if len(self._waiters) >= self.max_queue or (overloaded and self._waiters):
+            self.counters['shed'] += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.counters['queued'] += 1
+        try:
+            await asyncio.wait_for(waiter, timeout=LOAD_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if not (waiter.done() and not waiter.cancelled()):
+                self.counters['shed'] += 1
+                return False
+            # The slot was handed over just as the wait timed out, so keep it
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self.counters['admitted'] += 1
+        return True
+
+    def release(self, elapsed: float):
+        self.latency = 0.9 * self.latency + 0.1 * elapsed if self.latency else elapsed
+        # Hand the slot straight to the oldest waiter that is still waiting
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.in_flight -= 1
+
+    def retry_after(self) -> int:
+        """Rough time for the queue to drain, for the Retry-After header."""
+        per_request = max(self.latency, 0.05)
+        return max(1, math.ceil(per_request * (len(self._waiters) + 1) / max(self.limit, 1)))
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queued': len(self._waiters),
+            'max_queue': self.max_queue,
+            'latency_ms': round(self.latency * 1000, 1),
+            'latency_target_ms': round(self.latency_target * 1000, 1),
+            'client_rate': self.rate,
+            'client_burst': self.burst,
+            **self.counters
+        }
+
+# One limiter per route class, shared by the middleware and the stats endpoint
+route_limiters: Dict[str, RouteClassLimiter] = {
+    name: RouteClassLimiter(name)
+    for name in {route_class for _, _, route_class in ROUTE_CLASSES} | {DEFAULT_ROUTE_CLASS}
+}
+
+class LoadShedMiddleware:
+    """ASGI middleware applying the route class limiters to every HTTP request."""
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limiter = route_limiters[classify(scope["method"], scope["path"])]
+        wait = limiter.allow_client(client_key(scope))
+        if wait:
+            await reject(send, 429, "Too many requests", math.ceil(wait))
+            return
+        if not await limiter.acquire():
+            logger.warning(f"Shedding {scope['method']} {scope['path']} ({limiter.name} overloaded)")
+            await reject(send, 503, "Service overloaded, retry later", limiter.retry_after())
+            return
+
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(time.monotonic() - start)
+
+def load_stats() -> dict:
+    return {name: limiter.stats() for name, limiter in route_limiters.items()}
+
+def classify(method: str, path: str) -> str:
+    for route_method, pattern, route_class in ROUTE_CLASSES:
+        if (route_method is None or route_method == method) and pattern.match(path):
+            return route_class
+    return DEFAULT_ROUTE_CLASS
+
+def threadpool_size() -> int:
+    """Worker threads needed for every route class to fill its concurrency limit at once"""
+    return sum(limiter.limit for limiter in route_limiters.values())
+
+def is_trusted_proxy(address: str, trusted: List = LOAD_TRUSTED_PROXIES) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted)
+
+def client_key(scope, trusted: List = LOAD_TRUSTED_PROXIES) -> str:
+    """
+    The client's address. Behind trusted proxies it is the rightmost
+    X-Forwarded-For entry that is not itself a trusted proxy; entries left of
+    it were supplied by the client and could be anything.
+    """
+    client = scope.get("client")
+    peer = client[0] if client else "unknown"
+    if not is_trusted_proxy(peer, trusted):
+        return peer
+    forwarded = [
+        address.strip()
+        for name, value in scope.get("headers", ()) if name == b"x-forwarded-for"
+        for address in value.decode("latin-1").split(",") if address.strip()
+    ]
+    for address in reversed(forwarded):
+        if not is_trusted_proxy(address, trusted):
+            return address
+    return forwarded[0] if forwarded else peer
+
+async def reject(send, status: int, detail: str, retry_after: int):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class TestRouteClassLimiter(unittest.TestCase):
+        def test_classify(self):
+            self.assertEqual(classify("POST", "/api/login"), "auth")
+            self.assertEqual(classify("GET", "/api/search/advanced"), "search")
+            self.assertEqual(classify("GET", "/api/services/search"), "search")
+            self.assertEqual(classify("GET", "/api/services/export"), "export")
+            self.assertEqual(classify("POST", "/api/accounts/3/media"), "upload")
+            self.assertEqual(classify("GET", "/api/services/7"), "default")
+
+        def test_token_bucket(self):
+            limiter = RouteClassLimiter("auth")
+            limiter.rate, limiter.burst = 1, 2
+            self.assertEqual(limiter.allow_client("a"), 0)
+            self.assertEqual(limiter.allow_client("a"), 0)
+            self.assertGreater(limiter.allow_client("a"), 0)
+            self.assertEqual(limiter.allow_client("b"), 0)
+
+        def test_client_key(self):
+            trusted = [ipaddress.ip_network("10.0.0.0/8")]
+            scope = lambda peer, forwarded: {
+                "client": (peer, 5000), "headers": [(b"x-forwarded-for", forwarded.encode())]
+            }
+            # A direct client cannot choose its key
+            self.assertEqual(client_key(scope("203.0.113.9", "1.2.3.4"), trusted), "203.0.113.9")
+            # Behind the proxy chain, the address the first trusted proxy saw
+            self.assertEqual(client_key(scope("10.0.0.2", "1.2.3.4, 198.51.100.7, 10.0.0.1"), trusted),
+                             "198.51.100.7")
+            self.assertEqual(client_key({"client": ("10.0.0.2", 1), "headers": []}, trusted), "10.0.0.2")
+
+        def test_queue_and_shed(self):
+            async def scenario():
+                limiter = RouteClassLimiter("default")
+                limiter.limit, limiter.max_queue = 1, 1
+                self.assertTrue(await limiter.acquire())
+                queued = asyncio.ensure_future(limiter.acquire())
+                await asyncio.sleep(0)
+                # Queue is full, so the third request is shed immediately
+                self.assertFalse(await limiter.acquire())
+                limiter.release(0.01)
+                self.assertTrue(await queued)
+                limiter.release(0.01)
+                self.assertEqual(limiter.in_flight, 0)
+                self.assertEqual(limiter.counters['shed'], 1)
+
+            asyncio.run(scenario())
+
+    unittest.main(verbosity=2)
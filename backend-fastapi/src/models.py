@@ -1,20 +1,14 @@
-import sys
-from pathlib import Path
-
-# Add the project root directory to sys.path
-project_root = Path(__file__).resolve().parents[1]  # This should be the 'backend' directory
-sys.path.append(str(project_root))
-
-# Now use absolute imports
 from src.db import Base
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Table, Float, Boolean, ARRAY
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Table, Float, Boolean, ARRAY, JSON, Index
 from sqlalchemy.orm import relationship
-from datetime import datetime, UTC
+from datetime import datetime
 
 # Association table for the many-to-many relationship between Accounts and Hashtags
 account_hashtags = Table('account_hashtags', Base.metadata,
-    Column('account_id', Integer, ForeignKey('accounts.id'), primary_key=True),
-    Column('hashtag_id', Integer, ForeignKey('hashtags.id'), primary_key=True)
+    Column('account_id', Integer, ForeignKey('accounts.id', ondelete='CASCADE'), primary_key=True),
+    Column('hashtag_id', Integer, ForeignKey('hashtags.id', ondelete='CASCADE'), primary_key=True),
+    # The primary key leads with account_id; finding a tag's accounts needs its own index
+    Index('ix_account_hashtags_hashtag_id', 'hashtag_id')
 )
 
 class Account(Base):
@@ -24,24 +18,32 @@ class Account(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String(128), nullable=False)
-    created_at = Column(DateTime, default=datetime.now(UTC))
-    updated_at = Column(DateTime, default=datetime.now(UTC), onupdate=datetime.now(UTC))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     location = Column(ARRAY(Float), nullable=True)
     bio = Column(Text, nullable=True)
     website = Column(String, nullable=True)
     is_verified = Column(Boolean, default=False)
 
     # Relationships
-    services = relationship("Service", back_populates="account")
-    reviews = relationship("Review", back_populates="account", foreign_keys="[Review.account_id]")
-    reviews_as_client = relationship("Review", back_populates="client", foreign_keys="[Review.client_id]")
-    hashtags = relationship("Hashtag", secondary=account_hashtags, back_populates="accounts")
+    # Children are removed by ON DELETE CASCADE in the database; passive_deletes
+    # keeps SQLAlchemy from loading them into memory just to delete them.
+    services = relationship("Service", back_populates="account",
+                            cascade="all, delete-orphan", passive_deletes=True)
+    reviews = relationship("Review", back_populates="account", foreign_keys="[Review.account_id]",
+                           cascade="all, delete-orphan", passive_deletes=True)
+    reviews_as_client = relationship("Review", back_populates="client", foreign_keys="[Review.client_id]",
+                                     cascade="all, delete-orphan", passive_deletes=True)
+    hashtags = relationship("Hashtag", secondary=account_hashtags, back_populates="accounts",
+                            passive_deletes=True)
+    media = relationship("Media", back_populates="account",
+                         cascade="all, delete-orphan", passive_deletes=True)
 
 class Service(Base):
     __tablename__ = 'services'
 
     id = Column(Integer, primary_key=True, index=True)
-    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'), nullable=False, index=True)
     title = Column(String, nullable=False)
     description = Column(Text)
     price = Column(Integer)  # Store price in cents
@@ -50,15 +52,18 @@ class Service(Base):
 
     # Relationships
     account = relationship("Account", back_populates="services")
-    reviews = relationship("Review", back_populates="service")
+    reviews = relationship("Review", back_populates="service",
+                           cascade="all, delete-orphan", passive_deletes=True)
+    media = relationship("Media", back_populates="service",
+                         cascade="all, delete-orphan", passive_deletes=True)
 
 class Review(Base):
     __tablename__ = 'reviews'
 
     id = Column(Integer, primary_key=True, index=True)
-    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
-    client_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
-    service_id = Column(Integer, ForeignKey('services.id'), nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'), nullable=False, index=True)
+    client_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'), nullable=False, index=True)
+    service_id = Column(Integer, ForeignKey('services.id', ondelete='CASCADE'), nullable=False, index=True)
     rating = Column(Integer, nullable=False) # 1-5 stars
     title = Column(String, nullable=False)
     body = Column(Text, nullable=False)
@@ -70,15 +75,99 @@ class Review(Base):
     client = relationship("Account", back_populates="reviews_as_client", foreign_keys=[client_id])
     service = relationship("Service", back_populates="reviews")
 
+    # Latest reviews of a service, for the review summary
+    __table_args__ = (Index('ix_reviews_service_id_created_at', 'service_id', 'created_at'),)
+
+class Media(Base):
+    __tablename__ = 'media'
+
+    # Metadata for an uploaded image; the bytes live in the content-addressed store (src/media.py)
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'), nullable=False, index=True)
+    service_id = Column(Integer, ForeignKey('services.id', ondelete='CASCADE'), nullable=True, index=True)
+    sha256 = Column(String(64), nullable=False)
+    content_type = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)  # Bytes
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    variants = Column(JSON, nullable=False, default=dict)  # Name -> sha256, content_type, size, width, height
+    digests = Column(ARRAY(String(64)), nullable=False)  # Every stored file used: original and variants
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    # Relationships
+    account = relationship("Account", back_populates="media")
+    service = relationship("Service", back_populates="media")
+
+    # Garbage collection asks which of a set of files are still referenced
+    __table_args__ = (Index('ix_media_digests', 'digests', postgresql_using='gin'),)
+
 class Hashtag(Base):
     __tablename__ = 'hashtags'
 
     id = Column(Integer, primary_key=True, index=True)
     tag = Column(String, unique=True, index=True, nullable=False)
+    # Accounts using this tag. upgrade_schema() runs the backfill when it adds the column
+    usage_count = Column(Integer, nullable=False, default=0, server_default='0', info={
+        'backfill': "UPDATE hashtags SET usage_count = (SELECT count(*) FROM account_hashtags WHERE hashtag_id = hashtags.id)"
+    })
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationships
-    accounts = relationship("Account", secondary=account_hashtags, back_populates="hashtags")
+    accounts = relationship("Account", secondary=account_hashtags, back_populates="hashtags",
+                            passive_deletes=True)
+
+class HashtagUsageBucket(Base):
+    __tablename__ = 'hashtag_usage_buckets'
+
+    # Net associations added per hashtag per hour, used for trending
+    hashtag_id = Column(Integer, ForeignKey('hashtags.id', ondelete='CASCADE'), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True, index=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class HashtagRelated(Base):
+    __tablename__ = 'hashtag_related'
+
+    # Precomputed top-N co-occurring hashtags, rebuilt by the related-hashtag jobs
+    hashtag_id = Column(Integer, ForeignKey('hashtags.id', ondelete='CASCADE'), primary_key=True)
+    related_id = Column(Integer, ForeignKey('hashtags.id', ondelete='CASCADE'), primary_key=True)
+    score = Column(Float, nullable=False)
+    co_count = Column(Integer, nullable=False)  # Accounts carrying both tags
+
+class Job(Base):
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False, default=dict)
+    status = Column(String, nullable=False, default='queued')  # queued, running, completed, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Workers poll for due jobs by status and run_at
+    __table_args__ = (Index('ix_jobs_status_run_at', 'status', 'run_at'),)
+
+# Indexes that need a Postgres extension, by extension and index name. They are
+# built CONCURRENTLY by create_extension_indexes() outside the startup transaction,
+# when the extension is installed or can be installed, and skipped otherwise.
+# Trigram indexes serve the '%keyword%' ILIKE searches, which no b-tree can.
+Base.metadata.info['extension_indexes'] = {
+    'pg_trgm': {
+        'ix_services_title_trgm':
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_services_title_trgm ON services USING gin (title gin_trgm_ops)",
+        'ix_services_description_trgm':
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_services_description_trgm"
+            " ON services USING gin (description gin_trgm_ops)",
+        'ix_hashtags_tag_trgm':
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_hashtags_tag_trgm ON hashtags USING gin (tag gin_trgm_ops)",
+    }
+}
 
 if __name__ == "__main__":
     import unittest
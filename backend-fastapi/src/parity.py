@@ -0,0 +1,436 @@
+"""
+Cross-backend parity and performance harness.
+
+    python -m src.parity [--backends fastapi,go,node] [--scale 0.2] [--requests 2000]
+                         [--concurrency 8] [--duration 20] [--trace FILE] [--json FILE] [--keep] [--reuse]
+
+Starts each backend in turn (from the sibling backend-* directories) against
+the same database, seeded as by src.plancheck, and replays one request trace
+against it: once in order to record every response, then from --concurrency
+threads for --duration seconds to measure throughput and latency. CPU time
+and peak RSS of the backend's process tree are read from /proc while it runs.
+
+FastAPI is the reference. Another backend is flagged when any response differs
+from FastAPI's (status, and for successes the JSON body, ignoring key order,
+the order of unsorted lists and timestamp formatting), or when its throughput,
+p99 latency, CPU per request or peak RSS is worse than FastAPI's by more than
+PARITY_TOLERANCE. The exit status is 1 if anything was flagged.
+
+The trace only reads, so every backend sees the same data. --trace FILE
+replays the requests in FILE, writing a generated trace there first if it does
+not exist, so runs on different days compare like with like. The load
+generator is a threaded Python client; at high request rates it can become the
+bottleneck, so compare backends at the same --concurrency.
+
+Commands can be overridden with PARITY_<NAME>_COMMAND (e.g. a prebuilt Go
+binary); "{port}" in them is replaced by the port, which is also set as PORT.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlencode
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import text
+
+from src.db import drop_db, engine, init_db
+from src.plancheck import WORDS, seed
+
+PARITY_PORT = int(os.getenv("PARITY_PORT", "8765"))
+PARITY_START_TIMEOUT = float(os.getenv("PARITY_START_TIMEOUT", "120"))  # Seconds; covers go run compiling
+PARITY_TOLERANCE = float(os.getenv("PARITY_TOLERANCE", "0.10"))  # Allowed relative regression per metric
+PARITY_SAMPLE_INTERVAL = 0.2  # Seconds between CPU/RSS samples
+PARITY_MISMATCHES_SHOWN = 5
+PARITY_RETRIES = 5  # Attempts per request while recording, when the backend sheds it
+SHED_STATUSES = (429, 503)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+REFERENCE = "fastapi"
+
+BACKENDS = {
+    'fastapi': (
+        os.path.join(ROOT, "backend-fastapi"),
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1", "--port", "{port}",
+         "--log-level", "warning"],
+    ),
+    'go': (os.path.join(ROOT, "backend-go"), ["go", "run", "src/main.go"]),
+    'node': (os.path.join(ROOT, "backend-node"), ["node", "src/main.js"]),
+}
+
+# (weight, path, query parameters, what a list response is ordered by); filled from trace_inputs().
+# The order is False when it is not part of the answer, or the field the list is sorted by.
+TRACE_TEMPLATES = [
+    (10, "/api/accounts/{account}", [], False),
+    (8, "/api/accounts/{account}/services", [], False),
+    (6, "/api/accounts/{account}/hashtags", [], False),
+    (12, "/api/services/{service}", [], False),
+    (8, "/api/services/{service}/reviews", [], False),
+    (6, "/api/services/{service}/rating", [], False),
+    (5, "/api/services/search", [("keyword", "{phrase}")], False),
+    (4, "/api/hashtags/search", [("query", "{word}")], False),
+    (4, "/api/hashtags/{tag}/accounts", [], False),
+    (3, "/api/search/advanced", [("query", "{phrase}"), ("sort", "price_low"), ("limit", "20")], "price"),
+]
+
+def trace_inputs() -> Dict[str, list]:
+    """Ids and tags of the seeded data for the trace to ask about"""
+    with engine.connect() as conn:
+        return {
+            'account': conn.execute(text("SELECT id FROM accounts WHERE id % 37 = 0 ORDER BY id LIMIT 300")).scalars().all(),
+            'service': conn.execute(text("SELECT id FROM services WHERE id % 97 = 0 ORDER BY id LIMIT 300")).scalars().all(),
+            'tag': conn.execute(text(
+                "SELECT tag FROM hashtags WHERE usage_count > 0 ORDER BY usage_count DESC, id LIMIT 100"
+            )).scalars().all(),
+        }
+
+def build_trace(count: int, inputs: Dict[str, list], seed_value: int = 49) -> List[dict]:
+    rnd = random.Random(seed_value)
+    weights = [template[0] for template in TRACE_TEMPLATES]
+    trace = []
+    for _, path, params, ordered in rnd.choices(TRACE_TEMPLATES, weights=weights, k=count):
+        values = {
+            'account': rnd.choice(inputs['account']),
+            'service': rnd.choice(inputs['service']),
+            'tag': rnd.choice(inputs['tag']),
+            'word': rnd.choice(WORDS),
+            'phrase': f"{rnd.choice(WORDS)} {rnd.choice(WORDS)}",
+        }
+        query = urlencode([(name, value.format(**values)) for name, value in params])
+        trace.append({'method': "GET", 'path': path.format(**values) + (f"?{query}" if query else ""),
+                      'ordered': ordered})
+    return trace
+
+def canonical_order(items: list) -> list:
+    return sorted(items, key=lambda item: json.dumps(item, sort_keys=True))
+
+def normalize(value, ordered: Union[bool, str] = True):
+    """
+    A canonical form of a JSON response for comparison: keys sorted, floats
+    rounded, timestamps as naive UTC, and lists sorted unless their order is
+    part of the answer (only the outermost list's order is kept then). When
+    ordered names the field the list is sorted by, items that tie on it may
+    come in any order, so each run of ties is sorted as a set.
+    """
+    if isinstance(value, dict):
+        return {key: normalize(item, False) for key, item in sorted(value.items())}
+    if isinstance(value, list):
+        items = [normalize(item, False) for item in value]
+        if isinstance(ordered, str):
+            tie = lambda item: item.get(ordered) if isinstance(item, dict) else item
+            return [item for _, run in itertools.groupby(items, key=tie) for item in canonical_order(list(run))]
+        return items if ordered else canonical_order(items)
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, str) and len(value) >= 19 and value[4:5] == "-" and value[10:11] == "T":
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        return moment.isoformat(timespec="microseconds")
+    return value
+
+def process_tree(pid: int) -> List[int]:
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue  # Exited meanwhile
+    return pids
+
+def tree_usage(pid: int) -> Tuple[float, int]:
+    """CPU seconds used so far and resident bytes of pid and its descendants"""
+    cpu, rss = 0.0, 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime, stime
+            with open(f"/proc/{current}/status") as f:
+                rss += next((int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:")), 0)
+        except OSError:
+            continue
+    return cpu, rss
+
+@dataclass
+class BackendResult:
+    name: str
+    error: Optional[str] = None
+    responses: Dict[str, Tuple[int, object]] = field(default_factory=dict)
+    mismatches: List[str] = field(default_factory=list)
+    requests: int = 0
+    errors: int = 0
+    shed: int = 0  # Refused with 429 or 503 by load shedding
+    seconds: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    cpu_seconds: float = 0.0
+    peak_rss: int = 0
+    flags: List[str] = field(default_factory=list)
+
+    def percentile(self, share: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            'throughput': self.requests / self.seconds if self.seconds else 0.0,
+            'p50_ms': self.percentile(0.50) * 1000,
+            'p95_ms': self.percentile(0.95) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'cpu_ms_per_request': self.cpu_seconds * 1000 / self.requests if self.requests else 0.0,
+            'peak_rss_mb': self.peak_rss / 2 ** 20,
+        }
+
+def request(conn: http.client.HTTPConnection, entry: dict) -> Tuple[int, bytes, float]:
+    """Status, body and Retry-After seconds (1 if absent)"""
+    conn.request(entry['method'], entry['path'], headers={'Accept': "application/json"})
+    response = conn.getresponse()
+    return response.status, response.read(), float(response.getheader("Retry-After") or 1)
+
+def start(name: str, port: int, log) -> subprocess.Popen:
+    cwd, command = BACKENDS[name]
+    override = os.getenv(f"PARITY_{name.upper()}_COMMAND")
+    if override:
+        command = shlex.split(override)
+    # The harness is one client standing in for many, so per-client rate limits are off
+    env = dict(os.environ, PORT=str(port), DB_ECHO="0", PYTHONPATH=cwd, LOAD_RATE="0")
+    return subprocess.Popen([part.format(port=port) for part in command], cwd=cwd, env=env,
+                            stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+def wait_ready(process: subprocess.Popen, port: int, probe: str):
+    """Return once the backend answers HTTP at all; raise if it exits or PARITY_START_TIMEOUT passes"""
+    deadline = time.monotonic() + PARITY_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"exited with status {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            request(conn, {'method': "GET", 'path': probe})
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.25)
+    raise RuntimeError(f"not answering after {PARITY_START_TIMEOUT:.0f}s")
+
+def stop(process: subprocess.Popen):
+    if process.poll() is None:
+        os.killpg(process.pid, 15)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, 9)
+            process.wait()
+
+def record_responses(result: BackendResult, port: int, trace: List[dict]):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    for entry in {entry['path']: entry for entry in trace}.values():
+        for _ in range(PARITY_RETRIES):
+            status, body, retry_after = request(conn, entry)
+            if status not in SHED_STATUSES:
+                break
+            time.sleep(retry_after)
+        if 200 <= status < 300:
+            try:
+                body = normalize(json.loads(body), entry['ordered'])
+            except ValueError:
+                pass
+        else:
+            body = None  # Error bodies are each framework's own; the status must match
+        result.responses[entry['path']] = (status, body)
+    conn.close()
+
+def replay(result: BackendResult, process: subprocess.Popen, port: int, trace: List[dict],
+           concurrency: int, duration: float):
+    counter = itertools.count()
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    shed = [0] * concurrency
+    deadline = time.monotonic() + duration
+
+    def worker(index: int):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        while time.monotonic() < deadline:
+            entry = trace[next(counter) % len(trace)]
+            begin = time.perf_counter()
+            try:
+                status = request(conn, entry)[0]
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                status = 0
+            latencies[index].append(time.perf_counter() - begin)
+            if status in SHED_STATUSES:
+                shed[index] += 1
+            elif status == 0 or status >= 500:
+                errors[index] += 1
+        conn.close()
+
+    peak = [0]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(PARITY_SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], tree_usage(process.pid)[1])
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    cpu_before, rss = tree_usage(process.pid)
+    peak[0] = rss
+    sampler.start()
+    begin = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.seconds = time.monotonic() - begin
+    cpu_after, rss = tree_usage(process.pid)
+    done.set()
+    sampler.join()
+
+    result.latencies = [latency for per_thread in latencies for latency in per_thread]
+    result.requests = len(result.latencies)
+    result.errors = sum(errors)
+    result.shed = sum(shed)
+    result.cpu_seconds = cpu_after - cpu_before
+    result.peak_rss = max(peak[0], rss)
+
+def run_backend(name: str, port: int, trace: List[dict], concurrency: int, duration: float) -> BackendResult:
+    result = BackendResult(name)
+    with tempfile.NamedTemporaryFile("w+", prefix=f"parity-{name}-", suffix=".log", delete=False) as log:
+        try:
+            process = start(name, port, log)
+        except OSError as e:
+            result.error = f"could not start: {str(e)}"
+            return result
+        try:
+            wait_ready(process, port, trace[0]['path'])
+            record_responses(result, port, trace)
+            replay(result, process, port, trace, concurrency, duration)
+        except Exception as e:
+            log.flush()
+            log.seek(0)
+            tail = log.read().strip().splitlines()[-5:]
+            result.error = f"{str(e)}; log {log.name}:" + "".join(f"\n      {line}" for line in tail)
+        finally:
+            stop(process)
+    return result
+
+def compare(result: BackendResult, reference: BackendResult, tolerance: float = PARITY_TOLERANCE):
+    """Flag response differences and metrics worse than the reference's by more than tolerance"""
+    if result.error:
+        result.flags.append(f"did not run: {result.error}")
+        return
+    for path, expected in reference.responses.items():
+        actual = result.responses.get(path)
+        if actual != expected:
+            result.mismatches.append(path)
+    if result.mismatches:
+        result.flags.append(f"{len(result.mismatches)} of {len(reference.responses)} responses differ, e.g. "
+                            + ", ".join(result.mismatches[:PARITY_MISMATCHES_SHOWN]))
+    if result.errors:
+        result.flags.append(f"{result.errors} failed requests")
+    if result.shed > reference.shed:
+        result.flags.append(f"{result.shed} requests shed, against {reference.shed} for {reference.name}")
+    ours, theirs = result.metrics(), reference.metrics()
+    if ours['throughput'] < theirs['throughput'] * (1 - tolerance):
+        result.flags.append(f"throughput {ours['throughput'] / theirs['throughput'] - 1:+.0%}")
+    for metric in ("p99_ms", "cpu_ms_per_request", "peak_rss_mb"):
+        if theirs[metric] and ours[metric] > theirs[metric] * (1 + tolerance):
+            result.flags.append(f"{metric} {ours[metric] / theirs[metric] - 1:+.0%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="Comma-separated; fastapi always runs first")
+    parser.add_argument("--scale", type=float, default=0.2, help="Dataset size, as for src.plancheck")
+    parser.add_argument("--requests", type=int, default=2000, help="Length of a generated trace")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of load per backend")
+    parser.add_argument("--port", type=int, default=PARITY_PORT)
+    parser.add_argument("--trace", help="Trace file to replay, generated there if missing")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded tables afterwards")
+    parser.add_argument("--reuse", action="store_true", help="Use data already in the tables instead of seeding (implies --keep)")
+    args = parser.parse_args()
+    keep = args.keep or args.reuse  # Never drop data this run did not seed
+
+    names = [name.strip() for name in args.backends.split(",") if name.strip()]
+    unknown = sorted(set(names).difference(BACKENDS))
+    if unknown:
+        sys.exit(f"Unknown backend(s): {', '.join(unknown)}. Known: {', '.join(BACKENDS)}")
+    names = [REFERENCE] + [name for name in names if name != REFERENCE]
+
+    init_db()
+    with engine.connect() as conn:
+        populated = conn.execute(text("SELECT EXISTS (SELECT 1 FROM accounts)")).scalar()
+    if populated and not args.reuse:
+        sys.exit("The accounts table is not empty; use a scratch database, or --reuse to run against its data")
+    try:
+        if not populated:
+            seed(args.scale)
+        if args.trace and os.path.exists(args.trace):
+            with open(args.trace) as f:
+                trace = json.load(f)
+        else:
+            trace = build_trace(args.requests, trace_inputs())
+            if args.trace:
+                with open(args.trace, "w") as f:
+                    json.dump(trace, f, indent=1)
+
+        results = []
+        for name in names:
+            print(f"Running {name}...", flush=True)
+            results.append(run_backend(name, args.port, trace, args.concurrency, args.duration))
+    finally:
+        if not keep:
+            drop_db()
+
+    reference = results[0]
+    if reference.error:
+        sys.exit(f"The reference backend ({REFERENCE}) did not run: {reference.error}")
+    for result in results[1:]:
+        compare(result, reference)
+
+    print(f"\n{len(trace)} requests in the trace, {len(reference.responses)} distinct; "
+          f"{args.concurrency} clients for {args.duration:.0f}s per backend")
+    print(f"{'backend':<10}{'requests':>10}{'errors':>8}{'shed':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'cpu ms/req':>12}{'peak rss MB':>13}")
+    for result in results:
+        if result.error:
+            print(f"{result.name:<10}  did not run")
+        else:
+            m = result.metrics()
+            print(f"{result.name:<10}{result.requests:>10}{result.errors:>8}{result.shed:>7}{m['throughput']:>9.0f}{m['p50_ms']:>9.2f}"
+                  f"{m['p95_ms']:>9.2f}{m['p99_ms']:>9.2f}{m['cpu_ms_per_request']:>12.3f}{m['peak_rss_mb']:>13.1f}")
+        for flag in result.flags:
+            print(f"    {flag}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([{
+                'backend': result.name, 'error': result.error, 'requests': result.requests, 'errors': result.errors, 'shed': result.shed,
+                'mismatches': result.mismatches, 'flags': result.flags, **({} if result.error else result.metrics())
+            } for result in results], f, indent=2)
+    sys.exit(1 if any(result.flags for result in results) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""
+Query plan regression suite.
+
+    python -m src.plancheck [--scale 1] [--only NAME] [--update] [--keep] [--reuse]
+
+Seeds a production-sized dataset into the configured database, calls the
+service methods the API serves, and captures every statement each call sends.
+Each statement is run again under EXPLAIN (ANALYZE, BUFFERS) in a transaction
+that is rolled back (writes that cannot be replayed get a plain EXPLAIN), and
+the suite fails when a plan:
+
+- sequentially scans a table holding more than PLAN_SEQ_SCAN_MAX_ROWS rows,
+  unless the case allows it for that table,
+- touches more shared buffers, or takes longer, than the case's budget,
+- differs in shape (node types, tables and indexes) from the stored baseline
+  in src/plan_baselines.json. Run with --update after an intended change and
+  commit the file, so the plan change shows up in review.
+
+The tables are created empty and dropped at the end (keep them with --keep;
+--reuse plans against the data already there and never drops it), so point
+DB_NAME at a scratch database. Cases whose index needs an extension (pg_trgm)
+fail when the server lacks it; --allow-missing-extensions skips them instead,
+for development machines only, since their plans then go unchecked. They also
+fail, rather than report "new", while they have no baseline: it can only be
+recorded on a server with the extension.
+"""
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import difflib
+import json
+import os
+import sys
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+from src.cache import flush_all
+from src.db import create_extension_indexes, drop_db, engine, extension_installed, init_db
+import src.models  # noqa: F401 - registers the tables with init_db()
+from src.services.account import AccountService
+from src.services.hashtag import HashtagService
+from src.services.job import JobService
+from src.services.related import RelatedHashtagService
+from src.services.review import ReviewService
+from src.services.search import SearchService
+from src.services.service import ServiceService
+
+PLAN_SEQ_SCAN_MAX_ROWS = int(os.getenv("PLAN_SEQ_SCAN_MAX_ROWS", "10000"))
+PLAN_MAX_BUFFERS = int(os.getenv("PLAN_MAX_BUFFERS", "1000"))  # 8kB pages, hit or read, per statement
+PLAN_MAX_MS = float(os.getenv("PLAN_MAX_MS", "20"))  # Execution time per statement
+PLAN_BASELINES = os.path.join(os.path.dirname(__file__), "plan_baselines.json")
+
+# Rows per unit of --scale; roughly a mid-sized production database at 1
+SEED_ACCOUNTS = 20000
+SEED_SERVICES = 100000
+SEED_REVIEWS = 500000
+SEED_HASHTAGS = 2000
+SEED_TAGS_PER_ACCOUNT = 3
+SEED_JOBS = 20000
+
+WORDS = [
+    "lawn", "garden", "logo", "design", "brand", "dog", "walking", "house", "cleaning", "tax",
+    "advice", "guitar", "lessons", "photo", "editing", "web", "plumbing", "repair", "moving", "tutoring",
+    "yoga", "catering", "wedding", "painting", "bike", "car", "wash", "math", "piano", "resume",
+    "writing", "video", "mixing", "tile", "roof", "window", "pet", "sitting", "fitness", "coaching",
+]
+
+SEED_SQL = [
+    """
+    INSERT INTO accounts (username, email, hashed_password, bio, is_verified, created_at, updated_at)
+    SELECT 'user' || g, 'user' || g || '@example.com', 'x', 'Bio of user ' || g, g % 10 = 0,
+           now() - random() * interval '1000 days', now()
+    FROM generate_series(1, :accounts) g
+    """,
+    """
+    INSERT INTO hashtags (tag, created_at)
+    SELECT (:words)[1 + g % cardinality(:words)] || g, now() - random() * interval '1000 days'
+    FROM generate_series(1, :hashtags) g
+    """,
+    # Skewed: low ids are popular tags, as in production
+    """
+    INSERT INTO account_hashtags (account_id, hashtag_id)
+    SELECT a, 1 + floor(power(random(), 3) * :hashtags)::int
+    FROM generate_series(1, :accounts) a, generate_series(1, :tags_per_account)
+    ON CONFLICT DO NOTHING
+    """,
+    "UPDATE hashtags SET usage_count = (SELECT count(*) FROM account_hashtags WHERE hashtag_id = hashtags.id)",
+    # Skewed: a few providers offer many services
+    """
+    INSERT INTO services (account_id, title, description, price, created_at, updated_at)
+    SELECT 1 + floor(power(random(), 2) * :accounts)::int,
+           initcap((:words)[1 + floor(random() * cardinality(:words))::int] || ' '
+                   || (:words)[1 + floor(random() * cardinality(:words))::int]),
+           (SELECT string_agg((:words)[1 + floor(random() * cardinality(:words))::int], ' ')
+            FROM generate_series(1, 12 + g % 2)),
+           100 * (5 + floor(random() * 500)::int),
+           now() - random() * interval '1000 days', now()
+    FROM generate_series(1, :services) g
+    """,
+    """
+    INSERT INTO reviews (account_id, client_id, service_id, rating, title, body, created_at, updated_at)
+    SELECT s.account_id, p.client_id, s.id, p.rating, 'Review ' || p.g, 'Body of review ' || p.g,
+           now() - random() * interval '1000 days', now()
+    FROM (
+        SELECT g, 1 + floor(power(random(), 2) * :services)::int AS service_id,
+               1 + floor(random() * :accounts)::int AS client_id, 1 + floor(random() * 5)::int AS rating
+        FROM generate_series(1, :reviews) g
+    ) p
+    JOIN services s ON s.id = p.service_id
+    """,
+    """
+    INSERT INTO hashtag_related (hashtag_id, related_id, score, co_count)
+    SELECT h, 1 + floor(random() * :hashtags)::int, random(), 1 + floor(random() * 100)::int
+    FROM generate_series(1, :hashtags) h, generate_series(1, 10)
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO hashtag_usage_buckets (hashtag_id, bucket_start, count)
+    SELECT 1 + floor(random() * :hashtags)::int,
+           date_trunc('hour', now() AT TIME ZONE 'utc') - floor(random() * 24 * 30) * interval '1 hour',
+           1 + floor(random() * 10)::int
+    FROM generate_series(1, :hashtags * 20)
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO jobs (kind, payload, status, attempts, max_attempts, run_at, result, created_at, updated_at)
+    SELECT 'rebuild_related', '{}', 'completed', 1, 5, t, '{}', t, t
+    FROM (SELECT now() AT TIME ZONE 'utc' - random() * interval '30 days' AS t
+          FROM generate_series(1, :jobs)) g
+    """,
+]
+
+def seed(scale: float):
+    """Fill the (empty) tables with generated data and refresh the planner statistics"""
+    params = {
+        'accounts': int(SEED_ACCOUNTS * scale), 'services': int(SEED_SERVICES * scale),
+        'reviews': int(SEED_REVIEWS * scale), 'hashtags': int(SEED_HASHTAGS * scale),
+        'tags_per_account': SEED_TAGS_PER_ACCOUNT, 'jobs': int(SEED_JOBS * scale), 'words': WORDS,
+    }
+    with engine.begin() as conn:
+        conn.execute(text("SELECT setseed(0.49)"))  # Same data, so the same plans, on every run
+        for statement in SEED_SQL:
+            conn.execute(text(statement), params)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM ANALYZE"))
+
+@dataclass
+class Sample:
+    """Representative rows of the seeded data for the cases to look up"""
+    provider: int  # Account with the most services
+    provider_name: str
+    client: int
+    service: int  # Service with the most reviews
+    service_ids: List[int]
+    account_ids: List[int]
+    popular_tag: str
+    rare_tag: str
+
+def sample() -> Sample:
+    with engine.connect() as conn:
+        provider, name = conn.execute(text(
+            "SELECT a.id, a.username FROM accounts a JOIN services s ON s.account_id = a.id"
+            " GROUP BY a.id ORDER BY count(*) DESC, a.id LIMIT 1"
+        )).one()
+        client = conn.execute(text(
+            "SELECT client_id FROM reviews GROUP BY client_id ORDER BY count(*) DESC, client_id LIMIT 1"
+        )).scalar()
+        service = conn.execute(text(
+            "SELECT service_id FROM reviews GROUP BY service_id ORDER BY count(*) DESC, service_id LIMIT 1"
+        )).scalar()
+        service_ids = conn.execute(text("SELECT id FROM services ORDER BY id LIMIT 500 OFFSET 1000")).scalars().all()
+        account_ids = conn.execute(text("SELECT id FROM accounts ORDER BY id LIMIT 500 OFFSET 1000")).scalars().all()
+        popular, rare = conn.execute(text(
+            "(SELECT tag FROM hashtags ORDER BY usage_count DESC, id LIMIT 1)"
+            " UNION ALL (SELECT tag FROM hashtags WHERE usage_count > 0 ORDER BY usage_count, id LIMIT 1)"
+        )).scalars().all()
+    return Sample(provider, name, client, service, service_ids, account_ids, popular, rare)
+
+@dataclass
+class PlanCase:
+    name: str
+    call: Callable[[Sample], object]
+    max_buffers: int = PLAN_MAX_BUFFERS
+    max_ms: float = PLAN_MAX_MS
+    seq_scan_ok: Tuple[str, ...] = ()  # Tables this case may scan whole, e.g. because it reads most of them
+    requires: Optional[str] = None  # Extension whose indexes the good plan depends on
+
+def cases() -> List[PlanCase]:
+    # Samples are the busiest rows, so budgets above the default cover a worst case that legitimately reads more
+    accounts, services, reviews = AccountService(), ServiceService(), ReviewService()
+    hashtags, search, related, jobs = HashtagService(), SearchService(), RelatedHashtagService(), JobService()
+    return [
+        PlanCase("accounts.get_account_by_id", lambda s: accounts.get_account_by_id(s.provider)),
+        PlanCase("accounts.get_account_by_username", lambda s: accounts.get_account_by_username(s.provider_name)),
+        PlanCase("accounts.get_account_by_email",
+                 lambda s: accounts.get_account_by_email(f"{s.provider_name}@example.com")),
+        PlanCase("accounts.get_profile", lambda s: accounts.get_profile(s.provider), max_buffers=5000),
+        PlanCase("accounts.update_account", lambda s: accounts.update_account(s.client, username=f"client{s.client}")),
+        PlanCase("services.get_service_by_id", lambda s: services.get_service_by_id(s.service)),
+        PlanCase("services.get_services_by_account", lambda s: services.get_services_by_account(s.provider)),
+        PlanCase("services.get_services_by_ids", lambda s: services.get_services_by_ids(s.service_ids),
+                 max_buffers=2000),
+        PlanCase("services.search_services", lambda s: services.search_services(keyword="guitar lessons"),
+                 requires="pg_trgm"),
+        PlanCase("services.create_service",
+                 lambda s: services.create_service(s.provider, "Plan check", "Created by the plan check", 1000)),
+        PlanCase("reviews.get_review_by_id", lambda s: reviews.get_review_by_id(1)),
+        PlanCase("reviews.get_reviews_by_service", lambda s: reviews.get_reviews_by_service(s.service),
+                 max_buffers=2000),
+        PlanCase("reviews.get_reviews_by_account", lambda s: reviews.get_reviews_by_account(s.provider),
+                 max_buffers=4000),
+        PlanCase("reviews.get_reviews_by_client", lambda s: reviews.get_reviews_by_client(s.client)),
+        PlanCase("reviews.get_average_rating(service)", lambda s: reviews.get_average_rating(service_id=s.service),
+                 max_buffers=2000),
+        PlanCase("reviews.get_average_rating(account)", lambda s: reviews.get_average_rating(account_id=s.provider),
+                 max_buffers=4000),
+        PlanCase("reviews.get_review_summary", lambda s: reviews.get_review_summary(s.service), max_buffers=2000),
+        PlanCase("reviews.get_rating_stats", lambda s: reviews.get_rating_stats(s.service_ids),
+                 max_buffers=10000, max_ms=50),
+        PlanCase("reviews.create_review", lambda s: reviews.create_review(s.client, s.service_ids[0], 4, "Good", "Fine")),
+        PlanCase("hashtags.get_hashtag", lambda s: hashtags.get_hashtag(s.popular_tag)),
+        PlanCase("hashtags.get_account_hashtags", lambda s: hashtags.get_account_hashtags(s.provider)),
+        PlanCase("hashtags.get_hashtags_for_accounts", lambda s: hashtags.get_hashtags_for_accounts(s.account_ids),
+                 max_buffers=2000),
+        PlanCase("hashtags.get_accounts_by_hashtag(rare)", lambda s: hashtags.get_accounts_by_hashtag(s.rare_tag)),
+        PlanCase("hashtags.get_accounts_by_hashtag(popular)",
+                 lambda s: hashtags.get_accounts_by_hashtag(s.popular_tag), max_buffers=20000, max_ms=40),
+        PlanCase("hashtags.search_hashtags", lambda s: hashtags.search_hashtags("guitar1"), requires="pg_trgm"),
+        PlanCase("hashtags.add_hashtags_to_account",
+                 lambda s: hashtags.add_hashtags_to_account(s.client, [s.rare_tag, "plancheck"])),
+        PlanCase("related.get_related", lambda s: related.get_related(s.popular_tag)),
+        PlanCase("search.advanced_search", lambda s: search.advanced_search(
+            "guitar lessons", hashtags=[s.popular_tag], sort="rating", facets=["price", "rating"]
+        ), max_buffers=5000, requires="pg_trgm"),
+        PlanCase("jobs.claim_next", lambda s: jobs.claim_next("plancheck")),
+    ]
+
+def capture(call: Callable[[], object]) -> Tuple[List[Tuple[str, object]], Optional[Exception]]:
+    """The statements call() sends, with their parameters, in order, and the error it raised if any"""
+    statements = []
+    error = None
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            statements.append((statement, parameters))
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        call()
+    except Exception as e:
+        error = e
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    return statements, error
+
+def explain(statement: str, parameters) -> Tuple[dict, bool]:
+    """
+    The plan of statement, and whether it was executed (ANALYZE). Runs twice so
+    the measured run finds the pages cached, as they would be in steady state.
+    """
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SET LOCAL jit = off")
+        try:
+            for _ in range(2):
+                with conn.begin_nested():
+                    plan = conn.exec_driver_sql(
+                        "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters
+                    ).scalar()
+            analyzed = True
+        except Exception:
+            # E.g. an INSERT whose row now exists; the plan shape is still worth checking
+            plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+            analyzed = False
+        conn.rollback()
+    return plan[0], analyzed
+
+def plan_nodes(plan: dict, depth: int = 0):
+    """(depth, node) for every node of an EXPLAIN JSON plan, parents first"""
+    yield depth, plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child, depth + 1)
+
+def plan_shape(plan: dict) -> List[str]:
+    """The plan as indented 'Node Type on table using index' lines, without costs or row counts"""
+    lines = []
+    for depth, node in plan_nodes(plan['Plan']):
+        line = node['Node Type']
+        if 'Relation Name' in node:
+            line += f" on {node['Relation Name']}"
+        if 'Index Name' in node:
+            line += f" using {node['Index Name']}"
+        lines.append("  " * depth + line)
+    return lines
+
+def table_rows() -> Dict[str, int]:
+    with engine.connect() as conn:
+        return dict(conn.execute(text(
+            "SELECT relname, reltuples::bigint FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace"
+        )).all())
+
+@dataclass
+class CaseResult:
+    name: str
+    shapes: List[List[str]] = field(default_factory=list)
+    problems: List[str] = field(default_factory=list)
+    skipped: Optional[str] = None
+    max_ms: float = 0.0
+    max_buffers: int = 0
+
+def check(case: PlanCase, data: Sample, rows: Dict[str, int], allow_missing: bool = False) -> CaseResult:
+    result = CaseResult(case.name)
+    if case.requires:
+        with engine.connect() as conn:
+            if not extension_installed(conn, case.requires):
+                missing = f"needs the {case.requires} extension, which this server lacks"
+                if allow_missing:
+                    result.skipped = missing
+                else:
+                    result.problems.append(f"{missing} (--allow-missing-extensions to skip)")
+                return result
+    flush_all()  # So the call reaches the database instead of a cache
+    statements, error = capture(lambda: case.call(data))
+    if error is not None:
+        result.problems.append(f"call failed: {error!r}")
+    for number, (statement, parameters) in enumerate(statements, 1):
+        plan, analyzed = explain(statement, parameters)
+        result.shapes.append(plan_shape(plan))
+        for _, node in plan_nodes(plan['Plan']):
+            table = node.get('Relation Name')
+            if (node['Node Type'] == "Seq Scan" and rows.get(table, 0) > PLAN_SEQ_SCAN_MAX_ROWS
+                    and table not in case.seq_scan_ok):
+                result.problems.append(f"statement {number}: Seq Scan on {table} ({rows[table]} rows)")
+        if not analyzed:
+            continue
+        buffers = plan['Plan'].get('Shared Hit Blocks', 0) + plan['Plan'].get('Shared Read Blocks', 0)
+        result.max_buffers = max(result.max_buffers, buffers)
+        result.max_ms = max(result.max_ms, plan['Execution Time'])
+        if buffers > case.max_buffers:
+            result.problems.append(f"statement {number}: {buffers} buffers, budget {case.max_buffers}")
+        if plan['Execution Time'] > case.max_ms:
+            result.problems.append(f"statement {number}: {plan['Execution Time']:.1f} ms, budget {case.max_ms} ms")
+    return result
+
+def compare(result: CaseResult, baseline: Optional[List[List[str]]]) -> List[str]:
+    """Unified diff lines between the baseline plan shapes and the current ones; empty if unchanged"""
+    if baseline is None or baseline == result.shapes:
+        return []
+    as_lines = lambda shapes: [line for number, shape in enumerate(shapes, 1)
+                               for line in [f"statement {number}:", *shape]]
+    return list(difflib.unified_diff(as_lines(baseline), as_lines(result.shapes), "baseline", "current", lineterm=""))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=float, default=1.0, help="Dataset size relative to the default")
+    parser.add_argument("--only", action="append", default=[], help="Run cases whose name contains this")
+    parser.add_argument("--update", action="store_true", help="Store the current plan shapes as the baseline")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded tables afterwards")
+    parser.add_argument("--reuse", action="store_true",
+                        help="Use data already in the tables instead of seeding; implies --keep")
+    parser.add_argument("--allow-missing-extensions", action="store_true",
+                        help="Skip cases needing an extension the server lacks instead of failing")
+    args = parser.parse_args()
+    keep = args.keep or args.reuse  # Never drop data we did not seed
+
+    init_db()
+    with engine.connect() as conn:
+        populated = conn.execute(text("SELECT EXISTS (SELECT 1 FROM accounts)")).scalar()
+    if populated and not args.reuse:
+        sys.exit("The accounts table is not empty; use a scratch database, or --reuse to plan against its data")
+    try:
+        if not populated:
+            start = time.perf_counter()
+            seed(args.scale)
+            print(f"Seeded in {time.perf_counter() - start:.1f}s")
+        create_extension_indexes()  # As the app does after startup
+        rows = table_rows()
+        data = sample()
+        baselines = {}
+        if os.path.exists(PLAN_BASELINES):
+            with open(PLAN_BASELINES) as f:
+                baselines = json.load(f)
+
+        failed = False
+        print(f"{'case':<44}{'stmts':>6}{'max ms':>9}{'buffers':>9}  status")
+        for case in cases():
+            if args.only and not any(part in case.name for part in args.only):
+                continue
+            result = check(case, data, rows, args.allow_missing_extensions)
+            if result.skipped:
+                print(f"{case.name:<44}{'':>24}  skipped: {result.skipped}")
+                continue
+            diff = compare(result, baselines.get(case.name))
+            if case.requires and case.name not in baselines and not args.update:
+                result.problems.append(
+                    f"no baseline; run --update on a server with {case.requires} and commit {PLAN_BASELINES}"
+                )
+            status = "FAIL" if result.problems or diff else "new" if case.name not in baselines else "ok"
+            if args.update:
+                baselines[case.name] = result.shapes
+            elif diff:
+                result.problems.append("plan shape differs from the baseline (--update to accept):")
+                result.problems.extend("    " + line for line in diff)
+            failed = failed or bool(result.problems)
+            print(f"{case.name:<44}{len(result.shapes):>6}{result.max_ms:>9.2f}{result.max_buffers:>9}  {status}")
+            for problem in result.problems:
+                print(f"    {problem}")
+
+        if args.update:
+            with open(PLAN_BASELINES, "w") as f:
+                json.dump(dict(sorted(baselines.items())), f, indent=2)
+                f.write("\n")
+            print(f"Baselines written to {PLAN_BASELINES}")
+    finally:
+        if not keep:
+            drop_db()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
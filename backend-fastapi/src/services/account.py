@@ -1,19 +1,44 @@
-import sys
-from pathlib import Path
-
-# Add the project root directory to sys.path
-project_root = Path(__file__).resolve().parents[2]  # This should be the 'backend' directory
-sys.path.append(str(project_root))
-
-# Now you can import from src.db and src.models
-from src.db import get_db_session, init_db, drop_db
-from src.models import Account
+from src.db import get_db_session, get_read_session, init_db, drop_db
+from src.models import Account, Service, Review, account_hashtags
+from src.auth import tokens
+from src.cache import local_cache, notify_invalidation
+from src.fields import select_fields
+from src.services.review import rating_keys
 
+from sqlalchemy import select, delete, func, or_, bindparam
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from argon2 import PasswordHasher, exceptions
+from typing import List, Optional
+import os
 
 ph = PasswordHasher()
 
+# Accounts owning more dependent rows than this are purged in the background
+PURGE_SYNC_LIMIT = int(os.getenv("PURGE_SYNC_LIMIT", "5000"))
+PURGE_CHUNK_SIZE = int(os.getenv("PURGE_CHUNK_SIZE", "1000"))
+
+# Profile pages: services shown per page, and the most a request may ask for
+PROFILE_SERVICES_LIMIT = int(os.getenv("PROFILE_SERVICES_LIMIT", "20"))
+PROFILE_SERVICES_MAX_LIMIT = 100
+
+# Columns a client may request with ?fields=, and those returned by default
+ACCOUNT_FIELDS = ['id', 'username', 'email', 'bio', 'website', 'location', 'is_verified', 'created_at', 'updated_at']
+ACCOUNT_DEFAULT_FIELDS = ['id', 'username', 'email']
+
+account_cache = local_cache("accounts")
+profile_cache = local_cache("profiles")
+
+# Hot lookups are built once with bind parameters. Each call then skips
+# statement construction and goes straight to SQLAlchemy's compiled cache.
+ACCOUNT_BY_USERNAME = (
+    select_fields(Account, ACCOUNT_DEFAULT_FIELDS).where(Account.username == bindparam('username')).limit(1)
+)
+ACCOUNT_BY_EMAIL = select_fields(Account, ACCOUNT_DEFAULT_FIELDS).where(Account.email == bindparam('email')).limit(1)
+ACCOUNT_LOGIN = select(
+    Account.id, Account.username, Account.email, Account.hashed_password
+).where(or_(Account.username == bindparam('login'), Account.email == bindparam('login'))).limit(1)
+
 class AccountService:
     def create_account(self, username: str, email: str, password: str):
         with get_db_session() as session:
@@ -42,38 +67,105 @@ class AccountService:
                 session.rollback()
                 raise ValueError("An error occurred while creating the account")
 
-    def get_account_by_id(self, id: int):
-        with get_db_session() as session:
-            account = session.get(Account, id)
-            if account:
-                return {
+    def get_account_by_id(self, id: int, fields: Optional[List[str]] = None):
+        """The account as a dict. With fields, only those columns are read, bypassing the cache."""
+        if fields is not None:
+            return self._load_account(id, fields)
+        return account_cache.get_or_load(id, lambda: self._load_account(id))
+
+    def _load_account(self, id: int, fields: Optional[List[str]] = None):
+        with get_read_session() as session:
+            row = session.execute(
+                select_fields(Account, fields or ACCOUNT_DEFAULT_FIELDS).where(Account.id == id)
+            ).first()
+            return row._asdict() if row else None
+
+    def get_profile(self, id: int, limit: int = PROFILE_SERVICES_LIMIT, offset: int = 0):
+        """
+        Everything the profile screen shows, in a fixed number of queries: the
+        account with its hashtags (selectinload), one page of services with
+        their rating aggregates joined in, and the account's totals. First
+        pages are cached as a unit; later pages are loaded directly.
+        """
+        if offset == 0 and limit <= PROFILE_SERVICES_LIMIT:
+            profile = profile_cache.get_or_load(id, lambda: self._load_profile(id, PROFILE_SERVICES_LIMIT, 0))
+            # Cached profiles are shared, so page into a new dict rather than trimming this one
+            return profile and {**profile, 'services': profile['services'][:limit], 'limit': limit}
+        return self._load_profile(id, limit, offset)
+
+    def _load_profile(self, id: int, limit: int, offset: int):
+        with get_read_session() as session:
+            account = session.execute(
+                select(Account).options(selectinload(Account.hashtags)).where(Account.id == id)
+            ).scalar_one_or_none()
+            if not account:
+                return None
+
+            ratings = (
+                select(Review.service_id, func.count(Review.id).label('review_count'),
+                       func.avg(Review.rating).label('average_rating'))
+                .where(Review.account_id == id)
+                .group_by(Review.service_id)
+                .subquery()
+            )
+            services = session.execute(
+                select(Service, ratings.c.review_count, ratings.c.average_rating)
+                .outerjoin(ratings, ratings.c.service_id == Service.id)
+                .where(Service.account_id == id)
+                .order_by(Service.created_at.desc(), Service.id.desc())
+                .limit(limit)
+                .offset(offset)
+            ).all()
+
+            service_count, review_count, average_rating = session.execute(select(
+                select(func.count()).select_from(Service).where(Service.account_id == id).scalar_subquery(),
+                select(func.count()).select_from(Review).where(Review.account_id == id).scalar_subquery(),
+                select(func.avg(Review.rating)).where(Review.account_id == id).scalar_subquery()
+            )).one()
+
+            return {
+                'account': {
                     'id': account.id,
                     'username': account.username,
-                    'email': account.email
-                }
-            return None
+                    'email': account.email,
+                    'bio': account.bio,
+                    'website': account.website,
+                    'location': account.location,
+                    'is_verified': account.is_verified,
+                    'created_at': account.created_at
+                },
+                'hashtags': sorted(({
+                    'id': tag.id,
+                    'tag': tag.tag,
+                    'created_at': tag.created_at
+                } for tag in account.hashtags), key=lambda tag: tag['tag']),
+                'review_count': review_count,
+                'average_rating': float(average_rating) if average_rating else 0.0,
+                'service_count': service_count,
+                'limit': limit,
+                'offset': offset,
+                'services': [{
+                    'id': service.id,
+                    'account_id': service.account_id,
+                    'title': service.title,
+                    'description': service.description,
+                    'price': service.price,
+                    'created_at': service.created_at,
+                    'updated_at': service.updated_at,
+                    'review_count': service_reviews or 0,
+                    'average_rating': float(service_average) if service_average else 0.0
+                } for service, service_reviews, service_average in services]
+            }
 
     def get_account_by_username(self, username: str):
-        with get_db_session() as session:
-            account = session.query(Account).filter(Account.username == username).first()
-            if account:
-                return {
-                    'id': account.id,
-                    'username': account.username,
-                    'email': account.email
-                }
-            return None
+        with get_read_session() as session:
+            row = session.execute(ACCOUNT_BY_USERNAME, {'username': username}).first()
+            return row._asdict() if row else None
 
     def get_account_by_email(self, email: str):
-        with get_db_session() as session:
-            account = session.query(Account).filter(Account.email == email).first()
-            if account:
-                return {
-                    'id': account.id,
-                    'username': account.username,
-                    'email': account.email
-                }
-            return None
+        with get_read_session() as session:
+            row = session.execute(ACCOUNT_BY_EMAIL, {'email': email}).first()
+            return row._asdict() if row else None
 
     def update_account(self, id: int, username: str = None, email: str = None, password: str = None):
         with get_db_session() as session:
@@ -97,6 +189,8 @@ class AccountService:
                 account.hashed_password = ph.hash(password)
 
             try:
+                notify_invalidation(session, "accounts", [id])
+                notify_invalidation(session, "profiles", [id])
                 session.commit()
                 return {
                     'id': account.id,
@@ -108,33 +202,158 @@ class AccountService:
                 raise ValueError("An error occurred while updating the account")
 
     def delete_account(self, id: int):
+        """
+        Delete an account in a single statement.
+
+        Services and reviews go with it through ON DELETE CASCADE, so nothing is
+        loaded into the session; hashtag links are deleted first so the usage of
+        their tags can be decremented. Large accounts should go through
+        purge_account instead to avoid one long-running transaction.
+        """
         with get_db_session() as session:
-            account = session.get(Account, id)
-            if account:
-                session.delete(account)
-                session.commit()
-                return True
-            return False
+            removed = self._removed_keys(session, id)
+            self._unlink_hashtags(session, id)
+            result = session.execute(delete(Account).where(Account.id == id))
+            self._notify_removed(session, removed)
+            session.commit()
+            return result.rowcount > 0
+
+    def account_exists(self, id: int) -> bool:
+        with get_db_session() as session:
+            return session.execute(
+                select(Account.id).where(Account.id == id)
+            ).first() is not None
+
+    def requires_background_purge(self, id: int) -> bool:
+        """Whether the account owns too many rows to delete on the request path."""
+        with get_db_session() as session:
+            # Each count stops at the limit, so this stays cheap for huge accounts
+            review_count = session.execute(
+                select(func.count()).select_from(
+                    select(Review.id)
+                    .where(or_(Review.account_id == id, Review.client_id == id))
+                    .limit(PURGE_SYNC_LIMIT + 1)
+                    .subquery()
+                )
+            ).scalar()
+            service_count = session.execute(
+                select(func.count()).select_from(
+                    select(Service.id)
+                    .where(Service.account_id == id)
+                    .limit(PURGE_SYNC_LIMIT + 1)
+                    .subquery()
+                )
+            ).scalar()
+            return review_count + service_count > PURGE_SYNC_LIMIT
+
+    def purge_account(self, id: int, chunk_size: int = PURGE_CHUNK_SIZE) -> dict:
+        """
+        Delete an account and its dependent rows in bounded chunks.
+
+        Every chunk runs in its own short transaction, so locks are held briefly
+        and memory use does not depend on the size of the account.
+        """
+        deleted = {'reviews': 0, 'services': 0, 'hashtags': 0}
+        with get_db_session() as session:
+            removed = self._removed_keys(session, id)
+
+        def delete_chunk(table_key, model, condition):
+            while True:
+                with get_db_session() as session:
+                    ids = select(model.id).where(condition).limit(chunk_size).scalar_subquery()
+                    count = session.execute(delete(model).where(model.id.in_(ids))).rowcount
+                    session.commit()
+                deleted[table_key] += count
+                if count < chunk_size:
+                    break
+
+        delete_chunk('reviews', Review, or_(Review.account_id == id, Review.client_id == id))
+        delete_chunk('services', Service, Service.account_id == id)
+
+        with get_db_session() as session:
+            deleted['hashtags'] = self._unlink_hashtags(session, id)
+            deleted['account'] = session.execute(
+                delete(Account).where(Account.id == id)
+            ).rowcount > 0
+            self._notify_removed(session, removed)
+            session.commit()
+        return deleted
+
+    def _unlink_hashtags(self, session, id: int) -> int:
+        """Delete the account's hashtag links and count them out of their tags' usage."""
+        # hashtag.py imports this module, so import on use
+        from src.services.hashtag import record_usage
+        hashtag_ids = session.scalars(
+            delete(account_hashtags)
+            .where(account_hashtags.c.account_id == id)
+            .returning(account_hashtags.c.hashtag_id)
+        ).all()
+        record_usage(session, hashtag_ids, -1)
+        return len(hashtag_ids)
+
+    def _removed_keys(self, session, id: int) -> dict:
+        """
+        Cache keys that go stale when the account is deleted, read before its rows go:
+        its services, their ratings, and the ratings and profiles of the providers
+        it reviewed. Beyond PURGE_SYNC_LIMIT of either, those caches are flushed instead.
+        """
+        service_ids = session.scalars(
+            select(Service.id).where(Service.account_id == id).limit(PURGE_SYNC_LIMIT + 1)
+        ).all()
+        reviewed = session.execute(
+            select(Review.service_id, Review.account_id).where(Review.client_id == id)
+            .distinct().limit(PURGE_SYNC_LIMIT + 1)
+        ).all()
+        keys = {
+            'accounts': [id],
+            'account_hashtags': [id],
+            'search': ["services", "reviews", "account_hashtags"],
+        }
+        if len(service_ids) > PURGE_SYNC_LIMIT or len(reviewed) > PURGE_SYNC_LIMIT:
+            return {**keys, 'services': None, 'ratings': None, 'profiles': None}
+        ratings = {key for service_id in service_ids for key in rating_keys(service_id, id)}
+        ratings.update(key for service_id, provider_id in reviewed for key in rating_keys(service_id, provider_id))
+        return {
+            **keys,
+            'services': sorted(service_ids),
+            'ratings': sorted(ratings),
+            'profiles': sorted({id, *(provider_id for _, provider_id in reviewed)}),
+        }
+
+    def _notify_removed(self, session, keys: dict):
+        for name, cache_keys in keys.items():
+            notify_invalidation(session, name, cache_keys)
 
     def login(self, username_or_email: str, password: str):
         with get_db_session() as session:
-            account = session.query(Account).filter(
-                (Account.username == username_or_email) | (Account.email == username_or_email)
-            ).first()
+            account = session.execute(ACCOUNT_LOGIN, {'login': username_or_email}).first()
 
             if not account:
                 raise ValueError("Invalid username or email")
 
             if self.verify_password(account, password):
-                return {
+                account_data = {
                     'id': account.id,
                     'username': account.username,
                     'email': account.email
                 }
+                return {**account_data, **tokens.issue(account_data, account.hashed_password)}
             else:
                 raise ValueError("Invalid password")
 
-    def verify_password(self, account: Account, password: str) -> bool:
+    def refresh_login(self, refresh_token: str):
+        """Exchange a refresh token for a new token pair. Fails once the password has changed."""
+        claims = tokens.verify(refresh_token, "refresh")
+        # Read from the primary so a lagging replica cannot accept a revoked token
+        with get_db_session() as session:
+            account = session.get(Account, int(claims['sub']))
+            if not account or tokens.fingerprint(account.hashed_password) != claims.get('pwd'):
+                raise ValueError("Refresh token has been revoked")
+            account_data = {'id': account.id, 'username': account.username}
+            return tokens.issue(account_data, account.hashed_password)
+
+    def verify_password(self, account, password: str) -> bool:
+        """account is an Account or any row with a hashed_password"""
         try:
             ph.verify(account.hashed_password, password)
             return True
@@ -179,6 +398,29 @@ if __name__ == "__main__":
             self.assertIsNotNone(fetched)
             self.assertEqual(fetched['username'], self.test_account_data["username"])
 
+        def test_get_profile(self):
+            from src.services.service import ServiceService
+            from src.services.review import ReviewService
+            provider = self.account_service.create_account(**self.test_account_data)
+            client = self.account_service.create_account("profileclient", "profileclient@example.com", "pw")
+            services = [
+                ServiceService().create_service(provider['id'], f"Service {i}", "d", 1000 * i) for i in range(3)
+            ]
+            ReviewService().create_review(client['id'], services[0]['id'], 4, "Good", "Fine work")
+
+            profile = self.account_service.get_profile(provider['id'], limit=2)
+            self.assertEqual((profile['service_count'], profile['review_count']), (3, 1))
+            self.assertEqual([service['title'] for service in profile['services']], ["Service 2", "Service 1"])
+            page = self.account_service.get_profile(provider['id'], limit=2, offset=2)
+            self.assertEqual(page['services'][0]['average_rating'], 4.0)
+
+            # Writes invalidate the cached first page
+            ServiceService().create_service(provider['id'], "Service 3", "d", 10)
+            profile = self.account_service.get_profile(provider['id'], limit=2)
+            self.assertEqual(profile['service_count'], 4)
+            self.assertEqual(profile['services'][0]['title'], "Service 3")
+            self.assertIsNone(self.account_service.get_profile(10 ** 6))
+
         def test_update_account(self):
             account = self.account_service.create_account(**self.test_account_data)
             updated_data = {"username": "updateduser", "email": "updated@example.com"}
@@ -193,6 +435,52 @@ if __name__ == "__main__":
             deleted = self.account_service.get_account_by_id(account['id'])
             self.assertIsNone(deleted)
 
+        def test_delete_invalidates_removed_keys(self):
+            from src.cache import on_invalidation
+            from src.services.service import ServiceService
+            from src.services.review import ReviewService
+            provider = self.account_service.create_account("keysprovider", "keysprovider@example.com", "pw")
+            account = self.account_service.create_account(**self.test_account_data)
+            reviewed = ServiceService().create_service(provider['id'], "Reviewed", "d", 100)
+            own = ServiceService().create_service(account['id'], "Own", "d", 100)
+            ReviewService().create_review(account['id'], reviewed['id'], 5, "Great", "Thanks")
+
+            seen = {}
+            for name in ("services", "ratings", "profiles"):
+                on_invalidation(name, lambda keys, name=name: seen.setdefault(name, keys))
+            self.account_service.delete_account(account['id'])
+            self.assertEqual(seen['services'], [own['id']])
+            self.assertEqual(set(seen['ratings']), {
+                *rating_keys(own['id'], account['id']), *rating_keys(reviewed['id'], provider['id'])
+            })
+            self.assertEqual(seen['profiles'], sorted([account['id'], provider['id']]))
+
+        def test_delete_decrements_hashtag_usage(self):
+            from src.services.hashtag import HashtagService
+            from src.models import Hashtag, HashtagUsageBucket
+            hashtags = HashtagService(batching=False)
+            keeper = self.account_service.create_account("keeper", "keeper@example.com", "pw")
+            hashtags.add_hashtags_to_account(keeper['id'], ["usage"])
+            for purge in (False, True):
+                account = self.account_service.create_account(**self.test_account_data)
+                hashtags.add_hashtags_to_account(account['id'], ["usage", "drift"])
+                if purge:
+                    self.assertTrue(self.account_service.purge_account(account['id'])['account'])
+                else:
+                    self.assertTrue(self.account_service.delete_account(account['id']))
+                with get_db_session() as session:
+                    counts = dict(session.execute(
+                        select(Hashtag.tag, Hashtag.usage_count).where(Hashtag.tag.in_(["usage", "drift"]))
+                    ).all())
+                    buckets = dict(session.execute(
+                        select(Hashtag.tag, func.sum(HashtagUsageBucket.count))
+                        .join(HashtagUsageBucket, HashtagUsageBucket.hashtag_id == Hashtag.id)
+                        .where(Hashtag.tag.in_(["usage", "drift"]))
+                        .group_by(Hashtag.tag)
+                    ).all())
+                self.assertEqual(counts, {'usage': 1, 'drift': 0})
+                self.assertEqual(buckets, {'usage': 1, 'drift': 0})
+
         def test_login(self):
             self.account_service.create_account(**self.test_account_data)
             logged_in = self.account_service.login(
@@ -201,6 +489,13 @@ if __name__ == "__main__":
             )
             self.assertIsNotNone(logged_in)
             self.assertEqual(logged_in['username'], self.test_account_data["username"])
+            self.assertEqual(tokens.verify(logged_in['access_token'])['sub'], str(logged_in['id']))
+
+            refreshed = self.account_service.refresh_login(logged_in['refresh_token'])
+            self.assertIn('access_token', refreshed)
+            self.account_service.update_account(logged_in['id'], password="changed123")
+            with self.assertRaises(ValueError):
+                self.account_service.refresh_login(logged_in['refresh_token'])
 
         def test_verify_password(self):
             created = self.account_service.create_account(**self.test_account_data)
@@ -0,0 +1,320 @@
+from src.db import SessionLocal, get_read_session, any_id, id_array
+from src.models import Service, Review
+from src.events import subscribe
+from src.cache import on_invalidation
+from sqlalchemy import select, func
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_MAX_WORDS = int(os.getenv("AUTOCOMPLETE_MAX_WORDS", "6"))  # Title words a suggestion can start at
+AUTOCOMPLETE_KEY_LENGTH = int(os.getenv("AUTOCOMPLETE_KEY_LENGTH", "32"))  # Characters of each key kept
+AUTOCOMPLETE_REBUILD_SECONDS = float(os.getenv("AUTOCOMPLETE_REBUILD_SECONDS", "300"))
+AUTOCOMPLETE_DEFAULT_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 20
+AUTOCOMPLETE_TOP_KEEP = AUTOCOMPLETE_MAX_LIMIT + 10  # Spare entries, so a few removals need no rescan
+AUTOCOMPLETE_BUILT_PREFIX = 2  # Rankings for prefixes up to this long are computed by build()
+AUTOCOMPLETE_SCAN_LIMIT = 1000  # Rankings of prefixes matching more keys than this are kept once computed
+AUTOCOMPLETE_LOAD_CHUNK = 10000
+
+WORD_PATTERN = re.compile(r"\w+")
+SEPARATOR = "\x00"  # Sorts before every character, so "lawn" + SEPARATOR + id precedes "lawns"
+
+def normalize(text: Optional[str]) -> str:
+    return " ".join(WORD_PATTERN.findall(text.lower())) if text else ""
+
+class AutocompleteIndex:
+    """
+    Per-worker prefix index over service titles, for typeahead.
+
+    The normalized title is indexed from each of its first
+    AUTOCOMPLETE_MAX_WORDS words, so "des" finds "Lawn design". Keys are
+    "<text from that word>\\0<service id>", cut to AUTOCOMPLETE_KEY_LENGTH
+    characters of text, in one sorted list with the service ids alongside; a
+    prefix is the range between two bisections. Memory is therefore bounded
+    per service (at most AUTOCOMPLETE_MAX_WORDS short strings). Matches are
+    ranked by review count, then average rating, then recency.
+
+    Short or common prefixes match a large share of all keys, so their
+    rankings are kept in _top and adjusted on every change instead of being
+    rescanned: those up to AUTOCOMPLETE_BUILT_PREFIX characters long from
+    build(), others once a query finds more than AUTOCOMPLETE_SCAN_LIMIT keys.
+
+    The index is built at startup with a streaming query and kept current by
+    the services.* events of this worker and by the "services" cache
+    invalidations of every worker, which also cover imports and rows removed
+    with their account; a flush of that cache rebuilds early. Rating changes
+    are picked up by the periodic rebuild.
+    """
+
+    def __init__(self, scan_limit: int = AUTOCOMPLETE_SCAN_LIMIT):
+        self.scan_limit = scan_limit
+        self._lock = threading.RLock()
+        self._keys: List[str] = []
+        self._ids: List[int] = []  # Service id of each key
+        self._titles: Dict[int, str] = {}
+        self._scores: Dict[int, Tuple[int, float]] = {}  # (review count, average rating)
+        self._top: Dict[str, List[int]] = {}  # Short prefix -> best AUTOCOMPLETE_TOP_KEEP ids, best first
+        self._replay: Optional[list] = None  # Changes made while a build runs, applied to its result
+        self._dirty = set()  # Service ids invalidated since the last refresh
+        self._stale = threading.Event()  # The services cache was flushed: rebuild
+        self.ready = False
+
+        subscribe("services.created", lambda service: self.upsert(service))
+        subscribe("services.updated", lambda service: self.upsert(service))
+        subscribe("services.deleted", lambda service_id: self.remove(service_id))
+        on_invalidation("services", self._invalidated)
+
+    def build(self):
+        """Build the index from all services and their rating stats with a streaming query."""
+        entries: List[Tuple[str, int]] = []
+        titles: Dict[int, str] = {}
+        scores: Dict[int, Tuple[int, float]] = {}
+        with self._lock:
+            self._replay = []
+            self._stale.clear()
+        ratings = (
+            select(Review.service_id, func.count(Review.id).label('count'), func.avg(Review.rating).label('average'))
+            .group_by(Review.service_id)
+            .subquery()
+        )
+        try:
+            with get_read_session() as session:
+                result = session.execute(
+                    select(Service.id, Service.title, ratings.c.count, ratings.c.average)
+                    .outerjoin(ratings, ratings.c.service_id == Service.id)
+                    .execution_options(yield_per=AUTOCOMPLETE_LOAD_CHUNK)
+                )
+                heaps: Dict[str, list] = {}  # Short prefix -> min-heap of its best (rank, id)
+                for service_id, title, count, average in result:
+                    titles[service_id] = title
+                    scores[service_id] = (count or 0, float(average or 0))
+                    texts = self._texts(title)
+                    entries.extend((f"{text}{SEPARATOR}{service_id}", service_id) for text in texts)
+                    rank = (scores[service_id], service_id)
+                    for prefix in self._prefixes(texts, AUTOCOMPLETE_BUILT_PREFIX):
+                        heap = heaps.setdefault(prefix, [])
+                        if len(heap) < AUTOCOMPLETE_TOP_KEEP:
+                            heapq.heappush(heap, rank)
+                        elif rank > heap[0]:
+                            heapq.heapreplace(heap, rank)
+            entries.sort()
+            top = {prefix: [service_id for _, service_id in sorted(heap, reverse=True)] for prefix, heap in heaps.items()}
+        except BaseException:
+            with self._lock:
+                self._replay = None
+            raise
+
+        with self._lock:
+            replay, self._replay = self._replay, None
+            self._keys = [key for key, _ in entries]
+            self._ids = [service_id for _, service_id in entries]
+            self._titles = titles
+            self._scores = scores
+            self._top = top
+            self.ready = True
+            for change in replay:
+                change()
+        logger.info(f"Autocomplete index built: {len(titles)} services, {len(entries)} keys")
+
+    def upsert(self, service: dict):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(lambda: self.upsert(service))
+            if not self.ready:
+                return
+            service_id = service['id']
+            self._remove(service_id)
+            self._titles[service_id] = service['title']
+            self._scores.setdefault(service_id, (0, 0.0))
+            texts = self._texts(service['title'])
+            for text in texts:
+                key = f"{text}{SEPARATOR}{service_id}"
+                position = bisect_left(self._keys, key)
+                self._keys.insert(position, key)
+                self._ids.insert(position, service_id)
+            rank = self._rank(service_id)
+            for prefix in self._prefixes(texts):
+                ranked = self._top.get(prefix)
+                if ranked is not None:
+                    position = next((i for i, other in enumerate(ranked) if self._rank(other) < rank), len(ranked))
+                    if position < AUTOCOMPLETE_TOP_KEEP:
+                        ranked.insert(position, service_id)
+                        del ranked[AUTOCOMPLETE_TOP_KEEP:]
+
+    def remove(self, service_id: int):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(lambda: self.remove(service_id))
+            self._remove(service_id)
+            self._scores.pop(service_id, None)
+
+    def suggest(self, prefix: str, limit: int = AUTOCOMPLETE_DEFAULT_LIMIT) -> List[dict]:
+        """Up to limit services whose title has a word starting with prefix, most popular first"""
+        prefix = normalize(prefix)[:AUTOCOMPLETE_KEY_LENGTH]
+        if not prefix:
+            return []
+        with self._lock:
+            ids = self._top.get(prefix)
+            if ids is None:
+                start = bisect_left(self._keys, prefix)
+                end = bisect_left(self._keys, prefix + "\U0010ffff", start)
+                ids = heapq.nlargest(AUTOCOMPLETE_TOP_KEEP, set(self._ids[start:end]), key=self._rank)
+                if end - start > self.scan_limit:
+                    self._top[prefix] = ids
+            return [{'id': service_id, 'title': self._titles[service_id]} for service_id in ids[:limit]]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'services': len(self._titles),
+                'keys': len(self._keys),
+                'key_bytes': sum(len(key) for key in self._keys),
+                'ranked_prefixes': len(self._top)
+            }
+
+    async def run_maintenance(self, stop: asyncio.Event):
+        """
+        Build the index, then until stop is set reload invalidated services
+        every second and rebuild every AUTOCOMPLETE_REBUILD_SECONDS or when flushed.
+        """
+        while not stop.is_set():
+            try:
+                await asyncio.to_thread(self.build)
+            except Exception as e:
+                logger.error(f"Autocomplete index build failed: {str(e)}")
+            deadline = time.monotonic() + AUTOCOMPLETE_REBUILD_SECONDS
+            while not self._stale.is_set() and time.monotonic() < deadline:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=1.0)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                if self._dirty:
+                    try:
+                        await asyncio.to_thread(self.refresh)
+                    except Exception as e:
+                        logger.error(f"Autocomplete index refresh failed: {str(e)}")
+
+    def refresh(self):
+        """Reload the titles of invalidated services, dropping those that no longer exist."""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+        try:
+            # The primary, since a replica may not have replayed the write yet
+            with SessionLocal() as session:
+                titles = dict(session.execute(
+                    select(Service.id, Service.title).where(Service.id == any_id('service_ids')),
+                    {'service_ids': id_array(dirty)}
+                ).all())
+        except Exception:
+            with self._lock:
+                self._dirty.update(dirty)
+            raise
+        for service_id in dirty:
+            if service_id in titles:
+                if self._titles.get(service_id) != titles[service_id]:
+                    self.upsert({'id': service_id, 'title': titles[service_id]})
+            else:
+                self.remove(service_id)
+
+    def _invalidated(self, service_ids: Optional[list]):
+        # Runs on the invalidation listener's event loop: only record the work
+        with self._lock:
+            if service_ids is not None:
+                self._dirty.update(int(service_id) for service_id in service_ids)
+            elif self.ready:  # Before the first build there is nothing to rebuild
+                self._stale.set()
+
+    def _rank(self, service_id: int) -> tuple:
+        # Ties go to the newer service
+        return self._scores.get(service_id, (0, 0.0)), service_id
+
+    def _texts(self, title: Optional[str]) -> List[str]:
+        """The indexed text from each of the title's first words, each cut to the key length"""
+        words = WORD_PATTERN.findall(title.lower()) if title else []
+        return list({
+            " ".join(words[start:])[:AUTOCOMPLETE_KEY_LENGTH]
+            for start in range(min(len(words), AUTOCOMPLETE_MAX_WORDS))
+        })
+
+    def _prefixes(self, texts: List[str], length: int = AUTOCOMPLETE_KEY_LENGTH) -> set:
+        return {text[:end] for text in texts for end in range(1, min(length, len(text)) + 1)}
+
+    def _remove(self, service_id: int):
+        # Caller holds the lock
+        title = self._titles.pop(service_id, None)
+        if title is None:
+            return
+        texts = self._texts(title)
+        for text in texts:
+            key = f"{text}{SEPARATOR}{service_id}"
+            position = bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+                del self._ids[position]
+        for prefix in self._prefixes(texts):
+            ranked = self._top.get(prefix)
+            if ranked is not None and service_id in ranked:
+                ranked.remove(service_id)
+                if len(ranked) < AUTOCOMPLETE_MAX_LIMIT:
+                    del self._top[prefix]  # May be missing matches beyond the kept ones; rescan when asked
+
+if __name__ == "__main__":
+    import unittest
+
+    class TestAutocompleteIndex(unittest.TestCase):
+        def setUp(self):
+            self.index = AutocompleteIndex(scan_limit=0)  # Keep every ranking, to exercise their upkeep
+            self.index.ready = True
+            services = {1: "Lawn design", 2: "Logo Design & Branding", 3: "Lawn mowing", 4: "Dog walking"}
+            for service_id, title in services.items():
+                self.index.upsert({'id': service_id, 'title': title})
+            self.index._scores.update({2: (10, 4.5), 3: (3, 5.0)})
+
+        def test_prefixes(self):
+            self.assertEqual([s['id'] for s in self.index.suggest("la")], [3, 1])
+            self.assertEqual([s['id'] for s in self.index.suggest("DES")], [2, 1])
+            self.assertEqual([s['id'] for s in self.index.suggest("design  Br")], [2])
+            self.assertEqual(self.index.suggest("lawn m"), [{'id': 3, 'title': "Lawn mowing"}])
+            self.assertEqual(self.index.suggest("cat"), [])
+            self.assertEqual(self.index.suggest("  "), [])
+            self.assertEqual(len(self.index.suggest("l", limit=1)), 1)
+
+        def test_updates(self):
+            self.assertEqual([s['id'] for s in self.index.suggest("d")], [2, 4, 1])
+            self.index.upsert({'id': 4, 'title': "Cat sitting"})
+            self.index.remove(2)
+            self.assertEqual([s['id'] for s in self.index.suggest("d")], [1])
+            self.assertEqual([s['id'] for s in self.index.suggest("sit")], [4])
+            self.index.upsert({'id': 5, 'title': "Drum lessons"})
+            self.assertEqual([s['id'] for s in self.index.suggest("d")], [5, 1])
+            self.assertEqual(self.index.stats()['keys'], 8)
+
+        def test_long_titles_bounded(self):
+            title = " ".join(f"word{i}" for i in range(50))
+            self.index.upsert({'id': 9, 'title': title})
+            keys = [key for key, service_id in zip(self.index._keys, self.index._ids) if service_id == 9]
+            self.assertEqual(len(keys), AUTOCOMPLETE_MAX_WORDS)
+            self.assertTrue(all(len(key) <= AUTOCOMPLETE_KEY_LENGTH + 2 for key in keys))
+            self.assertEqual([s['id'] for s in self.index.suggest("word3 word4")], [9])
+
+        def test_invalidation(self):
+            self.index._invalidated([2, "4"])
+            self.assertEqual(self.index._dirty, {2, 4})
+            self.assertFalse(self.index._stale.is_set())
+            self.index._invalidated(None)
+            self.assertTrue(self.index._stale.is_set())
+
+    unittest.main(verbosity=2)
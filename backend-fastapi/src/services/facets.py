@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from src.lazy import lazy_import
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import os
+
+np = lazy_import("numpy")
+
+SEARCH_FACETS = ["price", "hashtags", "rating"]
+FACET_PRICE_EDGES = [int(edge) for edge in os.getenv("FACET_PRICE_EDGES", "1000,2500,5000,10000,25000").split(",")]
+FACET_RATING_EDGES = [float(edge) for edge in os.getenv("FACET_RATING_EDGES", "1,2,3,4,5").split(",")]
+FACET_TOP_HASHTAGS = int(os.getenv("FACET_TOP_HASHTAGS", "10"))
+
+def parse_facets(facets: Iterable[str]) -> Tuple[str, ...]:
+    """Requested facet names in SEARCH_FACETS order"""
+    requested = {facet.strip() for facet in facets if facet.strip()}
+    unknown = sorted(requested.difference(SEARCH_FACETS))
+    if unknown:
+        raise ValueError(f"Unknown facet(s): {', '.join(unknown)}. Allowed: {', '.join(SEARCH_FACETS)}")
+    return tuple(facet for facet in SEARCH_FACETS if facet in requested)
+
+class FacetCounter:
+    """
+    Facet counts for a search's full candidate set, before sorting and limit.
+
+    Counts come from one pass over the candidates and the provider tags and
+    rating stats the search loads for filtering and sorting (fetched once
+    more only when the sort did not need them): prices are bucketed with searchsorted and bincount, average ratings are
+    banded the same way, and hashtags are counted per provider and weighted by
+    how many candidates that provider has. Price buckets are open at both ends
+    (FACET_PRICE_EDGES are the boundaries between them); rating bands span
+    FACET_RATING_EDGES, the last one including its top, plus an "unrated"
+    bucket. Empty buckets are kept so the UI can show zeros.
+    """
+
+    def __init__(self, price_edges: Optional[Sequence[int]] = None, rating_edges: Optional[Sequence[float]] = None,
+                 top_hashtags: int = FACET_TOP_HASHTAGS):
+        self.price_edges = sorted(price_edges or FACET_PRICE_EDGES)
+        self.rating_edges = sorted(rating_edges or FACET_RATING_EDGES)
+        self.top_hashtags = top_hashtags
+
+    def count(self, services: List[dict], facets: Sequence[str],
+              account_tags: Optional[Dict[int, Set[str]]] = None,
+              rating_stats: Optional[Dict[int, Tuple[int, float]]] = None) -> dict:
+        counts = {}
+        if "price" in facets:
+            counts["price"] = self.price_counts(services)
+        if "hashtags" in facets:
+            counts["hashtags"] = self.hashtag_counts(services, account_tags or {})
+        if "rating" in facets:
+            counts["rating"] = self.rating_counts(services, rating_stats or {})
+        return counts
+
+    def price_counts(self, services: List[dict]) -> List[dict]:
+        prices = np.fromiter((service['price'] for service in services), dtype=np.float64, count=len(services))
+        counts = np.bincount(np.searchsorted(self.price_edges, prices, side="right"),
+                             minlength=len(self.price_edges) + 1)
+        bounds = [None, *self.price_edges, None]
+        return [
+            {'min': low, 'max': high, 'count': int(count)}
+            for low, high, count in zip(bounds, bounds[1:], counts)
+        ]
+
+    def rating_counts(self, services: List[dict], rating_stats: Dict[int, Tuple[int, float]]) -> List[dict]:
+        unrated = (0, np.nan)
+        averages = np.fromiter(
+            (rating_stats.get(service['id'], unrated)[1] for service in services),
+            dtype=np.float64, count=len(services)
+        )
+        rated = averages[~np.isnan(averages)]
+        inner = self.rating_edges[1:-1]
+        counts = np.bincount(np.searchsorted(inner, rated, side="right"), minlength=len(inner) + 1)
+        edges = self.rating_edges
+        bands = [
+            {'min': low, 'max': high, 'count': int(count)}
+            for low, high, count in zip(edges, edges[1:], counts)
+        ]
+        bands.append({'min': None, 'max': None, 'count': len(services) - len(rated)})  # Unrated
+        return bands
+
+    def hashtag_counts(self, services: List[dict], account_tags: Dict[int, Set[str]]) -> List[dict]:
+        per_account = Counter(service['account_id'] for service in services)
+        counts: Counter = Counter()
+        for account_id, services_count in per_account.items():
+            for tag in account_tags.get(account_id, ()):
+                counts[tag] += services_count
+        top = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:self.top_hashtags]
+        return [{'tag': tag, 'count': count} for tag, count in top]
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class TestFacetCounter(unittest.TestCase):
+        def setUp(self):
+            self.services = [
+                {'id': 1, 'account_id': 10, 'price': 500},
+                {'id': 2, 'account_id': 10, 'price': 1000},
+                {'id': 3, 'account_id': 20, 'price': 4000},
+                {'id': 4, 'account_id': 30, 'price': 90000},
+            ]
+            self.counter = FacetCounter(price_edges=[1000, 5000], rating_edges=[1, 3, 5], top_hashtags=2)
+
+        def test_buckets(self):
+            counts = self.counter.count(self.services, ["price", "rating"],
+                                        rating_stats={1: (2, 5.0), 2: (1, 2.5), 3: (4, 3.0)})
+            self.assertEqual([b['count'] for b in counts['price']], [1, 2, 1])
+            self.assertEqual((counts['price'][0]['max'], counts['price'][-1]['min']), (1000, 5000))
+            self.assertEqual(counts['rating'], [
+                {'min': 1, 'max': 3, 'count': 1},
+                {'min': 3, 'max': 5, 'count': 2},
+                {'min': None, 'max': None, 'count': 1},
+            ])
+            self.assertNotIn('hashtags', counts)
+
+        def test_hashtags(self):
+            tags = {10: {"garden", "lawn"}, 20: {"lawn"}, 30: {"art"}}
+            counts = self.counter.count(self.services, ["hashtags"], account_tags=tags)
+            self.assertEqual(counts['hashtags'], [{'tag': "lawn", 'count': 3}, {'tag': "garden", 'count': 2}])
+            self.assertEqual(self.counter.count([], SEARCH_FACETS)['hashtags'], [])
+
+        def test_parse(self):
+            self.assertEqual(parse_facets(["rating", " price"]), ("price", "rating"))
+            with self.assertRaises(ValueError):
+                parse_facets(["colour"])
+
+    unittest.main(verbosity=2)
@@ -1,16 +1,67 @@
-import sys
-from pathlib import Path
 from sqlalchemy import text
+from src.db import get_db_session, get_read_session, any_id, id_array
+from src.models import Hashtag, Account, HashtagUsageBucket, account_hashtags
+from src.events import publish
+from src.cache import local_cache, result_cache, notify_invalidation
+from src.fields import select_fields
+from src.batching import WriteCoalescer, WRITE_BATCHING
+from src.services.account import ACCOUNT_DEFAULT_FIELDS
+from sqlalchemy import select, update, func, bindparam
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple, Union
 
-project_root = Path(__file__).resolve().parents[2]
-sys.path.append(str(project_root))
+# Columns a client may request with ?fields=, and those returned by default
+HASHTAG_FIELDS = ['id', 'tag', 'usage_count', 'created_at']
+HASHTAG_DEFAULT_FIELDS = ['id', 'tag', 'created_at']
 
-from src.db import get_db_session
-from src.models import Hashtag, Account
-from sqlalchemy.exc import IntegrityError
-from typing import List
+account_hashtag_cache = local_cache("account_hashtags")
+search_cache = result_cache("search")
+
+# Built once; see ACCOUNT_BY_USERNAME in account.py
+HASHTAG_BY_TAG = select_fields(Hashtag, HASHTAG_DEFAULT_FIELDS).where(Hashtag.tag == bindparam('tag'))
+ACCOUNT_TAGS = (
+    select(account_hashtags.c.account_id, Hashtag.tag)
+    .join(Hashtag, Hashtag.id == account_hashtags.c.hashtag_id)
+    .where(account_hashtags.c.account_id == any_id('account_ids'))
+)
+
+def normalize_tag(tag: str) -> str:
+    """Normalize hashtag format (lowercase, remove #)"""
+    return tag.lower().strip().lstrip('#')
+
+def record_usage(session, hashtag_ids: List[int], delta: int):
+    """Adjust usage counters and the current hourly bucket in the caller's transaction."""
+    if not hashtag_ids:
+        return
+    # An id listed n times (a batch linking it to n accounts) counts n times
+    counts = Counter(hashtag_ids)
+    by_count: Dict[int, List[int]] = defaultdict(list)
+    for hashtag_id, count in counts.items():
+        by_count[count].append(hashtag_id)
+    for count, ids in sorted(by_count.items()):
+        session.execute(
+            update(Hashtag)
+            .where(Hashtag.id.in_(sorted(ids)))
+            .values(usage_count=Hashtag.usage_count + delta * count)
+        )
+    bucket_start = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    stmt = insert(HashtagUsageBucket).values([
+        {'hashtag_id': hashtag_id, 'bucket_start': bucket_start, 'count': delta * counts[hashtag_id]}
+        for hashtag_id in sorted(counts)
+    ])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[HashtagUsageBucket.hashtag_id, HashtagUsageBucket.bucket_start],
+        set_={'count': HashtagUsageBucket.count + stmt.excluded.count}
+    ))
 
 class HashtagService:
+    def __init__(self, batching: bool = WRITE_BATCHING):
+        # With batching, concurrent add_hashtags_to_account() calls share one transaction
+        self.coalescer = WriteCoalescer("hashtags", self._add_hashtags_batch) if batching else None
+
     def create_hashtag(self, tag: str):
         """Create a new hashtag if it doesn't exist"""
         # Normalize the tag (lowercase, remove #)
@@ -28,6 +79,7 @@ class HashtagService:
             hashtag = Hashtag(tag=tag)
             session.add(hashtag)
             try:
+                notify_invalidation(session, "search", ["hashtags"])
                 session.commit()
                 return {
                     'id': hashtag.id,
@@ -41,19 +93,13 @@ class HashtagService:
     def get_hashtag(self, tag: str):
         """Get a hashtag by its tag string"""
         tag = self._normalize_tag(tag)
-        with get_db_session() as session:
-            hashtag = session.query(Hashtag).filter(Hashtag.tag == tag).first()
-            if hashtag:
-                return {
-                    'id': hashtag.id,
-                    'tag': hashtag.tag,
-                    'created_at': hashtag.created_at
-                }
-            return None
+        with get_read_session() as session:
+            row = session.execute(HASHTAG_BY_TAG, {'tag': tag}).first()
+            return row._asdict() if row else None
 
     def get_hashtag_by_id(self, hashtag_id: int):
         """Get a hashtag by its ID"""
-        with get_db_session() as session:
+        with get_read_session() as session:
             hashtag = session.get(Hashtag, hashtag_id)
             if hashtag:
                 return {
@@ -65,12 +111,18 @@ class HashtagService:
 
     def add_hashtags_to_account(self, account_id: int, tags: List[str]):
         """Add multiple hashtags to an account"""
+        if self.coalescer:
+            return self.coalescer.submit((account_id, list(tags)))
+        return self._add_hashtags(account_id, tags)
+
+    def _add_hashtags(self, account_id: int, tags: List[str]):
         with get_db_session() as session:
             account = session.get(Account, account_id)
             if not account:
                 raise ValueError("Account not found")
 
-            added_tags = []
+            added = []
+            created = False
             for tag in tags:
                 tag = self._normalize_tag(tag)
                 # Get or create hashtag
@@ -78,18 +130,100 @@ class HashtagService:
                 if not hashtag:
                     hashtag = Hashtag(tag=tag)
                     session.add(hashtag)
+                    created = True
                 
                 if hashtag not in account.hashtags:
                     account.hashtags.append(hashtag)
-                    added_tags.append(tag)
+                    added.append(hashtag)
 
             try:
+                session.flush()
+                self._record_usage(session, [hashtag.id for hashtag in added], 1)
+                if added:
+                    notify_invalidation(session, "account_hashtags", [account_id])
+                    notify_invalidation(session, "profiles", [account_id])
+                    notify_invalidation(session, "search", ["account_hashtags"])
+                    if created:  # New tags can match hashtag searches
+                        notify_invalidation(session, "search", ["hashtags"])
                 session.commit()
-                return added_tags
             except IntegrityError:
                 session.rollback()
                 raise ValueError("Error adding hashtags to account")
 
+            added_tags = [(hashtag.id, hashtag.tag) for hashtag in added]
+        if added_tags:
+            publish("hashtags.added", account_id=account_id, hashtags=added_tags)
+        return [tag for _, tag in added_tags]
+
+    def _add_hashtags_batch(self, items: List[Tuple[int, List[str]]]) -> List[Union[List[str], Exception]]:
+        """
+        Write handler for the coalescer. items are (account_id, tags) pairs from
+        add_hashtags_to_account(). All their tags are upserted with one
+        statement and all the links inserted with another, in one transaction.
+        If that fails, each item is retried on its own.
+        """
+        results: List[Union[List[str], Exception]] = [None] * len(items)
+        wanted: Dict[int, List[str]] = {}  # Item index -> its normalized tags, first occurrence first
+        try:
+            with get_db_session() as session:
+                existing = set(session.execute(
+                    select(Account.id).where(Account.id.in_({account_id for account_id, _ in items}))
+                ).scalars())
+                for index, (account_id, tags) in enumerate(items):
+                    if account_id not in existing:
+                        results[index] = ValueError("Account not found")
+                    else:
+                        wanted[index] = list(dict.fromkeys(self._normalize_tag(tag) for tag in tags))
+
+                all_tags = sorted({tag for tags in wanted.values() for tag in tags})
+                added: Dict[int, List[Tuple[int, str]]] = defaultdict(list)  # Account -> (hashtag id, tag)
+                if all_tags:
+                    created = session.execute(
+                        insert(Hashtag).values([{'tag': tag} for tag in all_tags])
+                        .on_conflict_do_nothing(index_elements=[Hashtag.tag])
+                        .returning(Hashtag.id)
+                    ).all()
+                    ids = dict(session.execute(select(Hashtag.tag, Hashtag.id).where(Hashtag.tag.in_(all_tags))).all())
+                    links = sorted({
+                        (items[index][0], ids[tag]) for index, tags in wanted.items() for tag in tags
+                    })
+                    tags_by_id = {hashtag_id: tag for tag, hashtag_id in ids.items()}
+                    linked = session.execute(
+                        insert(account_hashtags)
+                        .values([{'account_id': account_id, 'hashtag_id': hashtag_id} for account_id, hashtag_id in links])
+                        .on_conflict_do_nothing()
+                        .returning(account_hashtags.c.account_id, account_hashtags.c.hashtag_id)
+                    ).all()
+                    for account_id, hashtag_id in linked:
+                        added[account_id].append((hashtag_id, tags_by_id[hashtag_id]))
+                    self._record_usage(session, [hashtag_id for _, hashtag_id in linked], 1)
+                    if linked:
+                        notify_invalidation(session, "account_hashtags", sorted(added))
+                        notify_invalidation(session, "profiles", sorted(added))
+                        notify_invalidation(session, "search", ["account_hashtags"])
+                        if created:
+                            notify_invalidation(session, "search", ["hashtags"])
+                session.commit()
+        except SQLAlchemyError:
+            for index in range(len(items)):
+                if results[index] is None:
+                    try:
+                        results[index] = self._add_hashtags(*items[index])
+                    except Exception as e:
+                        results[index] = e
+            return results
+
+        for account_id, hashtags in added.items():
+            publish("hashtags.added", account_id=account_id, hashtags=hashtags)
+        # An account may appear in several items; each reports the tags it asked for that were new
+        reported: Set[Tuple[int, str]] = set()
+        for index, tags in wanted.items():
+            account_id = items[index][0]
+            new_tags = {tag for _, tag in added.get(account_id, ())}
+            results[index] = [tag for tag in tags if tag in new_tags and (account_id, tag) not in reported]
+            reported.update((account_id, tag) for tag in results[index])
+        return results
+
     def remove_hashtag_from_account(self, account_id: int, tag: str):
         """Remove a hashtag from an account"""
         tag = self._normalize_tag(tag)
@@ -102,57 +236,97 @@ class HashtagService:
             if not hashtag:
                 return False
 
-            if hashtag in account.hashtags:
-                account.hashtags.remove(hashtag)
-                session.commit()
-                return True
-            return False
+            if hashtag not in account.hashtags:
+                return False
+
+            account.hashtags.remove(hashtag)
+            self._record_usage(session, [hashtag.id], -1)
+            notify_invalidation(session, "account_hashtags", [account_id])
+            notify_invalidation(session, "profiles", [account_id])
+            notify_invalidation(session, "search", ["account_hashtags"])
+            session.commit()
+            removed = [(hashtag.id, hashtag.tag)]
+        publish("hashtags.removed", account_id=account_id, hashtags=removed)
+        return True
 
-    def get_account_hashtags(self, account_id: int):
-        """Get all hashtags for an account"""
+    def rebuild_usage_counts(self):
+        """Recompute every usage_count from account_hashtags, e.g. after a backfill."""
         with get_db_session() as session:
-            account = session.get(Account, account_id)
-            if not account:
+            counts = (
+                session.query(func.count())
+                .select_from(account_hashtags)
+                .filter(account_hashtags.c.hashtag_id == Hashtag.id)
+                .scalar_subquery()
+            )
+            updated = session.execute(update(Hashtag).values(usage_count=counts)).rowcount
+            session.commit()
+            return updated
+
+    def get_account_hashtags(self, account_id: int, fields: Optional[List[str]] = None):
+        """Get all hashtags for an account. With fields, only those columns are read, bypassing the cache."""
+        if fields is not None:
+            return self._load_account_hashtags(account_id, fields)
+        return account_hashtag_cache.get_or_load(account_id, lambda: self._load_account_hashtags(account_id))
+
+    def _load_account_hashtags(self, account_id: int, fields: Optional[List[str]] = None):
+        with get_read_session() as session:
+            if session.execute(select(Account.id).where(Account.id == account_id)).first() is None:
                 raise ValueError("Account not found")
-            
-            return [{
-                'id': tag.id,
-                'tag': tag.tag,
-                'created_at': tag.created_at
-            } for tag in account.hashtags]
 
-    def get_accounts_by_hashtag(self, tag: str):
+            rows = session.execute(
+                select_fields(Hashtag, fields or HASHTAG_DEFAULT_FIELDS)
+                .join(account_hashtags, account_hashtags.c.hashtag_id == Hashtag.id)
+                .where(account_hashtags.c.account_id == account_id)
+            )
+            return [row._asdict() for row in rows]
+
+    def get_hashtags_for_accounts(self, account_ids: List[int]) -> Dict[int, Set[str]]:
+        """Get the tags of many accounts in one query"""
+        if not account_ids:
+            return {}
+        with get_read_session() as session:
+            rows = session.execute(ACCOUNT_TAGS, {'account_ids': id_array(set(account_ids))})
+            tags: Dict[int, Set[str]] = {}
+            for account_id, tag in rows:
+                tags.setdefault(account_id, set()).add(tag)
+            return tags
+
+    def get_accounts_by_hashtag(self, tag: str, fields: Optional[List[str]] = None):
         """Get all accounts that have a specific hashtag"""
         tag = self._normalize_tag(tag)
-        with get_db_session() as session:
-            hashtag = session.query(Hashtag).filter(Hashtag.tag == tag).first()
-            if not hashtag:
-                return []
-            
-            return [{
-                'id': account.id,
-                'username': account.username,
-                'email': account.email
-            } for account in hashtag.accounts]
-
-    def search_hashtags(self, query: str):
-        """Search hashtags by partial match"""
+        with get_read_session() as session:
+            rows = session.execute(
+                select_fields(Account, fields or ACCOUNT_DEFAULT_FIELDS)
+                .join(account_hashtags, account_hashtags.c.account_id == Account.id)
+                .join(Hashtag, Hashtag.id == account_hashtags.c.hashtag_id)
+                .where(Hashtag.tag == tag)
+            )
+            return [row._asdict() for row in rows]
+
+    def search_hashtags(self, query: str, fields: Optional[List[str]] = None):
+        """
+        Search hashtags by partial match. Results are cached until a hashtag is
+        created, except usage_count, which changes with every add and is read fresh.
+        """
         query = self._normalize_tag(query)
-        with get_db_session() as session:
-            hashtags = session.query(Hashtag).filter(
-                Hashtag.tag.ilike(f'%{query}%')
-            ).all()
-            
-            return [{
-                'id': tag.id,
-                'tag': tag.tag,
-                'created_at': tag.created_at
-            } for tag in hashtags]
+        fields = tuple(fields or HASHTAG_DEFAULT_FIELDS)
+        if 'usage_count' in fields:
+            return self._search_hashtags(query, fields)
+        rows = search_cache.get_or_load(
+            ('hashtags', query, fields), ["hashtags"], lambda: self._search_hashtags(query, fields)
+        )
+        return list(rows)
+
+    def _search_hashtags(self, query: str, fields: Tuple[str, ...]) -> List[dict]:
+        with get_read_session() as session:
+            rows = session.execute(select_fields(Hashtag, fields).where(Hashtag.tag.ilike(f'%{query}%')))
+            return [row._asdict() for row in rows]
+
+    def _record_usage(self, session, hashtag_ids: List[int], delta: int):
+        record_usage(session, hashtag_ids, delta)
 
     def _normalize_tag(self, tag: str) -> str:
-        """Normalize hashtag format (lowercase, remove #)"""
-        tag = tag.lower().strip()
-        return tag.lstrip('#')
+        return normalize_tag(tag)
 
 
 if __name__ == "__main__":
@@ -256,6 +430,39 @@ if __name__ == "__main__":
             accounts = self.hashtag_service.get_accounts_by_hashtag("python")
             self.assertEqual(len(accounts), 2)
 
+        def test_batched_add(self):
+            from concurrent.futures import ThreadPoolExecutor
+            other = self.account_service.create_account("batched", "batched@example.com", "testpass123")
+            self.hashtag_service.add_hashtags_to_account(self.test_account['id'], ["python"])
+            batched = HashtagService(batching=True)
+            calls = [(self.test_account['id'], ["#Python", "rust", "rust"]), (other['id'], ["rust", "go"]), (-1, ["x"])]
+
+            def call(args):
+                try:
+                    return batched.add_hashtags_to_account(*args)
+                except ValueError as e:
+                    return str(e)
+
+            with ThreadPoolExecutor(len(calls)) as pool:
+                results = list(pool.map(call, calls))
+            self.assertEqual(results, [["rust"], ["rust", "go"], "Account not found"])
+            rust = self.hashtag_service.search_hashtags("rust", fields=HASHTAG_FIELDS)[0]
+            self.assertEqual(rust['usage_count'], 2)
+            self.assertEqual(len(self.hashtag_service.get_accounts_by_hashtag("rust")), 2)
+
+        def test_upgrade_backfills_usage_count(self):
+            from src.db import engine, upgrade_schema
+            other = self.account_service.create_account("upgraded", "upgraded@example.com", "testpass123")
+            self.hashtag_service.add_hashtags_to_account(self.test_account['id'], ["python", "rust"])
+            self.hashtag_service.add_hashtags_to_account(other['id'], ["python"])
+            # A database from before the column existed
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE hashtags DROP COLUMN usage_count"))
+            upgrade_schema()
+            with get_db_session() as session:
+                counts = dict(session.execute(select(Hashtag.tag, Hashtag.usage_count)).all())
+            self.assertEqual(counts, {"python": 2, "rust": 1})
+
         def test_search_hashtags(self):
             # Create some hashtags
             self.hashtag_service.create_hashtag("python")
@@ -0,0 +1,375 @@
+from __future__ import annotations
+
+from src.db import SessionLocal, get_read_session, id_array
+from src.models import Hashtag, account_hashtags
+from src.events import subscribe
+from src.cache import on_invalidation
+from src.lazy import lazy_import
+from src.services.hashtag import ACCOUNT_TAGS
+from sqlalchemy import select
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+import asyncio
+import logging
+import os
+import threading
+import time
+
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
+
+HASHTAG_INDEX_REBUILD_SECONDS = float(os.getenv("HASHTAG_INDEX_REBUILD_SECONDS", "600"))
+HASHTAG_INDEX_LOAD_CHUNK = 10000
+# Tags carried by at least this share of the account id range are kept as bitmaps, which are then no larger
+HASHTAG_INDEX_BITMAP_SHARE = 1 / 64
+HASHTAG_MATCHES = ["any", "all"]
+
+def tags_match(account_tags: Set[str], tags: Sequence[str], match: str = "any", exclude: Sequence[str] = ()) -> bool:
+    """Whether an account carrying account_tags passes a hashtag filter; what HashtagIndex.matches() computes"""
+    if not account_tags.isdisjoint(exclude):
+        return False
+    if not tags:
+        return True
+    if match == "all":
+        return account_tags.issuperset(tags)
+    return not account_tags.isdisjoint(tags)
+
+def _contains(members: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Mask of the values present in members, a posting array or bitmap"""
+    if members.dtype == np.uint8:
+        if len(values) and values.max() >= len(members) * 8:  # Ids past the bitmap are not members
+            found = np.zeros(len(values), dtype=bool)
+            inside = values < len(members) * 8
+            found[inside] = _contains(members, values[inside])
+            return found
+        return ((members[values >> 3] >> (values & 7).astype(np.uint8)) & 1).astype(bool)
+    positions = np.searchsorted(members, values)
+    np.minimum(positions, len(members) - 1, out=positions)
+    return members[positions] == values
+
+def _bitmap(ids: np.ndarray, universe: int) -> np.ndarray:
+    """Bit id & 7 of byte id >> 3 set for each id"""
+    dense = np.zeros(max(universe, 1), dtype=bool)
+    dense[ids] = True
+    return np.packbits(dense, bitorder="little")
+
+class HashtagIndex:
+    """
+    Per-worker inverted index from hashtag to the accounts carrying it, for
+    filtering search candidates by their provider's tags.
+
+    Each tag maps to a sorted NumPy array of account ids or, once it is
+    carried by HASHTAG_INDEX_BITMAP_SHARE of the account id range, a packed
+    bitmap over that range, which is then the smaller of the two. A query
+    tests the candidates' account ids against each tag with one vectorized
+    gather (bitmaps) or searchsorted into a short array (rare tags); all
+    (AND), any (OR) and exclude (NOT) combine the resulting masks, so the
+    cost does not grow with how popular the tags are.
+    Arrays are replaced on change and bitmaps only have bits flipped, so
+    queries read a snapshot outside the lock.
+
+    This worker's hashtags.added/removed events update the index directly.
+    Other workers' changes arrive as account_hashtags cache invalidations;
+    those accounts are reloaded from the primary before the next query, so
+    filters see every committed write as the cache would. A flush (listener
+    reconnect) and the periodic rebuild rebuild the index.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings: Dict[str, np.ndarray] = {}  # Tag -> sorted int64 account ids, or uint8 bitmap
+        self._sizes: Dict[str, int] = {}  # Tag -> accounts carrying it
+        self._universe = 0  # One past the highest account id seen
+        self._tags: Dict[int, Set[str]] = {}  # Account id -> its tags
+        self._dirty: Set[int] = set()  # Accounts to reload before the next query
+        self._stale = threading.Event()  # Set when the whole index must be rebuilt
+        self._replay: Optional[list] = None  # Changes made while a build runs, applied to its result
+        self.ready = False
+
+        subscribe("hashtags.added", lambda account_id, hashtags: self.add(account_id, [tag for _, tag in hashtags]))
+        subscribe("hashtags.removed", lambda account_id, hashtags: self.remove(account_id, [tag for _, tag in hashtags]))
+        on_invalidation("account_hashtags", self._invalidated)
+
+    def build(self):
+        """Build the index from account_hashtags with a streaming query."""
+        members: Dict[str, List[int]] = {}
+        tags: Dict[int, Set[str]] = {}
+        universe = 0
+        with self._lock:
+            self._replay = []
+            self._stale.clear()
+        try:
+            with get_read_session() as session:
+                rows = session.execute(
+                    select(account_hashtags.c.account_id, Hashtag.tag)
+                    .join(Hashtag, Hashtag.id == account_hashtags.c.hashtag_id)
+                    .execution_options(yield_per=HASHTAG_INDEX_LOAD_CHUNK)
+                )
+                for account_id, tag in rows:
+                    members.setdefault(tag, []).append(account_id)
+                    tags.setdefault(account_id, set()).add(tag)
+                    universe = max(universe, account_id + 1)
+            postings = {}
+            sizes = {}
+            for tag, ids in members.items():
+                ids = np.unique(np.array(ids, dtype=np.int64))
+                sizes[tag] = len(ids)
+                postings[tag] = _bitmap(ids, universe) if self._dense(len(ids), universe) else ids
+        except BaseException:
+            with self._lock:
+                self._replay = None
+            raise
+
+        with self._lock:
+            replay, self._replay = self._replay, None
+            self._postings = postings
+            self._sizes = sizes
+            self._tags = tags
+            self._universe = universe
+            self.ready = True
+            for change in replay:
+                change()
+        logger.info(f"Hashtag index built: {len(postings)} tags, {len(tags)} accounts")
+
+    def add(self, account_id: int, tags: Iterable[str]):
+        tags = list(tags)
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(lambda: self.add(account_id, tags))
+            if self.ready:
+                self._add(account_id, tags)
+
+    def remove(self, account_id: int, tags: Iterable[str]):
+        tags = list(tags)
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(lambda: self.remove(account_id, tags))
+            if self.ready:
+                self._remove(account_id, tags)
+
+    def matches(self, account_ids: Sequence[int], tags: Sequence[str], match: str = "any",
+                exclude: Sequence[str] = ()) -> np.ndarray:
+        """Boolean mask over account_ids of the accounts passing the filter, as tags_match() defines it"""
+        self._refresh()
+        with self._lock:
+            # Rarest first, so an all-match empties early
+            wanted = [(self._sizes.get(tag, 0), self._postings.get(tag)) for tag in tags]
+            wanted.sort(key=lambda item: item[0])
+            unwanted = [self._postings[tag] for tag in exclude if tag in self._postings]
+        ids = np.asarray(account_ids, dtype=np.int64)
+        if match == "all":
+            mask = np.ones(len(ids), dtype=bool)
+            for size, members in wanted:
+                if not size:  # A tag nobody carries
+                    return np.zeros(len(ids), dtype=bool)
+                mask &= _contains(members, ids)
+        elif tags:
+            mask = np.zeros(len(ids), dtype=bool)
+            for size, members in wanted:
+                if size:
+                    mask |= _contains(members, ids)
+        else:
+            mask = np.ones(len(ids), dtype=bool)
+        for members in unwanted:
+            mask &= ~_contains(members, ids)
+        return mask
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'tags': len(self._postings),
+                'bitmaps': sum(1 for members in self._postings.values() if members.dtype == np.uint8),
+                'accounts': len(self._tags),
+                'postings': sum(self._sizes.values()),
+                'dirty': len(self._dirty)
+            }
+
+    async def run_maintenance(self, stop: asyncio.Event):
+        """Build the index, then rebuild it every HASHTAG_INDEX_REBUILD_SECONDS or when flushed, until stop is set."""
+        while not stop.is_set():
+            try:
+                await asyncio.to_thread(self.build)
+            except Exception as e:
+                logger.error(f"Hashtag index build failed: {str(e)}")
+            deadline = time.monotonic() + HASHTAG_INDEX_REBUILD_SECONDS
+            while not self._stale.is_set() and time.monotonic() < deadline:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=1.0)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+
+    def _invalidated(self, account_ids: Optional[list]):
+        # Runs on the invalidation listener's event loop: only record the work
+        with self._lock:
+            if account_ids is not None:
+                self._dirty.update(int(account_id) for account_id in account_ids)
+            elif self.ready:  # Before the first build there is nothing to rebuild
+                self._stale.set()
+
+    def _refresh(self):
+        """Reload the tags of accounts changed since the last query"""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+        try:
+            # The primary, since a replica may not have replayed the write yet
+            with SessionLocal() as session:
+                rows = session.execute(ACCOUNT_TAGS, {'account_ids': id_array(dirty)}).all()
+        except Exception:
+            with self._lock:
+                self._dirty.update(dirty)
+            raise
+        current: Dict[int, Set[str]] = {account_id: set() for account_id in dirty}
+        for account_id, tag in rows:
+            current[account_id].add(tag)
+        for account_id, tags in current.items():
+            with self._lock:
+                old = self._tags.get(account_id, set())
+                self.remove(account_id, old - tags)
+                self.add(account_id, tags - old)
+
+    def _dense(self, size: int, universe: int) -> bool:
+        return size >= universe * HASHTAG_INDEX_BITMAP_SHARE
+
+    def _add(self, account_id: int, tags: List[str]):
+        # Caller holds the lock
+        current = self._tags.get(account_id, set())
+        self._universe = max(self._universe, account_id + 1)
+        for tag in tags:
+            if tag in current:
+                continue
+            current.add(tag)
+            self._tags[account_id] = current
+            self._sizes[tag] = self._sizes.get(tag, 0) + 1
+            members = self._postings.get(tag)
+            if members is None:
+                self._postings[tag] = np.array([account_id], dtype=np.int64)
+            elif members.dtype == np.uint8:
+                if account_id >= len(members) * 8:
+                    # Grown (a new array), so queries holding the old one are unaffected
+                    grow = max(len(members), (account_id >> 3) + 1 - len(members))
+                    members = np.concatenate([members, np.zeros(grow, dtype=np.uint8)])
+                    self._postings[tag] = members
+                members[account_id >> 3] |= np.uint8(1 << (account_id & 7))
+            else:
+                members = np.insert(members, np.searchsorted(members, account_id), account_id)
+                if self._dense(len(members), self._universe):
+                    members = _bitmap(members, self._universe)
+                self._postings[tag] = members
+
+    def _remove(self, account_id: int, tags: List[str]):
+        # Caller holds the lock; bitmaps only go back to arrays at the next build
+        current = self._tags.get(account_id, set())
+        for tag in tags:
+            if tag not in current:
+                continue
+            current.discard(tag)
+            self._sizes[tag] -= 1
+            members = self._postings[tag]
+            if not self._sizes[tag]:
+                del self._postings[tag]
+                del self._sizes[tag]
+            elif members.dtype == np.uint8:
+                members[account_id >> 3] &= np.uint8(~(1 << (account_id & 7)) & 0xFF)
+            else:
+                self._postings[tag] = np.delete(members, np.searchsorted(members, account_id))
+        if not current:
+            self._tags.pop(account_id, None)
+
+
+if __name__ == "__main__":
+    import random
+    import unittest
+    from src.db import init_db, drop_db, get_db_session
+    from src.cache import notify_invalidation
+    from src.services.account import AccountService
+    from src.services.hashtag import HashtagService
+
+    class TestHashtagIndex(unittest.TestCase):
+        def setUp(self):
+            self.index = HashtagIndex()
+            self.index.ready = True
+            self.index.add(1, ["garden", "lawn"])
+            self.index.add(2, ["lawn"])
+            self.index.add(3, ["art", "garden"])
+
+        def test_match_modes(self):
+            accounts = [1, 2, 3, 4, 2]
+            self.assertEqual(self.index.matches(accounts, ["garden", "lawn"]).tolist(),
+                             [True, True, True, False, True])
+            self.assertEqual(self.index.matches(accounts, ["garden", "lawn"], match="all").tolist(),
+                             [True, False, False, False, False])
+            self.assertEqual(self.index.matches(accounts, ["garden"], exclude=["art"]).tolist(),
+                             [True, False, False, False, False])
+            self.assertEqual(self.index.matches(accounts, [], exclude=["lawn"]).tolist(),
+                             [False, False, True, True, False])
+            self.assertFalse(self.index.matches(accounts, ["lawn", "nobody"], match="all").any())
+
+        def test_updates(self):
+            self.index.remove(1, ["lawn", "never"])
+            self.index.add(4, ["lawn"])
+            self.assertEqual(self.index.matches([1, 2, 3, 4], ["lawn"]).tolist(), [False, True, False, True])
+            self.index.remove(3, ["art", "garden"])
+            self.assertEqual(self.index.stats()['tags'], 2)
+            self.assertNotIn(3, self.index._tags)
+
+            # Small tags over a wide id range stay arrays; a bitmap grows for a new high id
+            self.index.add(50000, ["rare", "lawn"])
+            self.assertEqual(self.index._postings["rare"].dtype, np.int64)
+            self.assertEqual(self.index._postings["lawn"].dtype, np.uint8)
+            self.assertEqual(self.index.matches([50000, 2, 99999], ["lawn", "rare"], match="all").tolist(),
+                             [True, False, False])
+
+        def test_same_as_tags_match(self):
+            rng = random.Random(7)
+            vocabulary = [f"tag{i}" for i in range(8)]
+            # Consecutive ids make every tag a bitmap, scattered ones keep them arrays
+            for ids in (range(200), rng.sample(range(100000), 200)):
+                index = HashtagIndex()
+                index.ready = True
+                tags = {account_id: set(rng.sample(vocabulary, rng.randrange(4))) for account_id in ids}
+                for account_id, account_tags in tags.items():
+                    index.add(account_id, account_tags)
+                for account_id in rng.sample(list(ids), 20):
+                    index.remove(account_id, list(tags[account_id])[:1])
+                    tags[account_id] = set(list(tags[account_id])[1:])
+                accounts = list(ids) + [rng.randrange(200000) for _ in range(50)]
+                for _ in range(50):
+                    wanted = rng.sample(vocabulary, rng.randrange(3))
+                    unwanted = rng.sample(vocabulary, rng.randrange(2))
+                    for match in HASHTAG_MATCHES:
+                        expected = [tags_match(tags.get(a, set()), wanted, match, unwanted) for a in accounts]
+                        self.assertEqual(index.matches(accounts, wanted, match, unwanted).tolist(), expected)
+
+    class TestIndexMaintenance(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            init_db()
+
+        @classmethod
+        def tearDownClass(cls):
+            drop_db()
+
+        def test_build_and_other_workers(self):
+            account = AccountService().create_account("tagged", "tagged@example.com", "pw")
+            hashtags = HashtagService()
+            hashtags.add_hashtags_to_account(account['id'], ["garden"])
+            index = HashtagIndex()
+            index.build()
+            self.assertTrue(index.matches([account['id']], ["garden"])[0])
+
+            # A write this worker made: applied from the event
+            hashtags.add_hashtags_to_account(account['id'], ["lawn"])
+            self.assertTrue(index.matches([account['id']], ["garden", "lawn"], match="all")[0])
+
+            # A write another worker made: only the invalidation arrives
+            with get_db_session() as session:
+                session.execute(account_hashtags.delete().where(account_hashtags.c.account_id == account['id']))
+                notify_invalidation(session, "account_hashtags", [account['id']])
+            self.assertFalse(index.matches([account['id']], ["garden", "lawn"])[0])
+            self.assertNotIn(account['id'], index._tags)
+
+    unittest.main(verbosity=2)
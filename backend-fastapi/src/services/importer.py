@@ -0,0 +1,317 @@
+from src.db import get_db_session
+from src.models import Hashtag, account_hashtags
+from src.services.hashtag import HashtagService
+from src.events import publish
+from src.cache import notify_invalidation, on_invalidation
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+import csv
+import io
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))  # Rows validated and copied per round trip
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))  # Row errors listed in the report
+IMPORT_FORMATS = ("csv", "ndjson")
+IMPORT_CONFLICT_MODES = ("update", "skip")
+PG_INT_MAX = 2 ** 31 - 1
+HASHTAG_SPLIT = re.compile(r"[\s,;]+")
+
+class ServiceImportService:
+    """
+    Bulk creation of services and hashtags for one provider account.
+
+    Rows are validated in Python in chunks of IMPORT_CHUNK_SIZE; valid rows go
+    through COPY into a temporary staging table, and invalid ones are collected
+    into a per-row error report. The staged rows are then merged into services
+    with a few set-based statements. A service whose title already exists on the
+    account is updated or skipped depending on on_conflict. When a title repeats
+    within the upload, the last occurrence wins. Hashtags from all rows are
+    attached to the account.
+
+    Everything runs in one transaction holding a row lock on the account, so
+    an import either lands completely or not at all, and concurrent imports for
+    the same account cannot create duplicate titles.
+    """
+
+    def __init__(self):
+        self.hashtag_service = HashtagService()
+
+    def import_upload(self, account_id: int, upload: BinaryIO, fmt: str = "csv",
+                      on_conflict: str = "update"):
+        """Import a CSV or NDJSON byte stream. CSV needs a header row with title and price."""
+        if fmt not in IMPORT_FORMATS:
+            raise ValueError(f"Unsupported import format: {fmt}")
+        stream = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")
+        rows = parse_csv(stream) if fmt == "csv" else parse_ndjson(stream)
+        try:
+            return self.import_services(account_id, rows, on_conflict=on_conflict)
+        except UnicodeDecodeError:
+            raise ValueError("Upload is not valid UTF-8")
+        finally:
+            stream.detach()
+
+    def import_services(self, account_id: int, rows: Iterable[Tuple[int, object]],
+                        on_conflict: str = "update"):
+        """
+        Import numbered rows for account_id.
+        rows: (row number, dict of fields) pairs, or (row number, error message) for unparseable rows
+        """
+        if on_conflict not in IMPORT_CONFLICT_MODES:
+            raise ValueError(f"on_conflict must be one of: {', '.join(IMPORT_CONFLICT_MODES)}")
+
+        report = {'received': 0, 'created': 0, 'updated': 0, 'skipped': 0, 'failed': 0,
+                  'errors': [], 'hashtags_added': []}
+        tags = set()
+        with get_db_session() as session:
+            locked = session.execute(
+                text("SELECT id FROM accounts WHERE id = :account_id FOR UPDATE"),
+                {'account_id': account_id}
+            ).scalar()
+            if locked is None:
+                raise ValueError("Account not found")
+
+            session.execute(text(
+                "CREATE TEMPORARY TABLE service_import ("
+                " row_no integer PRIMARY KEY, title text NOT NULL, description text,"
+                " price integer NOT NULL) ON COMMIT DROP"
+            ))
+            cursor = session.connection().connection.cursor()
+            chunk: List[tuple] = []
+            for row_no, row in rows:
+                report['received'] += 1
+                values, error = validate_row(row)
+                if error:
+                    self._fail(report, row_no, error)
+                    continue
+                tags.update(values.pop())
+                chunk.append((row_no, *values))
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    self._copy(cursor, chunk)
+                    chunk = []
+            if chunk:
+                self._copy(cursor, chunk)
+            cursor.close()
+
+            self._merge(session, account_id, on_conflict, report)
+            added = self._attach_hashtags(session, account_id, tags)
+            session.commit()
+
+        if added:
+            publish("hashtags.added", account_id=account_id, hashtags=added)
+        report['hashtags_added'] = sorted(tag for _, tag in added)
+        report['errors'].sort(key=lambda error: error['row'])
+        report['errors_truncated'] = report['failed'] > len(report['errors'])
+        logger.info(
+            f"Imported services for account {account_id}: {report['created']} created, "
+            f"{report['updated']} updated, {report['skipped']} skipped, {report['failed']} failed"
+        )
+        return report
+
+    def _copy(self, cursor, chunk: List[tuple]):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(chunk)
+        buffer.seek(0)
+        cursor.copy_expert(
+            "COPY service_import (row_no, title, description, price) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+
+    def _merge(self, session, account_id: int, on_conflict: str, report: dict):
+        params = {'account_id': account_id, 'now': datetime.utcnow()}
+        superseded = session.execute(text(
+            "DELETE FROM service_import i USING service_import later"
+            " WHERE later.title = i.title AND later.row_no > i.row_no"
+            " RETURNING i.row_no, (SELECT max(row_no) FROM service_import m WHERE m.title = i.title)"
+        )).all()
+        for row_no, winner in superseded:
+            self._fail(report, row_no, f"Duplicate title, superseded by row {winner}")
+
+        if on_conflict == "update":
+            updated_ids = session.execute(text(
+                "UPDATE services s SET description = i.description, price = i.price, updated_at = :now"
+                " FROM service_import i WHERE s.account_id = :account_id AND s.title = i.title"
+                " RETURNING s.id"
+            ), params).scalars().all()
+            report['updated'] = len(updated_ids)
+        else:
+            updated_ids = []
+            report['skipped'] = session.execute(text(
+                "SELECT count(*) FROM service_import i WHERE EXISTS ("
+                " SELECT 1 FROM services s WHERE s.account_id = :account_id AND s.title = i.title)"
+            ), params).scalar()
+
+        created_ids = session.execute(text(
+            "INSERT INTO services (account_id, title, description, price, created_at, updated_at)"
+            " SELECT :account_id, i.title, i.description, i.price, :now, :now FROM service_import i"
+            " WHERE NOT EXISTS ("
+            " SELECT 1 FROM services s WHERE s.account_id = :account_id AND s.title = i.title)"
+            " ORDER BY i.row_no"
+            " RETURNING id"
+        ), params).scalars().all()
+        report['created'] = len(created_ids)
+        if created_ids or updated_ids:
+            # Also how the autocomplete and similar-services indexes of every worker learn of the rows
+            notify_invalidation(session, "services", updated_ids + created_ids)
+            notify_invalidation(session, "profiles", [account_id])
+            notify_invalidation(session, "search", ["services"])
+
+    def _attach_hashtags(self, session, account_id: int, tags: set) -> List[Tuple[int, str]]:
+        """Create missing hashtags and link them to the account, returning the new links."""
+        if not tags:
+            return []
+        tags = sorted(tags)
+        created = session.execute(insert(Hashtag).values([
+            {'tag': tag, 'created_at': datetime.utcnow()} for tag in tags
+        ]).on_conflict_do_nothing(index_elements=[Hashtag.tag]).returning(Hashtag.id)).all()
+        ids = dict(session.execute(select(Hashtag.tag, Hashtag.id).where(Hashtag.tag.in_(tags))).all())
+        linked = session.execute(
+            insert(account_hashtags).values([
+                {'account_id': account_id, 'hashtag_id': ids[tag]} for tag in tags
+            ]).on_conflict_do_nothing().returning(account_hashtags.c.hashtag_id)
+        ).scalars().all()
+        self.hashtag_service._record_usage(session, linked, 1)
+        if linked:
+            notify_invalidation(session, "account_hashtags", [account_id])
+            notify_invalidation(session, "profiles", [account_id])
+            notify_invalidation(session, "search", ["account_hashtags"])
+        if created:
+            notify_invalidation(session, "search", ["hashtags"])
+        by_id = {hashtag_id: tag for tag, hashtag_id in ids.items()}
+        return [(hashtag_id, by_id[hashtag_id]) for hashtag_id in sorted(linked)]
+
+    def _fail(self, report: dict, row_no: int, error: str):
+        report['failed'] += 1
+        if len(report['errors']) < IMPORT_MAX_ERRORS:
+            report['errors'].append({'row': row_no, 'error': error})
+
+def parse_csv(stream: io.TextIOBase) -> Iterator[Tuple[int, object]]:
+    """Yield (row number, dict) for each CSV data row, numbered from 1 after the header."""
+    reader = csv.DictReader(stream)
+    try:
+        missing = {'title', 'price'} - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"CSV header is missing required columns: {', '.join(sorted(missing))}")
+        for row_no, row in enumerate(reader, start=1):
+            if None in row:
+                yield row_no, "Row has more fields than the header"
+            else:
+                yield row_no, row
+    except csv.Error as e:
+        raise ValueError(f"Malformed CSV after row {reader.line_num}: {str(e)}")
+
+def parse_ndjson(stream: io.TextIOBase) -> Iterator[Tuple[int, object]]:
+    """Yield (line number, dict) for each non-blank NDJSON line."""
+    for row_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield row_no, "Invalid JSON"
+            continue
+        yield row_no, row if isinstance(row, dict) else "Row must be a JSON object"
+
+def validate_row(row: object) -> Tuple[Optional[list], Optional[str]]:
+    """Check one parsed row. Returns ([title, description, price, tags], None) or (None, error)."""
+    if isinstance(row, str):
+        return None, row
+    title = row.get('title')
+    if not isinstance(title, str) or not title.strip():
+        return None, "title is required"
+    description = row.get('description')
+    if description is not None and not isinstance(description, str):
+        return None, "description must be a string"
+    if '\x00' in title or (description and '\x00' in description):
+        return None, "Text fields cannot contain NUL characters"
+
+    price = row.get('price')
+    if isinstance(price, str) and price.strip().lstrip('-').isdigit():
+        price = int(price)
+    if isinstance(price, bool) or not isinstance(price, int):
+        return None, "price must be an integer number of cents"
+    if not 0 <= price <= PG_INT_MAX:
+        return None, "price is out of range"
+
+    raw_tags = row.get('hashtags') or []
+    if isinstance(raw_tags, str):
+        raw_tags = HASHTAG_SPLIT.split(raw_tags)
+    if not isinstance(raw_tags, list) or not all(isinstance(tag, str) for tag in raw_tags):
+        return None, "hashtags must be a list of strings"
+    tags = {tag.lower().strip().lstrip('#') for tag in raw_tags} - {''}
+    if any('\x00' in tag for tag in tags):
+        return None, "Text fields cannot contain NUL characters"
+    return [title.strip(), description, price, tags], None
+
+
+if __name__ == "__main__":
+    import unittest
+    from src.db import init_db, drop_db
+    from src.services.account import AccountService
+    from src.services.service import ServiceService
+
+    class TestParsing(unittest.TestCase):
+        def test_validate_row(self):
+            values, error = validate_row({'title': " Lessons ", 'price': "1500", 'hashtags': "#Music, piano"})
+            self.assertIsNone(error)
+            self.assertEqual(values, ["Lessons", None, 1500, {"music", "piano"}])
+            self.assertEqual(validate_row({'title': "", 'price': 1})[1], "title is required")
+            self.assertIsNotNone(validate_row({'title': "A", 'price': 1.5})[1])
+            self.assertIsNotNone(validate_row({'title': "A", 'price': True})[1])
+            self.assertIsNotNone(validate_row({'title': "A", 'price': -1})[1])
+
+        def test_parse_ndjson(self):
+            rows = list(parse_ndjson(io.StringIO('{"title": "A"}\n\nnot json\n[1]\n')))
+            self.assertEqual(rows, [(1, {'title': "A"}), (3, "Invalid JSON"), (4, "Row must be a JSON object")])
+
+        def test_parse_csv_header(self):
+            with self.assertRaises(ValueError):
+                list(parse_csv(io.StringIO("title,description\nA,B\n")))
+
+    class TestServiceImport(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            init_db()
+            cls.importer = ServiceImportService()
+            cls.account = AccountService().create_account(
+                username="importer", email="importer@example.com", password="testpass123"
+            )
+
+        @classmethod
+        def tearDownClass(cls):
+            drop_db()
+
+        def test_import_merge_and_report(self):
+            ServiceService().create_service(self.account['id'], "Existing", "old", 100)
+            upload = (
+                "title,description,price,hashtags\n"
+                "Existing,new,200,design\n"
+                "Fresh,first,300,#Design garden\n"
+                "Broken,,abc,\n"
+                "Fresh,second,400,\n"
+            ).encode()
+            invalidated = []
+            on_invalidation("services", invalidated.append)
+            report = self.importer.import_upload(self.account['id'], io.BytesIO(upload))
+            self.assertEqual((report['created'], report['updated'], report['failed']), (1, 1, 2))
+            self.assertEqual([error['row'] for error in report['errors']], [2, 3])
+            self.assertEqual(report['hashtags_added'], ["design", "garden"])
+
+            services = {s['title']: s for s in ServiceService().get_services_by_account(self.account['id'])}
+            self.assertEqual(services['Existing']['price'], 200)
+            self.assertEqual(services['Fresh']['description'], "second")
+            self.assertEqual(sorted(invalidated[0]), sorted(s['id'] for s in services.values()))
+
+            report = self.importer.import_upload(
+                self.account['id'], io.BytesIO(b'{"title": "Existing", "price": 1}\n'),
+                fmt="ndjson", on_conflict="skip"
+            )
+            self.assertEqual((report['created'], report['skipped']), (0, 1))
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,342 @@
+from src.db import get_db_session
+from src.models import Job
+from sqlalchemy import select, update, or_, and_
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+import asyncio
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_HEARTBEATS_PER_LEASE = 3  # Lease renewals while a job runs, per lease period
+JOB_BACKOFF_BASE = float(os.getenv("JOB_BACKOFF_BASE", "2.0"))
+JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", "600"))
+
+class JobService:
+    """
+    Persistent job queue backed by the jobs table.
+
+    Any number of workers, in one process or many, can share the queue: jobs are
+    claimed with SELECT ... FOR UPDATE SKIP LOCKED, so each job runs once at a time
+    without an external broker. Jobs whose worker died are reclaimed after the lease,
+    which a live worker renews while its handler runs. Outcomes are recorded only by
+    the worker still holding the lease, so a reclaimed job's first run cannot
+    overwrite the second's.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, Callable[[dict], Any]] = {}
+
+    def register(self, kind: str, handler: Callable[[dict], Any]):
+        """Register the function that runs jobs of this kind. It receives the payload."""
+        self._handlers[kind] = handler
+
+    def enqueue(self, kind: str, payload: dict = None, delay: float = 0, max_attempts: int = 5):
+        with get_db_session() as session:
+            job = Job(
+                kind=kind,
+                payload=payload or {},
+                max_attempts=max_attempts,
+                run_at=datetime.utcnow() + timedelta(seconds=delay)
+            )
+            session.add(job)
+            session.commit()
+            return self._to_dict(job)
+
+    def enqueue_merged(self, kind: str, payload: Dict[str, list], delay: float = 0, max_attempts: int = 5):
+        """
+        Enqueue, or merge into a job of this kind that is still queued and untried:
+        each list in payload is united with the queued job's, so changes to ids
+        already pending add no work. The queued job keeps its run_at. A job being
+        run holds its row lock and is skipped, so its changes get a new job.
+        """
+        with get_db_session() as session:
+            job = session.execute(
+                select(Job)
+                .where(Job.kind == kind, Job.status == 'queued', Job.attempts == 0)
+                .order_by(Job.run_at)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            ).scalar_one_or_none()
+            if job is None:
+                job = Job(
+                    kind=kind,
+                    payload={key: sorted(set(values)) for key, values in payload.items()},
+                    max_attempts=max_attempts,
+                    run_at=datetime.utcnow() + timedelta(seconds=delay)
+                )
+                session.add(job)
+            else:
+                job.payload = {
+                    key: sorted(set(job.payload.get(key, ())) | set(payload.get(key, ())))
+                    for key in set(job.payload) | set(payload)
+                }
+            session.commit()
+            return self._to_dict(job)
+
+    def get_job(self, job_id: int):
+        with get_db_session() as session:
+            job = session.get(Job, job_id)
+            if job:
+                return self._to_dict(job)
+            return None
+
+    def claim_next(self, worker_id: str) -> Optional[dict]:
+        """Lock the next due job for this worker, or return None if there is none."""
+        now = datetime.utcnow()
+        with get_db_session() as session:
+            job = session.execute(
+                select(Job)
+                .where(or_(
+                    and_(Job.status == 'queued', Job.run_at <= now),
+                    and_(Job.status == 'running', Job.locked_at < now - timedelta(seconds=JOB_LEASE_SECONDS))
+                ))
+                .order_by(Job.run_at)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            ).scalar_one_or_none()
+            if not job:
+                return None
+
+            job.status = 'running'
+            job.attempts += 1
+            job.locked_by = worker_id
+            job.locked_at = now
+            session.commit()
+            return {
+                'id': job.id,
+                'kind': job.kind,
+                'payload': job.payload,
+                'attempts': job.attempts,
+                'max_attempts': job.max_attempts,
+                'locked_by': worker_id
+            }
+
+    def renew_lease(self, job: dict) -> bool:
+        """Extend the lease on a claimed job. False if another worker has reclaimed it."""
+        with get_db_session() as session:
+            renewed = session.execute(
+                update(Job)
+                .where(Job.id == job['id'], Job.status == 'running', Job.locked_by == job['locked_by'])
+                .values(locked_at=datetime.utcnow())
+            ).rowcount
+            session.commit()
+            return renewed > 0
+
+    def run_next(self, worker_id: str) -> bool:
+        """Claim and execute one job. Returns False when the queue had nothing due."""
+        job = self.claim_next(worker_id)
+        if not job:
+            return False
+
+        handler = self._handlers.get(job['kind'])
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, finished), daemon=True)
+        heartbeat.start()
+        try:
+            if not handler:
+                raise ValueError(f"No handler registered for job kind '{job['kind']}'")
+            result = handler(job['payload'])
+        except Exception as e:
+            logger.error(f"Job {job['id']} ({job['kind']}) failed: {str(e)}")
+            finished.set()
+            heartbeat.join()
+            self._record_failure(job, traceback.format_exc())
+        else:
+            finished.set()
+            heartbeat.join()
+            self._record_success(job, result)
+        return True
+
+    async def run_worker(self, worker_id: str, stop: asyncio.Event):
+        """Poll the queue until stop is set. Handlers run in a thread, off the event loop."""
+        logger.info(f"Job worker {worker_id} started")
+        while not stop.is_set():
+            try:
+                if await asyncio.to_thread(self.run_next, worker_id):
+                    continue
+            except Exception as e:
+                logger.error(f"Job worker {worker_id} error: {str(e)}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        logger.info(f"Job worker {worker_id} stopped")
+
+    def worker_id(self, index: int) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+    def _heartbeat(self, job: dict, finished: threading.Event):
+        """Renew the job's lease until finished is set, so a long run is not reclaimed."""
+        while not finished.wait(JOB_LEASE_SECONDS / JOB_HEARTBEATS_PER_LEASE):
+            try:
+                if not self.renew_lease(job):
+                    logger.warning(f"Job {job['id']} ({job['kind']}) lost its lease; its outcome will not be recorded")
+                    return
+            except Exception as e:
+                logger.error(f"Job {job['id']} lease renewal failed: {str(e)}")
+
+    def _locked_row(self, session, job: dict) -> Optional[Job]:
+        """The job's row, locked, if this worker still holds its lease"""
+        row = session.execute(
+            select(Job)
+            .where(Job.id == job['id'], Job.status == 'running', Job.locked_by == job['locked_by'])
+            .with_for_update()
+        ).scalar_one_or_none()
+        if row is None:
+            logger.warning(f"Job {job['id']} ({job['kind']}) was reclaimed by another worker; dropping this run's outcome")
+        return row
+
+    def _record_success(self, job: dict, result: Any):
+        with get_db_session() as session:
+            row = self._locked_row(session, job)
+            if row is None:
+                return
+            row.status = 'completed'
+            row.result = result
+            row.last_error = None
+            row.locked_by = None
+            row.locked_at = None
+            session.commit()
+
+    def _record_failure(self, job: dict, error: str):
+        with get_db_session() as session:
+            row = self._locked_row(session, job)
+            if row is None:
+                return
+            row.last_error = error
+            row.locked_by = None
+            row.locked_at = None
+            if job['attempts'] >= job['max_attempts']:
+                row.status = 'failed'
+            else:
+                # Exponential backoff with jitter so retries from a burst spread out
+                delay = min(JOB_BACKOFF_BASE ** job['attempts'], JOB_BACKOFF_MAX)
+                row.status = 'queued'
+                row.run_at = datetime.utcnow() + timedelta(seconds=delay * random.uniform(0.5, 1.0))
+            session.commit()
+
+    def _to_dict(self, job: Job) -> dict:
+        return {
+            'id': job.id,
+            'kind': job.kind,
+            'payload': job.payload,
+            'status': job.status,
+            'attempts': job.attempts,
+            'max_attempts': job.max_attempts,
+            'run_at': job.run_at,
+            'last_error': job.last_error,
+            'result': job.result,
+            'created_at': job.created_at,
+            'updated_at': job.updated_at
+        }
+
+
+if __name__ == "__main__":
+    import unittest
+    import time
+    from src.db import init_db, drop_db
+
+    class TestJobService(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            print("Initializing test database...")
+            init_db()
+
+        @classmethod
+        def tearDownClass(cls):
+            print("Cleaning up test database...")
+            drop_db()
+
+        def setUp(self):
+            with get_db_session() as session:
+                session.query(Job).delete()
+                session.commit()
+            self.job_service = JobService()
+
+        def test_run_job(self):
+            self.job_service.register("double", lambda payload: payload['value'] * 2)
+            job = self.job_service.enqueue("double", {"value": 21})
+            self.assertTrue(self.job_service.run_next("test"))
+            finished = self.job_service.get_job(job['id'])
+            self.assertEqual(finished['status'], 'completed')
+            self.assertEqual(finished['result'], 42)
+
+        def test_retry_then_fail(self):
+            def broken(payload):
+                raise RuntimeError("boom")
+            self.job_service.register("broken", broken)
+            job = self.job_service.enqueue("broken", max_attempts=2)
+
+            self.assertTrue(self.job_service.run_next("test"))
+            retried = self.job_service.get_job(job['id'])
+            self.assertEqual(retried['status'], 'queued')
+            self.assertEqual(retried['attempts'], 1)
+
+            # Not due again until the backoff expires
+            self.assertFalse(self.job_service.run_next("test"))
+            with get_db_session() as session:
+                session.get(Job, job['id']).run_at = datetime.utcnow()
+                session.commit()
+
+            self.assertTrue(self.job_service.run_next("test"))
+            self.assertEqual(self.job_service.get_job(job['id'])['status'], 'failed')
+
+        def test_enqueue_merged(self):
+            first = self.job_service.enqueue_merged("refresh", {"ids": [3, 1]}, delay=60)
+            again = self.job_service.enqueue_merged("refresh", {"ids": [1, 2], "other": [7]}, delay=60)
+            self.assertEqual(again['id'], first['id'])
+            self.assertEqual(again['payload'], {"ids": [1, 2, 3], "other": [7]})
+            self.assertEqual(again['run_at'], first['run_at'])
+
+            # Once claimed, changes go to a new job
+            with get_db_session() as session:
+                session.get(Job, first['id']).status = 'running'
+                session.commit()
+            self.assertNotEqual(self.job_service.enqueue_merged("refresh", {"ids": [1]})['id'], first['id'])
+
+        def test_lease_renewed_while_running(self):
+            global JOB_LEASE_SECONDS
+            lease, JOB_LEASE_SECONDS = JOB_LEASE_SECONDS, 1
+            try:
+                def slow(payload):
+                    time.sleep(2.5)
+                    return self.job_service.claim_next("other")  # Lease expired long ago without renewal
+                self.job_service.register("slow", slow)
+                job = self.job_service.enqueue("slow")
+                self.assertTrue(self.job_service.run_next("test"))
+                finished = self.job_service.get_job(job['id'])
+                self.assertEqual((finished['status'], finished['attempts'], finished['result']), ('completed', 1, None))
+            finally:
+                JOB_LEASE_SECONDS = lease
+
+        def test_reclaimed_run_not_recorded(self):
+            job = self.job_service.enqueue("noop")
+            first = self.job_service.claim_next("first")
+            with get_db_session() as session:
+                session.get(Job, job['id']).locked_at = datetime.utcnow() - timedelta(seconds=JOB_LEASE_SECONDS + 1)
+                session.commit()
+            second = self.job_service.claim_next("second")
+            self.assertEqual(second['attempts'], 2)
+
+            self.job_service._record_success(first, "stale")
+            self.assertFalse(self.job_service.renew_lease(first))
+            self.assertEqual(self.job_service.get_job(job['id'])['status'], 'running')
+            self.job_service._record_success(second, "fresh")
+            self.assertEqual(self.job_service.get_job(job['id'])['result'], "fresh")
+
+        def test_skip_locked(self):
+            self.job_service.enqueue("noop")
+            with get_db_session() as session:
+                # Hold the row lock as another worker would
+                session.execute(select(Job).with_for_update()).all()
+                self.assertIsNone(self.job_service.claim_next("other"))
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,211 @@
+from src.db import get_db_session, get_read_session
+from src.models import Media, Account, Service
+from src.media import MediaStore, MEDIA_GC_GRACE, store as default_store
+from sqlalchemy import select, func, or_, cast, String
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from typing import Iterable, List, Optional
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+class MediaService:
+    def __init__(self, store: MediaStore = default_store):
+        self.store = store
+
+    def create_media(self, account_id: int, digest: str, size: int, info: dict, service_id: Optional[int] = None):
+        """Record an uploaded image. info is what render_variants() returned for it."""
+        with get_db_session() as session:
+            if not session.get(Account, account_id):
+                raise ValueError("Account not found")
+            if service_id is not None:
+                service = session.get(Service, service_id)
+                if not service:
+                    raise ValueError("Service not found")
+                if service.account_id != account_id:
+                    raise ValueError("Not authorized to add media to this service")
+
+            media = Media(
+                account_id=account_id,
+                service_id=service_id,
+                sha256=digest,
+                content_type=info['content_type'],
+                size=size,
+                width=info['width'],
+                height=info['height'],
+                variants=info['variants'],
+                digests=[digest] + [variant['sha256'] for variant in info['variants'].values()]
+            )
+            session.add(media)
+            session.commit()
+            return self._to_dict(media)
+
+    def get_media(self, media_id: int):
+        with get_read_session() as session:
+            media = session.get(Media, media_id)
+            return self._to_dict(media) if media else None
+
+    def get_media_by_account(self, account_id: int):
+        with get_read_session() as session:
+            media = session.query(Media).filter(Media.account_id == account_id).order_by(Media.id).all()
+            return [self._to_dict(item) for item in media]
+
+    def get_media_by_service(self, service_id: int):
+        with get_read_session() as session:
+            media = session.query(Media).filter(Media.service_id == service_id).order_by(Media.id).all()
+            return [self._to_dict(item) for item in media]
+
+    def delete_media(self, media_id: int, account_id: Optional[int] = None) -> Optional[List[str]]:
+        """
+        Delete a media row (only by its owner when account_id is given). Returns
+        the digests it referenced, for collect_garbage(), or None if not found.
+        """
+        with get_db_session() as session:
+            media = session.get(Media, media_id)
+            if not media:
+                return None
+            if account_id is not None and media.account_id != account_id:
+                raise ValueError("Not authorized to delete this media")
+            digests = list(media.digests)
+            session.delete(media)
+            session.commit()
+            return digests
+
+    def media_digests(self, account_id: Optional[int] = None, service_id: Optional[int] = None) -> List[str]:
+        """Digests referenced by an account's or a service's media, collected before deleting it"""
+        conditions = []
+        if account_id is not None:
+            conditions.append(Media.account_id == account_id)
+        if service_id is not None:
+            conditions.append(Media.service_id == service_id)
+        if not conditions:
+            return []
+        with get_db_session() as session:
+            media = session.execute(select(Media).where(or_(*conditions))).scalars().all()
+            return sorted({digest for item in media for digest in item.digests})
+
+    def collect_garbage(self, digests: Optional[Iterable[str]] = None, grace: float = MEDIA_GC_GRACE) -> dict:
+        """
+        Remove stored files that no media row references. Only the given digests
+        are checked, or every stored file when digests is None. Files modified
+        within the grace period are kept, since an upload may not be recorded yet.
+        """
+        cutoff = time.time() - grace
+        if digests is None:
+            candidates = {digest for digest, mtime in self.store.iter_files() if mtime < cutoff}
+        else:
+            candidates = set()
+            for digest in digests:
+                try:
+                    mtime = os.stat(self.store.path(digest)).st_mtime
+                except (FileNotFoundError, ValueError):
+                    continue
+                if mtime < cutoff:
+                    candidates.add(digest)
+
+        removed = 0
+        if candidates:
+            with get_db_session() as session:
+                referenced = self._referenced(session, candidates)
+            for digest in candidates - referenced:
+                if self.store.remove(digest, older_than=cutoff):
+                    removed += 1
+        logger.info(f"Media garbage collection removed {removed} of {len(candidates)} candidate files")
+        return {'checked': len(candidates), 'removed': removed}
+
+    def _referenced(self, session, digests: set) -> set:
+        """The subset of digests used by some media row, as an original or a variant"""
+        overlapping = Media.digests.op("&&")(cast(array(sorted(digests)), ARRAY(String(64))))
+        used = session.execute(select(func.unnest(Media.digests)).where(overlapping)).scalars()
+        return digests.intersection(used)
+
+    def _to_dict(self, media: Media) -> dict:
+        return {
+            'id': media.id,
+            'account_id': media.account_id,
+            'service_id': media.service_id,
+            'sha256': media.sha256,
+            'url': media_url(media.sha256),
+            'content_type': media.content_type,
+            'size': media.size,
+            'width': media.width,
+            'height': media.height,
+            'variants': {
+                name: {**variant, 'url': media_url(variant['sha256'])}
+                for name, variant in (media.variants or {}).items()
+            },
+            'created_at': media.created_at
+        }
+
+def media_url(digest: str) -> str:
+    return f"/api/media/files/{digest}"
+
+
+if __name__ == "__main__":
+    import unittest
+    import io
+    import shutil
+    import tempfile
+    from PIL import Image
+    from src.db import init_db, drop_db
+    from src.media import render_variants
+
+    class TestMediaService(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            init_db()
+            from src.services.account import AccountService
+            from src.services.service import ServiceService
+            cls.owner = AccountService().create_account("mediaowner", "mediaowner@example.com", "pw")
+            cls.other = AccountService().create_account("mediaother", "mediaother@example.com", "pw")
+            cls.service = ServiceService().create_service(cls.owner['id'], "Photography", "Portraits", 5000)
+
+        @classmethod
+        def tearDownClass(cls):
+            drop_db()
+
+        def setUp(self):
+            self.root = tempfile.mkdtemp()
+            self.media_service = MediaService(MediaStore(self.root))
+
+        def tearDown(self):
+            shutil.rmtree(self.root)
+
+        def upload(self, size=(800, 600), service_id=None):
+            buffer = io.BytesIO()
+            Image.new("RGB", size, (10, 120, 200)).save(buffer, "JPEG")
+            digest = self.media_service.store.put_bytes(buffer.getvalue())
+            info = render_variants(self.root, digest)
+            return self.media_service.create_media(
+                self.owner['id'], digest, len(buffer.getvalue()), info, service_id=service_id
+            )
+
+        def test_create_and_list(self):
+            media = self.upload(service_id=self.service['id'])
+            self.assertEqual(media['url'], f"/api/media/files/{media['sha256']}")
+            self.assertEqual(media['variants']['thumb']['width'], 256)
+            self.assertEqual(self.media_service.get_media(media['id'])['sha256'], media['sha256'])
+            self.assertIn(media['id'], [item['id'] for item in self.media_service.get_media_by_service(self.service['id'])])
+            with self.assertRaises(ValueError):
+                self.media_service.create_media(self.other['id'], media['sha256'], 1, {
+                    'content_type': "image/jpeg", 'width': 1, 'height': 1, 'variants': {}
+                }, service_id=self.service['id'])
+
+        def test_delete_and_collect_garbage(self):
+            media = self.upload(size=(300, 200))
+            shared = self.upload(size=(300, 200))  # Same bytes, so the same files
+            with self.assertRaises(ValueError):
+                self.media_service.delete_media(media['id'], self.other['id'])
+            digests = self.media_service.delete_media(media['id'], self.owner['id'])
+            self.assertEqual(set(digests), {media['sha256'], media['variants']['thumb']['sha256']})
+
+            # Still used by the second row
+            self.assertEqual(self.media_service.collect_garbage(digests, grace=0)['removed'], 0)
+            self.media_service.delete_media(shared['id'])
+            # Within the grace period nothing is removed
+            self.assertEqual(self.media_service.collect_garbage(digests)['removed'], 0)
+            self.assertEqual(self.media_service.collect_garbage(grace=-1)['removed'], 2)
+            self.assertFalse(self.media_service.store.exists(media['sha256']))
+
+    unittest.main(verbosity=2)
@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+from src.lazy import lazy_import
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import math
+import os
+import re
+
+np = lazy_import("numpy")
+
+RANK_WEIGHT_TEXT = float(os.getenv("RANK_WEIGHT_TEXT", "0.45"))
+RANK_WEIGHT_RATING = float(os.getenv("RANK_WEIGHT_RATING", "0.3"))
+RANK_WEIGHT_RECENCY = float(os.getenv("RANK_WEIGHT_RECENCY", "0.1"))
+RANK_WEIGHT_HASHTAGS = float(os.getenv("RANK_WEIGHT_HASHTAGS", "0.15"))
+RANK_RATING_PRIOR = float(os.getenv("RANK_RATING_PRIOR", "3.5"))  # Assumed average for unreviewed services
+RANK_RATING_PRIOR_COUNT = float(os.getenv("RANK_RATING_PRIOR_COUNT", "5"))  # Reviews the prior is worth
+RANK_RECENCY_HALF_LIFE_DAYS = float(os.getenv("RANK_RECENCY_HALF_LIFE_DAYS", "90"))
+RANK_TITLE_BOOST = 2.0
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def term_counts(texts: List[Optional[str]], terms: List[str]) -> np.ndarray:
+    """
+    Occurrences of each term as a whole word (\\w+ token) in each text,
+    case-insensitively, as a len(texts) x len(terms) array: "art" does not
+    count in "start". The texts are joined into one array of code points and
+    each term is located with array comparisons, so the cost does not grow
+    with a Python loop over words.
+    """
+    lowered = [text.lower() if text else "" for text in texts]
+    lengths = np.fromiter(map(len, lowered), dtype=np.int64, count=len(lowered))
+    # A separator before and after every text, so each match has a neighbour on both sides
+    codes = np.frombuffer(
+        ("\n" + "\n".join(lowered) + "\n").encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+    )
+    starts = np.cumsum(lengths + 1) - lengths
+    counts = np.zeros((len(texts), len(terms)))
+    for column, term in enumerate(terms):
+        pattern = np.frombuffer(term.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        found = np.flatnonzero(codes[1:max(len(codes) - len(pattern), 1)] == pattern[0]) + 1
+        for offset in range(1, len(pattern)):
+            found = found[codes[found + offset] == pattern[offset]]
+        found = found[~_word_characters(codes[found - 1]) & ~_word_characters(codes[found + len(pattern)])]
+        counts[:, column] = np.bincount(np.searchsorted(starts, found, side="right") - 1, minlength=len(texts))
+    return counts
+
+_ASCII_WORD = None
+
+def _word_characters(codes: np.ndarray) -> np.ndarray:
+    """Which code points \\w matches"""
+    global _ASCII_WORD
+    if _ASCII_WORD is None:
+        _ASCII_WORD = np.array([bool(TOKEN_PATTERN.match(chr(code))) for code in range(128)])
+    word = _ASCII_WORD[np.minimum(codes, 127)]
+    wide = codes >= 128
+    if wide.any():
+        word[wide] = [bool(TOKEN_PATTERN.match(chr(code))) for code in codes[wide]]
+    return word
+
+class RelevanceRanker:
+    """
+    Scores search candidates for sort=relevance.
+
+    Each signal is computed for the whole candidate set as a NumPy array in [0, 1]:
+    text match (whole-word query terms in title and description, title weighted higher),
+    a Bayesian-smoothed rating that pulls services with few reviews towards
+    RANK_RATING_PRIOR, exponential recency decay on created_at, and the share of
+    requested hashtags carried by the provider. The final score is a weighted sum
+    and with a limit the top k are selected with argpartition, so only k results are sorted.
+    """
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        self.weights = {
+            'text': RANK_WEIGHT_TEXT,
+            'rating': RANK_WEIGHT_RATING,
+            'recency': RANK_WEIGHT_RECENCY,
+            'hashtags': RANK_WEIGHT_HASHTAGS
+        }
+        if weights:
+            unknown = set(weights) - set(self.weights)
+            if unknown:
+                raise ValueError(f"Unknown ranking weights: {', '.join(sorted(unknown))}")
+            self.weights.update(weights)
+
+    def rank(self, services: List[dict], query: Optional[str] = None,
+             hashtags: Iterable[str] = (),
+             rating_stats: Optional[Dict[int, Tuple[int, float]]] = None,
+             account_tags: Optional[Dict[int, Set[str]]] = None,
+             limit: Optional[int] = None, now: Optional[datetime] = None) -> List[dict]:
+        """Return the services (the best `limit` of them, if given), each with a 'relevance' score, best first."""
+        if not services:
+            return []
+
+        scores = self.weights['text'] * self.text_scores(services, query)
+        scores += self.weights['rating'] * self.rating_scores(services, rating_stats or {})
+        scores += self.weights['recency'] * self.recency_scores(services, now or datetime.utcnow())
+        scores += self.weights['hashtags'] * self.hashtag_scores(services, hashtags, account_tags or {})
+
+        if limit and len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [dict(services[i], relevance=round(float(scores[i]), 4)) for i in top]
+
+    def text_scores(self, services: List[dict], query: Optional[str]) -> np.ndarray:
+        terms = list(dict.fromkeys(TOKEN_PATTERN.findall(query.lower()))) if query else []
+        if not terms or not services:
+            return np.zeros(len(services))
+        texts = [service.get('title') for service in services] + [service.get('description') for service in services]
+        counts = term_counts(texts, terms)
+        matches = RANK_TITLE_BOOST * counts[:len(services)] + counts[len(services):]
+        # Dampen repeated terms, then reward covering more of the query
+        per_term = np.log1p(matches)
+        coverage = (matches > 0).mean(axis=1)
+        raw = per_term.sum(axis=1) * coverage
+        peak = raw.max()
+        return raw / peak if peak > 0 else raw
+
+    def rating_scores(self, services: List[dict], rating_stats: Dict[int, Tuple[int, float]]) -> np.ndarray:
+        stats = np.array([rating_stats.get(service['id'], (0, 0.0)) for service in services], dtype=np.float64)
+        counts, averages = stats[:, 0], stats[:, 1]
+        smoothed = (RANK_RATING_PRIOR_COUNT * RANK_RATING_PRIOR + counts * averages) / (RANK_RATING_PRIOR_COUNT + counts)
+        return (smoothed - 1) / 4  # 1-5 stars onto 0-1
+
+    def recency_scores(self, services: List[dict], now: datetime) -> np.ndarray:
+        ages = np.array([
+            (now - service['created_at']).total_seconds() if service.get('created_at') else math.inf
+            for service in services
+        ], dtype=np.float64)
+        decay = math.log(2) / (RANK_RECENCY_HALF_LIFE_DAYS * 86400)
+        return np.exp(-decay * np.maximum(ages, 0))
+
+    def hashtag_scores(self, services: List[dict], hashtags: Iterable[str],
+                       account_tags: Dict[int, Set[str]]) -> np.ndarray:
+        wanted = {tag.lower().strip().lstrip('#') for tag in hashtags}
+        if not wanted:
+            return np.zeros(len(services))
+        overlap = np.fromiter(
+            (len(wanted & account_tags.get(service['account_id'], set())) for service in services),
+            dtype=np.float64, count=len(services)
+        )
+        return overlap / len(wanted)
+
+
+if __name__ == "__main__":
+    import unittest
+    from datetime import timedelta
+
+    class TestRelevanceRanker(unittest.TestCase):
+        def setUp(self):
+            self.now = datetime(2024, 6, 1)
+            self.services = [
+                {'id': 1, 'account_id': 10, 'title': "Garden design", 'description': "Plants", 'created_at': self.now},
+                {'id': 2, 'account_id': 20, 'title': "Plumbing", 'description': "Garden taps", 'created_at': self.now},
+                {'id': 3, 'account_id': 30, 'title': "Tutoring", 'description': "Maths", 'created_at': self.now},
+            ]
+
+        def test_text_match(self):
+            ranked = RelevanceRanker().rank(self.services, query="garden", now=self.now)
+            self.assertEqual([s['id'] for s in ranked], [1, 2, 3])
+
+        def test_smoothed_rating(self):
+            ranker = RelevanceRanker(weights={'text': 0, 'recency': 0, 'hashtags': 0})
+            # One 5-star review should not beat fifty 4.8-star reviews
+            stats = {1: (1, 5.0), 2: (50, 4.8)}
+            ranked = ranker.rank(self.services, rating_stats=stats, now=self.now)
+            self.assertEqual([s['id'] for s in ranked], [2, 1, 3])
+
+        def test_whole_words(self):
+            self.services[1]['description'] = "Start your art journey"
+            self.services[2]['title'] = "Smart starters"
+            scores = RelevanceRanker().text_scores(self.services, "ART")
+            self.assertEqual(scores.tolist(), [0.0, 1.0, 0.0])
+            scores = RelevanceRanker().text_scores(self.services, "garden design garden")
+            self.assertEqual(scores.argmax(), 0)
+            self.assertEqual(RelevanceRanker().text_scores([], "art").tolist(), [])
+
+        def test_term_counts(self):
+            texts = ["Art, ART! art_deco", None, "café cafés caf’s", "", "x"]
+            self.assertEqual(
+                term_counts(texts, ["art", "caf", "cafés", "longer than any text"]).tolist(),
+                [[2, 0, 0, 0], [0, 0, 0, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
+            )
+
+        def test_no_limit_by_default(self):
+            services = [dict(self.services[0], id=i) for i in range(120)]
+            self.assertEqual(len(RelevanceRanker().rank(services, query="garden", now=self.now)), 120)
+
+        def test_top_k_and_recency(self):
+            self.services[2]['created_at'] = self.now - timedelta(days=365)
+            ranker = RelevanceRanker(weights={'text': 0, 'rating': 0, 'hashtags': 0})
+            ranked = ranker.rank(self.services, limit=2, now=self.now)
+            self.assertEqual(len(ranked), 2)
+            self.assertNotIn(3, [s['id'] for s in ranked])
+
+        def test_hashtag_overlap(self):
+            ranker = RelevanceRanker(weights={'text': 0, 'rating': 0, 'recency': 0})
+            tags = {10: {"design"}, 30: {"design", "maths"}}
+            ranked = ranker.rank(self.services, hashtags=["#design", "maths"], account_tags=tags, now=self.now)
+            self.assertEqual(ranked[0]['id'], 3)
+
+        def test_unknown_weight(self):
+            with self.assertRaises(ValueError):
+                RelevanceRanker(weights={'popularity': 1})
+
+    unittest.main(verbosity=2)
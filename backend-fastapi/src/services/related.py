@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+from src.db import get_db_session, get_read_session
+from src.models import Hashtag, HashtagRelated, Account, account_hashtags
+from src.lazy import lazy_import
+from sqlalchemy import select, delete, func, insert
+from typing import Iterable, List, Optional
+import logging
+import os
+
+np = lazy_import("numpy")
+sparse = lazy_import("scipy.sparse")
+
+logger = logging.getLogger(__name__)
+
+RELATED_TOP_N = int(os.getenv("RELATED_TOP_N", "20"))
+RELATED_METRIC = os.getenv("RELATED_METRIC", "jaccard")  # jaccard or pmi
+RELATED_MIN_COUNT = int(os.getenv("RELATED_MIN_COUNT", "2"))
+RELATED_REFRESH_DELAY = float(os.getenv("RELATED_REFRESH_DELAY", "60"))
+RELATED_REBUILD_SECONDS = float(os.getenv("RELATED_REBUILD_SECONDS", "86400"))  # Full rebuild interval
+RELATED_LOAD_CHUNK = 50000
+
+def usage_totals(usage: dict, tags: np.ndarray) -> Optional[dict]:
+    """
+    usage (hashtag id -> usage_count), or None when a count is below the number
+    of loaded pairs with that tag, as before usage_count was backfilled: the
+    totals must then come from the loaded pairs.
+    """
+    tag_ids, loaded = np.unique(tags, return_counts=True)
+    counted = np.array([usage.get(int(t), 0) for t in tag_ids], dtype=np.int64)
+    if (counted < loaded).any():
+        logger.warning("hashtags.usage_count is behind account_hashtags; using totals from the loaded pairs")
+        return None
+    return usage
+
+class RelatedHashtagService:
+    """
+    Related-hashtag recommendations from a precomputed co-occurrence matrix.
+
+    The builder loads account/hashtag pairs into a sparse accounts x tags incidence
+    matrix A; A.T @ A gives co-occurrence counts for every tag pair. Scores are
+    normalized with Jaccard or PMI and the top N neighbours per tag are stored in
+    hashtag_related, so serving is a primary-key lookup rather than a self-join.
+    """
+
+    def __init__(self, metric: str = RELATED_METRIC, top_n: int = RELATED_TOP_N):
+        if metric not in ("jaccard", "pmi"):
+            raise ValueError("Related hashtag metric must be 'jaccard' or 'pmi'")
+        self.metric = metric
+        self.top_n = top_n
+
+    def get_related(self, tag: str, limit: int = 10):
+        """Get the hashtags that most often appear on the same accounts as tag"""
+        tag = tag.lower().strip().lstrip('#')
+        with get_read_session() as session:
+            hashtag_id = select(Hashtag.id).where(Hashtag.tag == tag).scalar_subquery()
+            rows = session.execute(
+                select(Hashtag.id, Hashtag.tag, HashtagRelated.score, HashtagRelated.co_count)
+                .join(HashtagRelated, HashtagRelated.related_id == Hashtag.id)
+                .where(HashtagRelated.hashtag_id == hashtag_id)
+                .order_by(HashtagRelated.score.desc())
+                .limit(limit)
+            ).all()
+            return [{
+                'id': row.id,
+                'tag': row.tag,
+                'score': row.score,
+                'co_count': row.co_count
+            } for row in rows]
+
+    def rebuild(self):
+        """Recompute neighbours for every hashtag."""
+        with get_db_session() as session:
+            accounts, tags = self._load_pairs(session, select(
+                account_hashtags.c.account_id, account_hashtags.c.hashtag_id
+            ))
+            total_accounts = session.execute(select(func.count()).select_from(Account)).scalar()
+            tag_ids = np.unique(tags)
+            result = self._neighbours(accounts, tags, tag_ids, total_accounts, usage=None)
+            session.execute(delete(HashtagRelated))
+            self._store(session, result)
+            session.commit()
+        logger.info(f"Related hashtags rebuilt for {len(tag_ids)} tags")
+        return {'tags': int(len(tag_ids)), 'pairs': int(len(result[0]))}
+
+    def refresh(self, hashtag_ids: Iterable[int], account_ids: Iterable[int] = ()):
+        """
+        Recompute neighbours for the tags touched by recent association changes.
+
+        A change to account a alters the pair counts of every tag on a, so the
+        tags currently on those accounts are refreshed as well. Only accounts
+        carrying one of the dirty tags are loaded, and tag totals come from
+        hashtags.usage_count instead of a full scan, unless the counts are
+        behind the pairs (see usage_totals).
+        """
+        with get_db_session() as session:
+            dirty = set(hashtag_ids)
+            account_ids = list(account_ids)
+            if account_ids:
+                dirty.update(session.execute(
+                    select(account_hashtags.c.hashtag_id)
+                    .where(account_hashtags.c.account_id.in_(account_ids))
+                ).scalars())
+            if not dirty:
+                return {'tags': 0, 'pairs': 0}
+
+            affected = select(account_hashtags.c.account_id).where(
+                account_hashtags.c.hashtag_id.in_(dirty)
+            )
+            accounts, tags = self._load_pairs(session, select(
+                account_hashtags.c.account_id, account_hashtags.c.hashtag_id
+            ).where(account_hashtags.c.account_id.in_(affected)))
+            total_accounts = session.execute(select(func.count()).select_from(Account)).scalar()
+
+            usage = dict(session.execute(
+                select(Hashtag.id, Hashtag.usage_count).where(Hashtag.id.in_(np.unique(tags).tolist()))
+            ).all()) if len(tags) else {}
+            usage = usage_totals(usage, tags)
+            dirty_ids = np.array(sorted(dirty), dtype=np.int64)
+            result = self._neighbours(accounts, tags, dirty_ids, total_accounts, usage=usage)
+
+            session.execute(delete(HashtagRelated).where(HashtagRelated.hashtag_id.in_(dirty_ids.tolist())))
+            self._store(session, result)
+            session.commit()
+        return {'tags': int(len(dirty_ids)), 'pairs': int(len(result[0]))}
+
+    def is_empty(self) -> bool:
+        """True until neighbours have been stored for any tag"""
+        with get_read_session() as session:
+            return session.execute(select(HashtagRelated.hashtag_id).limit(1)).first() is None
+
+    def _load_pairs(self, session, stmt):
+        """Stream (account_id, hashtag_id) pairs into two int64 arrays."""
+        accounts: List[np.ndarray] = []
+        tags: List[np.ndarray] = []
+        result = session.execute(stmt.execution_options(yield_per=RELATED_LOAD_CHUNK))
+        for chunk in result.partitions():
+            pairs = np.array(chunk, dtype=np.int64).reshape(-1, 2)
+            accounts.append(pairs[:, 0])
+            tags.append(pairs[:, 1])
+        if not accounts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(accounts), np.concatenate(tags)
+
+    def _neighbours(self, accounts: np.ndarray, tags: np.ndarray, row_tags: np.ndarray,
+                    total_accounts: int, usage: Optional[dict]):
+        """
+        Top-N neighbours for each tag in row_tags as (hashtag_id, related_id, score, co_count) arrays.
+        When usage is None the tag totals are taken from the loaded pairs.
+        """
+        empty = (np.empty(0, dtype=np.int64),) * 2 + (np.empty(0), np.empty(0, dtype=np.int64))
+        if len(tags) == 0:
+            return empty
+
+        account_ids, account_index = np.unique(accounts, return_inverse=True)
+        tag_ids, tag_index = np.unique(tags, return_inverse=True)
+        incidence = sparse.csr_matrix(
+            (np.ones(len(tags), dtype=np.float32), (account_index, tag_index)),
+            shape=(len(account_ids), len(tag_ids))
+        )
+        if usage is None:
+            totals = np.asarray(incidence.sum(axis=0), dtype=np.float64).ravel()
+        else:
+            totals = np.array([usage.get(int(t), 0) for t in tag_ids], dtype=np.float64)
+
+        rows = np.flatnonzero(np.isin(tag_ids, row_tags))
+        if len(rows) == 0:
+            return empty
+        cooccurrence = (incidence[:, rows].T @ incidence).tocoo()
+
+        source = rows[cooccurrence.row]
+        target = cooccurrence.col
+        counts = cooccurrence.data.astype(np.float64)
+        keep = (source != target) & (counts >= RELATED_MIN_COUNT)
+        source, target, counts = source[keep], target[keep], counts[keep]
+        if len(counts) == 0:
+            return empty
+
+        n_source, n_target = totals[source], totals[target]
+        if self.metric == "jaccard":
+            scores = counts / np.maximum(n_source + n_target - counts, counts)
+        else:
+            scores = np.log(counts * max(total_accounts, 1) / np.maximum(n_source * n_target, 1.0))
+
+        # Sort by source tag, best score first, then keep the first top_n of each group
+        order = np.lexsort((-scores, source))
+        source, target, scores, counts = source[order], target[order], scores[order], counts[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(source)) + 1]
+        group_sizes = np.diff(np.r_[starts, len(source)])
+        rank = np.arange(len(source)) - np.repeat(starts, group_sizes)
+        top = rank < self.top_n
+
+        return (
+            tag_ids[source[top]],
+            tag_ids[target[top]],
+            scores[top],
+            counts[top].astype(np.int64)
+        )
+
+    def _store(self, session, result):
+        hashtag_ids, related_ids, scores, counts = result
+        for start in range(0, len(hashtag_ids), RELATED_LOAD_CHUNK):
+            end = start + RELATED_LOAD_CHUNK
+            session.execute(insert(HashtagRelated), [{
+                'hashtag_id': int(h),
+                'related_id': int(r),
+                'score': float(s),
+                'co_count': int(c)
+            } for h, r, s, c in zip(hashtag_ids[start:end], related_ids[start:end],
+                                    scores[start:end], counts[start:end])])
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class TestRelatedNeighbours(unittest.TestCase):
+        def test_jaccard_neighbours(self):
+            service = RelatedHashtagService(metric="jaccard", top_n=1)
+            # Accounts 1-3 share tags 10 and 20; tag 30 appears with 10 on two accounts
+            accounts = np.array([1, 1, 2, 2, 3, 3, 4, 5, 4, 5])
+            tags = np.array([10, 20, 10, 20, 10, 20, 10, 10, 30, 30])
+            source, target, scores, counts = service._neighbours(accounts, tags, np.array([10, 20, 30]), 5, None)
+
+            best = dict(zip(source.tolist(), target.tolist()))
+            self.assertEqual(best, {10: 20, 20: 10, 30: 10})
+            self.assertAlmostEqual(float(scores[source == 20][0]), 3 / 5)
+            self.assertEqual(int(counts[source == 10][0]), 3)
+
+        def test_min_count(self):
+            service = RelatedHashtagService(metric="pmi")
+            accounts = np.array([1, 1])
+            tags = np.array([10, 20])
+            result = service._neighbours(accounts, tags, np.array([10, 20]), 1, None)
+            self.assertEqual(len(result[0]), 0)
+
+        def test_usage_totals(self):
+            tags = np.array([10, 20, 10])
+            self.assertEqual(usage_totals({10: 5, 20: 1}, tags), {10: 5, 20: 1})
+            self.assertIsNone(usage_totals({10: 0, 20: 0}, tags))
+            self.assertIsNone(usage_totals({10: 2}, tags))
+
+    unittest.main(verbosity=2)
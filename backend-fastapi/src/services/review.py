@@ -1,15 +1,44 @@
-import sys
-from pathlib import Path
-
-project_root = Path(__file__).resolve().parents[2]
-sys.path.append(str(project_root))
-
-from src.db import get_db_session
+from src.db import get_db_session, get_read_session, any_id, id_array
 from src.models import Review, Account, Service
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func
+from src.export import EXPORT_BATCH_SIZE
+from src.cache import local_cache, notify_invalidation
+from src.fields import select_fields
+from src.batching import WriteCoalescer, WRITE_BATCHING
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy import func, select, bindparam, insert, tuple_
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from functools import lru_cache
+import os
+
+rating_cache = local_cache("ratings")
+
+def rating_keys(service_id: int, account_id: int) -> List[str]:
+    """Cache keys of the averages and summary a review of service_id (provided by account_id) feeds into"""
+    return [f"service:{service_id}", f"account:{account_id}", f"summary:{service_id}"]
+
+REVIEW_SUMMARY_LATEST = int(os.getenv("REVIEW_SUMMARY_LATEST", "5"))
+REVIEW_SUMMARY_MAX_LATEST = 20  # Latest reviews kept in the cached summary; requests may ask for fewer
+
+# Columns a client may request with ?fields=, also the export columns
+REVIEW_FIELDS = ['id', 'account_id', 'client_id', 'service_id', 'rating', 'title', 'body', 'created_at', 'updated_at']
+REVIEW_EXPORT_COLUMNS = REVIEW_FIELDS
+
+RATING_STATS = (
+    select(Review.service_id, func.count(Review.id), func.avg(Review.rating))
+    .where(Review.service_id == any_id('service_ids'))
+    .group_by(Review.service_id)
+)
+
+@lru_cache(maxsize=256)
+def reviews_by_service_statement(fields: Tuple[str, ...]):
+    """Built once per field selection and reused, so calls skip statement construction"""
+    return select_fields(Review, fields).where(Review.service_id == bindparam('service_id'))
 
 class ReviewService:
+    def __init__(self, batching: bool = WRITE_BATCHING):
+        # With batching, concurrent create_review() calls share one transaction
+        self.coalescer = WriteCoalescer("reviews", self._create_reviews) if batching else None
+
     def create_review(self, client_id: int, service_id: int, rating: int, title: str, body: str):
         """
         Create a new review.
@@ -19,7 +48,11 @@ class ReviewService:
         """
         if not 1 <= rating <= 5:
             raise ValueError("Rating must be between 1 and 5")
+        if self.coalescer:
+            return self.coalescer.submit((client_id, service_id, rating, title, body))
+        return self._create_review(client_id, service_id, rating, title, body)
 
+    def _create_review(self, client_id: int, service_id: int, rating: int, title: str, body: str):
         with get_db_session() as session:
             # Get the service and its account
             service = session.get(Service, service_id)
@@ -54,6 +87,9 @@ class ReviewService:
             session.add(review)
             
             try:
+                notify_invalidation(session, "ratings", rating_keys(service_id, service.account_id))
+                notify_invalidation(session, "profiles", [service.account_id])
+                notify_invalidation(session, "search", ["reviews"])
                 session.commit()
                 return {
                     'id': review.id,
@@ -70,8 +106,81 @@ class ReviewService:
                 session.rollback()
                 raise ValueError("An error occurred while creating the review")
 
+    def _create_reviews(self, items: List[tuple]) -> List[Union[dict, Exception]]:
+        """
+        Write handler for the coalescer. items are create_review() argument
+        tuples; they are checked with one query each for services, clients and
+        existing reviews, and the valid ones are inserted with one multi-row
+        INSERT and one commit. If the batch fails as a whole (say a service was
+        deleted meanwhile), each item is retried on its own so only the
+        offending ones fail.
+        """
+        results: List[Union[dict, Exception]] = [None] * len(items)
+        try:
+            with get_db_session() as session:
+                providers = dict(session.execute(
+                    select(Service.id, Service.account_id).where(Service.id.in_({item[1] for item in items}))
+                ).all())
+                clients = set(session.execute(
+                    select(Account.id).where(Account.id.in_({item[0] for item in items}))
+                ).scalars())
+                reviewed = set(session.execute(
+                    select(Review.client_id, Review.service_id)
+                    .where(tuple_(Review.client_id, Review.service_id).in_({item[:2] for item in items}))
+                ).all())
+
+                accepted, rows = [], []
+                for index, (client_id, service_id, rating, title, body) in enumerate(items):
+                    provider_id = providers.get(service_id)
+                    if provider_id is None:
+                        results[index] = ValueError("Service not found")
+                    elif client_id not in clients:
+                        results[index] = ValueError("Client account not found")
+                    elif client_id == provider_id:
+                        results[index] = ValueError("Cannot review your own service")
+                    elif (client_id, service_id) in reviewed:
+                        results[index] = ValueError("You have already reviewed this service")
+                    else:
+                        reviewed.add((client_id, service_id))  # A second one in the same batch is a duplicate too
+                        accepted.append(index)
+                        rows.append({
+                            'account_id': provider_id,
+                            'client_id': client_id,
+                            'service_id': service_id,
+                            'rating': rating,
+                            'title': title,
+                            'body': body
+                        })
+                if not rows:
+                    return results
+
+                inserted = session.execute(
+                    insert(Review).returning(
+                        *(getattr(Review, field) for field in REVIEW_FIELDS), sort_by_parameter_order=True
+                    ),
+                    rows
+                ).all()
+                notify_invalidation(session, "ratings", sorted({
+                    key for row in rows for key in rating_keys(row['service_id'], row['account_id'])
+                }))
+                notify_invalidation(session, "profiles", sorted({row['account_id'] for row in rows}))
+                notify_invalidation(session, "search", ["reviews"])
+                session.commit()
+        except SQLAlchemyError:
+            for index in range(len(items)):
+                if results[index] is None:
+                    try:
+                        results[index] = self._create_review(*items[index])
+                    except Exception as e:
+                        results[index] = e
+            return results
+
+        for index, row in zip(accepted, inserted):
+            results[index] = row._asdict()
+        return results
+
     def get_review_by_id(self, review_id: int):
-        with get_db_session() as session:
+        with get_read_session() as session:
             review = session.get(Review, review_id)
             if review:
                 return {
@@ -87,52 +196,45 @@ class ReviewService:
                 }
             return None
 
-    def get_reviews_by_service(self, service_id: int):
-        with get_db_session() as session:
-            reviews = session.query(Review).filter(Review.service_id == service_id).all()
-            return [{
-                'id': review.id,
-                'account_id': review.account_id,
-                'client_id': review.client_id,
-                'service_id': review.service_id,
-                'rating': review.rating,
-                'title': review.title,
-                'body': review.body,
-                'created_at': review.created_at,
-                'updated_at': review.updated_at
-            } for review in reviews]
-
-    def get_reviews_by_account(self, account_id: int):
+    def get_reviews_by_service(self, service_id: int, fields: Optional[List[str]] = None):
+        with get_read_session() as session:
+            rows = session.execute(
+                reviews_by_service_statement(tuple(fields or REVIEW_FIELDS)), {'service_id': service_id}
+            )
+            return [row._asdict() for row in rows]
+
+    def get_reviews_by_account(self, account_id: int, fields: Optional[List[str]] = None):
         """Get all reviews for services provided by this account"""
-        with get_db_session() as session:
-            reviews = session.query(Review).filter(Review.account_id == account_id).all()
-            return [{
-                'id': review.id,
-                'account_id': review.account_id,
-                'client_id': review.client_id,
-                'service_id': review.service_id,
-                'rating': review.rating,
-                'title': review.title,
-                'body': review.body,
-                'created_at': review.created_at,
-                'updated_at': review.updated_at
-            } for review in reviews]
-
-    def get_reviews_by_client(self, client_id: int):
+        with get_read_session() as session:
+            rows = session.execute(
+                select_fields(Review, fields or REVIEW_FIELDS).where(Review.account_id == account_id)
+            )
+            return [row._asdict() for row in rows]
+
+    def iter_reviews(self, account_id: Optional[int] = None, client_id: Optional[int] = None,
+                     batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[dict]:
+        """
+        Yield reviews one at a time for export, filtered by provider and/or client.
+        Rows come from a server-side cursor in batches of batch_size, so the
+        session stays open until the generator is exhausted or closed.
+        """
+        stmt = select_fields(Review, REVIEW_EXPORT_COLUMNS).order_by(Review.id)
+        if account_id is not None:
+            stmt = stmt.where(Review.account_id == account_id)
+        if client_id is not None:
+            stmt = stmt.where(Review.client_id == client_id)
+        with get_read_session() as session:
+            result = session.execute(stmt.execution_options(yield_per=batch_size, stream_results=True))
+            for row in result:
+                yield row._asdict()
+
+    def get_reviews_by_client(self, client_id: int, fields: Optional[List[str]] = None):
         """Get all reviews written by this client"""
-        with get_db_session() as session:
-            reviews = session.query(Review).filter(Review.client_id == client_id).all()
-            return [{
-                'id': review.id,
-                'account_id': review.account_id,
-                'client_id': review.client_id,
-                'service_id': review.service_id,
-                'rating': review.rating,
-                'title': review.title,
-                'body': review.body,
-                'created_at': review.created_at,
-                'updated_at': review.updated_at
-            } for review in reviews]
+        with get_read_session() as session:
+            rows = session.execute(
+                select_fields(Review, fields or REVIEW_FIELDS).where(Review.client_id == client_id)
+            )
+            return [row._asdict() for row in rows]
 
     def update_review(self, review_id: int, rating: int = None, title: str = None, body: str = None):
         with get_db_session() as session:
@@ -150,6 +252,9 @@ class ReviewService:
                 review.body = body
 
             try:
+                notify_invalidation(session, "ratings", rating_keys(review.service_id, review.account_id))
+                notify_invalidation(session, "profiles", [review.account_id])
+                notify_invalidation(session, "search", ["reviews"])
                 session.commit()
                 return {
                     'id': review.id,
@@ -190,22 +295,76 @@ class ReviewService:
                 raise ValueError("You can only delete your own reviews")
             
             session.delete(review)
+            notify_invalidation(session, "ratings", rating_keys(review.service_id, review.account_id))
+            notify_invalidation(session, "profiles", [review.account_id])
+            notify_invalidation(session, "search", ["reviews"])
             session.commit()
             return True
 
     def get_average_rating(self, service_id: int = None, account_id: int = None):
         """Get the average rating for a service or account"""
-        with get_db_session() as session:
-            query = session.query(func.avg(Review.rating))
-            if service_id:
-                query = query.filter(Review.service_id == service_id)
-            elif account_id:
-                query = query.filter(Review.account_id == account_id)
-            else:
-                raise ValueError("Must provide either service_id or account_id")
-            
-            avg_rating = query.scalar()
-            return float(avg_rating) if avg_rating else 0.0
+        if service_id:
+            key, condition = f"service:{service_id}", Review.service_id == service_id
+        elif account_id:
+            key, condition = f"account:{account_id}", Review.account_id == account_id
+        else:
+            raise ValueError("Must provide either service_id or account_id")
+
+        def load():
+            with get_read_session() as session:
+                avg_rating = session.query(func.avg(Review.rating)).filter(condition).scalar()
+                return float(avg_rating) if avg_rating else 0.0
+
+        return rating_cache.get_or_load(key, load)
+
+    def get_review_summary(self, service_id: int, latest: int = REVIEW_SUMMARY_LATEST) -> dict:
+        """
+        Count, average, 1-5 histogram and the latest reviews of a service. The
+        histogram comes from one grouped query, and the average is derived from
+        it; the latest reviews are a LIMITed index scan.
+        """
+        summary = rating_cache.get_or_load(f"summary:{service_id}", lambda: self._load_review_summary(service_id))
+        # The cached summary is shared, so slice into a new dict rather than trimming it
+        return {**summary, 'latest': summary['latest'][:latest]}
+
+    def _load_review_summary(self, service_id: int) -> dict:
+        with get_read_session() as session:
+            distribution = {rating: 0 for rating in range(1, 6)}
+            for rating, count in session.execute(
+                select(Review.rating, func.count())
+                .where(Review.service_id == service_id)
+                .group_by(Review.rating)
+            ):
+                distribution[rating] = count
+
+            latest = session.execute(
+                select(
+                    Review.id, Review.client_id, Account.username.label('client_username'),
+                    Review.rating, Review.title, Review.body, Review.created_at
+                )
+                .join(Account, Account.id == Review.client_id)
+                .where(Review.service_id == service_id)
+                .order_by(Review.created_at.desc(), Review.id.desc())
+                .limit(REVIEW_SUMMARY_MAX_LATEST)
+            ).all()
+
+        count = sum(distribution.values())
+        total = sum(rating * n for rating, n in distribution.items())
+        return {
+            'service_id': service_id,
+            'count': count,
+            'average_rating': total / count if count else 0.0,
+            'distribution': distribution,
+            'latest': [row._asdict() for row in latest]
+        }
+
+    def get_rating_stats(self, service_ids: List[int]) -> Dict[int, Tuple[int, float]]:
+        """Review count and average rating for many services in one grouped query"""
+        if not service_ids:
+            return {}
+        with get_read_session() as session:
+            rows = session.execute(RATING_STATS, {'service_ids': id_array(service_ids)})
+            return {service_id: (count, float(avg)) for service_id, count, avg in rows}
 
 
 if __name__ == "__main__":
@@ -311,6 +470,61 @@ if __name__ == "__main__":
             avg_service = self.review_service.get_average_rating(service_id=self.service['id'])
             self.assertEqual(avg_service, 4.0)  # (5 + 3) / 2 = 4.0
 
+        def test_review_summary(self):
+            second_client = self.account_service.create_account(
+                username="client3",
+                email="client3@example.com",
+                password="testpass123"
+            )
+            self.review_service.create_review(**self.test_review_data)  # rating: 5
+            summary = self.review_service.get_review_summary(self.service['id'], latest=1)
+            self.assertEqual((summary['count'], summary['average_rating']), (1, 5.0))
+
+            # A new review invalidates the cached summary
+            self.review_service.create_review(
+                client_id=second_client['id'],
+                service_id=self.service['id'],
+                rating=2,
+                title="Latest",
+                body="Late"
+            )
+            summary = self.review_service.get_review_summary(self.service['id'], latest=1)
+            self.assertEqual(summary['count'], 2)
+            self.assertEqual(summary['average_rating'], 3.5)
+            self.assertEqual(summary['distribution'], {1: 0, 2: 1, 3: 0, 4: 0, 5: 1})
+            self.assertEqual([review['title'] for review in summary['latest']], ["Latest"])
+            self.assertEqual(summary['latest'][0]['client_username'], "client3")
+            self.assertEqual(len(self.review_service.get_review_summary(self.service['id'])['latest']), 2)
+
+        def test_batched_create(self):
+            from concurrent.futures import ThreadPoolExecutor
+            clients = [
+                self.account_service.create_account(f"batch{i}", f"batch{i}@example.com", "testpass123")
+                for i in range(6)
+            ]
+            batched = ReviewService(batching=True)
+            calls = [(client['id'], self.service['id'], 4, "Batched", "Body") for client in clients]
+            calls += [(clients[0]['id'], self.service['id'], 2, "Again", "Twice"),  # Duplicate
+                      (self.provider['id'], self.service['id'], 5, "Mine", "Self")]
+
+            def call(args):
+                try:
+                    return batched.create_review(*args)['client_id']
+                except ValueError as e:
+                    return str(e)
+
+            with ThreadPoolExecutor(len(calls)) as pool:
+                results = list(pool.map(call, calls))
+            self.assertEqual(results[1:6], [client['id'] for client in clients[1:]])
+            # Whichever of the first client's two reviews came first wins
+            self.assertEqual(
+                sorted(map(str, (results[0], results[6]))),
+                sorted([str(clients[0]['id']), "You have already reviewed this service"])
+            )
+            self.assertEqual(results[7], "Cannot review your own service")
+            self.assertEqual(len(self.review_service.get_reviews_by_service(self.service['id'])), 6)
+            self.assertEqual(self.review_service.get_average_rating(service_id=self.service['id']), 4.0)
+
         def test_prevent_self_review(self):
             with self.assertRaises(ValueError):
                 self.review_service.create_review(
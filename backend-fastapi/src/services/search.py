@@ -0,0 +1,207 @@
+from src.services.service import ServiceService, SEARCH_CACHE_MAX_RESULTS, search_cache
+from src.services.hashtag import HashtagService, normalize_tag
+from src.services.review import ReviewService
+from src.services.ranking import RelevanceRanker
+from src.services.facets import FacetCounter, parse_facets
+from src.services.hashtag_index import HashtagIndex, HASHTAG_MATCHES, tags_match
+from itertools import compress
+from typing import Iterable, List, Optional, Tuple, Union
+
+SEARCH_SORTS = ["relevance", "price_low", "price_high", "rating"]
+
+class SearchService:
+    def __init__(self, ranker: Optional[RelevanceRanker] = None, facet_counter: Optional[FacetCounter] = None,
+                 hashtag_index: Optional[HashtagIndex] = None):
+        self.service_service = ServiceService()
+        self.hashtag_service = HashtagService()
+        self.review_service = ReviewService()
+        self.ranker = ranker or RelevanceRanker()
+        self.facet_counter = facet_counter or FacetCounter()
+        # Without an index (or before it is built), candidates' tags are loaded and checked one by one
+        self.hashtag_index = hashtag_index
+
+    def advanced_search(self, keyword: Optional[str] = None, min_price: Optional[int] = None,
+                        max_price: Optional[int] = None, hashtags: Iterable[str] = (),
+                        sort: str = "relevance", limit: Optional[int] = None,
+                        facets: Iterable[str] = (), match: str = "any",
+                        exclude_hashtags: Iterable[str] = ()) -> Union[List[dict], dict]:
+        """
+        Services matching keyword and the price range whose provider carries any
+        (match="any") or all (match="all") of hashtags and none of
+        exclude_hashtags, sorted by sort. The result is cached as (id, relevance)
+        pairs under the normalized query until a table it read from changes.
+
+        When facets are requested the result is {'results': [...], 'facets': {...}},
+        with the counts taken over every match, not just the first limit.
+        """
+        keyword = keyword.lower() if keyword else None
+        tags = tuple(sorted({normalize_tag(tag) for tag in hashtags}))
+        excluded = tuple(sorted({normalize_tag(tag) for tag in exclude_hashtags}))
+        if match not in HASHTAG_MATCHES:
+            raise ValueError(f"Unknown match: {match}. Allowed: {', '.join(HASHTAG_MATCHES)}")
+        if len(tags) < 2:
+            match = "any"  # Same result, same cache entry
+        facets = parse_facets(facets)
+        tables = ["services"]
+        if tags or excluded or sort == "relevance" or "hashtags" in facets:
+            tables.append("account_hashtags")
+        if sort in ("rating", "relevance") or "rating" in facets:
+            tables.append("reviews")
+        loaded = None
+
+        def load():
+            nonlocal loaded
+            loaded = self._advanced_search(keyword, min_price, max_price, tags, sort, limit, facets, match, excluded)
+            if len(loaded[0]) > SEARCH_CACHE_MAX_RESULTS:
+                return None
+            return [(service['id'], service.get('relevance')) for service in loaded[0]], loaded[1]
+
+        cached = search_cache.get_or_load(
+            ('advanced', keyword, min_price, max_price, tags, match, excluded, sort, limit, facets), tables, load
+        )
+        if loaded is not None:
+            services, facet_counts = loaded
+        else:
+            ranked, facet_counts = cached
+            services = self.service_service.get_services_by_ids([service_id for service_id, _ in ranked])
+            if sort == "relevance":
+                relevance = dict(ranked)
+                services = [dict(service, relevance=relevance[service['id']]) for service in services]
+        if not facets:
+            return services
+        return {'results': services, 'facets': facet_counts}
+
+    def _advanced_search(self, keyword: Optional[str], min_price: Optional[int], max_price: Optional[int],
+                         tags: tuple, sort: str, limit: Optional[int],
+                         facets: Tuple[str, ...] = (), match: str = "any",
+                         excluded: tuple = ()) -> Tuple[List[dict], Optional[dict]]:
+        services = self.service_service.search_services(keyword=keyword, min_price=min_price, max_price=max_price)
+
+        # Filter by hashtags with the index first, so only the survivors' tags are loaded
+        filtered = not (tags or excluded)
+        if not filtered and self.hashtag_index is not None and self.hashtag_index.ready:
+            keep = self.hashtag_index.matches([service['account_id'] for service in services], tags, match, excluded)
+            services = list(compress(services, keep))
+            filtered = True
+
+        # Tags of every candidate's provider, loaded in one query
+        account_tags = {}
+        if not filtered or sort == "relevance" or "hashtags" in facets:
+            account_tags = self.hashtag_service.get_hashtags_for_accounts(
+                [service['account_id'] for service in services]
+            )
+
+        if not filtered:
+            services = [
+                service for service in services
+                if tags_match(account_tags.get(service['account_id'], set()), tags, match, excluded)
+            ]
+
+        # Rating stats of the remaining candidates, shared by the sort and the facets
+        stats = {}
+        if sort in ("rating", "relevance") or "rating" in facets:
+            stats = self.review_service.get_rating_stats([service['id'] for service in services])
+
+        facet_counts = self.facet_counter.count(services, facets, account_tags, stats) if facets else None
+
+        # Sort results; services may be shared with the cache, so sort a new list
+        # Ties are broken by id so the order (and which ties a limit keeps) is deterministic
+        if sort == "price_low":
+            services = sorted(services, key=lambda x: (x['price'], x['id']))
+        elif sort == "price_high":
+            services = sorted(services, key=lambda x: (-x['price'], x['id']))
+        elif sort == "rating":
+            services = sorted(services, key=lambda x: (-stats.get(x['id'], (0, 0.0))[1], x['id']))
+        elif sort == "relevance":
+            return self.ranker.rank(
+                services,
+                query=keyword,
+                hashtags=tags,
+                rating_stats=stats,
+                account_tags=account_tags,
+                limit=limit
+            ), facet_counts
+
+        return (services[:limit] if limit else services), facet_counts
+
+
+if __name__ == "__main__":
+    import unittest
+    from src.db import init_db, drop_db
+    from src.services.account import AccountService
+
+    class TestSearchService(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            init_db()
+            cls.search_service = SearchService()
+            accounts = AccountService()
+            cls.gardener = accounts.create_account("gardener", "gardener@example.com", "pw")
+            cls.designer = accounts.create_account("designer", "designer@example.com", "pw")
+            cls.client = accounts.create_account("searcher", "searcher@example.com", "pw")
+            services = ServiceService()
+            cls.lawn = services.create_service(cls.gardener['id'], "Lawn design", "Mowing and planting", 3000)
+            cls.logo = services.create_service(cls.designer['id'], "Logo design", "Brand identity", 8000)
+            HashtagService().add_hashtags_to_account(cls.gardener['id'], ["garden"])
+
+        @classmethod
+        def tearDownClass(cls):
+            drop_db()
+
+        def test_filters_and_sorts(self):
+            results = self.search_service.advanced_search("Design", sort="price_high")
+            self.assertEqual([s['id'] for s in results], [self.logo['id'], self.lawn['id']])
+            results = self.search_service.advanced_search("design", hashtags=["#Garden"], sort="price_low")
+            self.assertEqual([s['id'] for s in results], [self.lawn['id']])
+            ranked = self.search_service.advanced_search("logo")
+            self.assertEqual(ranked[0]['id'], self.logo['id'])
+            self.assertIn('relevance', ranked[0])
+
+        def test_cached_until_write(self):
+            first = self.search_service.advanced_search("design", sort="rating")
+            hits = search_cache.stats()['hits']
+            self.assertEqual(self.search_service.advanced_search("DESIGN", sort="rating"), first)
+            self.assertEqual(search_cache.stats()['hits'], hits + 1)
+            self.assertEqual(self.search_service.advanced_search("design", sort="relevance"),
+                             self.search_service.advanced_search("design", sort="relevance"))
+
+            # A new review reorders the rating sort
+            ReviewService().create_review(self.client['id'], first[-1]['id'], 5, "Great", "Really")
+            self.assertEqual(self.search_service.advanced_search("design", sort="rating")[0]['id'], first[-1]['id'])
+
+        def test_facets(self):
+            found = self.search_service.advanced_search("design", sort="price_low", limit=1,
+                                                        facets=["hashtags", "price"])
+            self.assertEqual([s['id'] for s in found['results']], [self.lawn['id']])
+            self.assertEqual(sum(bucket['count'] for bucket in found['facets']['price']), 2)
+            self.assertEqual(found['facets']['hashtags'], [{'tag': "garden", 'count': 1}])
+            self.assertNotIn('rating', found['facets'])
+            self.assertEqual(self.search_service.advanced_search("design", sort="price_low", limit=1,
+                                                                 facets=["price", "hashtags"]), found)
+
+            # Tagging the designer changes the counts of the cached query
+            HashtagService().add_hashtags_to_account(self.designer['id'], ["branding"])
+            found = self.search_service.advanced_search("design", sort="price_low", limit=1,
+                                                        facets=["hashtags", "price"])
+            self.assertEqual(found['facets']['hashtags'],
+                             [{'tag': "branding", 'count': 1}, {'tag': "garden", 'count': 1}])
+            with self.assertRaises(ValueError):
+                self.search_service.advanced_search("design", facets=["colour"])
+
+        def test_match_modes(self):
+            florist = AccountService().create_account("florist", "florist@example.com", "pw")
+            bouquet = ServiceService().create_service(florist['id'], "Bouquet design", "Flowers", 5000)
+            HashtagService().add_hashtags_to_account(florist['id'], ["garden", "flowers"])
+            index = HashtagIndex()
+            index.build()
+            for search in (self.search_service, SearchService(hashtag_index=index)):
+                search_cache.invalidate()  # Both would otherwise share one cached answer
+                ids = lambda **filters: {s['id'] for s in search.advanced_search("design", sort="price_low", **filters)}
+                self.assertEqual(ids(hashtags=["garden", "flowers"]), {self.lawn['id'], bouquet['id']})
+                self.assertEqual(ids(hashtags=["garden", "flowers"], match="all"), {bouquet['id']})
+                self.assertEqual(ids(hashtags=["garden"], exclude_hashtags=["#Flowers"]), {self.lawn['id']})
+                self.assertEqual(ids(exclude_hashtags=["garden"]), {self.logo['id']})
+            with self.assertRaises(ValueError):
+                self.search_service.advanced_search("design", hashtags=["garden"], match="some")
+
+    unittest.main(verbosity=2)
@@ -1,12 +1,42 @@
-import sys
-from pathlib import Path
-
-project_root = Path(__file__).resolve().parents[2]
-sys.path.append(str(project_root))
-
-from src.db import get_db_session
+from src.db import get_db_session, get_read_session
 from src.models import Service, Account
+from src.events import publish
+from src.export import EXPORT_BATCH_SIZE
+from src.cache import local_cache, result_cache, notify_invalidation
+from src.fields import select_fields
+from src.services.review import rating_keys
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import bindparam
+from typing import Iterator, List, Optional, Tuple
+from functools import lru_cache
+import os
+
+service_cache = local_cache("services")
+search_cache = result_cache("search")  # Keys are table names: services, reviews, hashtags, account_hashtags
+
+# Searches matching more services than this are not cached
+SEARCH_CACHE_MAX_RESULTS = int(os.getenv("SEARCH_CACHE_MAX_RESULTS", "1000"))
+
+# Columns a client may request with ?fields=, also the export columns
+SERVICE_FIELDS = ['id', 'account_id', 'title', 'description', 'price', 'created_at', 'updated_at']
+SERVICE_EXPORT_COLUMNS = SERVICE_FIELDS
+
+@lru_cache(maxsize=256)
+def search_statement(fields: Tuple[str, ...], keyword: bool, min_price: bool, max_price: bool):
+    """
+    The search SELECT for one combination of field selection and filters, built
+    once and reused with bind parameters instead of being rebuilt per call
+    """
+    query = select_fields(Service, fields)
+    if keyword:
+        query = query.where(
+            Service.title.ilike(bindparam('pattern')) | Service.description.ilike(bindparam('pattern'))
+        )
+    if min_price:
+        query = query.where(Service.price >= bindparam('min_price'))
+    if max_price:
+        query = query.where(Service.price <= bindparam('max_price'))
+    return query
 
 class ServiceService:
     def create_service(self, account_id: int, title: str, description: str, price: int):
@@ -26,8 +56,10 @@ class ServiceService:
             session.add(service)
             
             try:
+                notify_invalidation(session, "profiles", [account_id])
+                notify_invalidation(session, "search", ["services"])
                 session.commit()
-                return {
+                result = {
                     'id': service.id,
                     'account_id': service.account_id,
                     'title': service.title,
@@ -36,37 +68,54 @@ class ServiceService:
                     'created_at': service.created_at,
                     'updated_at': service.updated_at
                 }
+                publish("services.created", service=result)
+                return result
             except IntegrityError:
                 session.rollback()
                 raise ValueError("An error occurred while creating the service")
 
-    def get_service_by_id(self, service_id: int):
-        with get_db_session() as session:
-            service = session.get(Service, service_id)
-            if service:
-                return {
-                    'id': service.id,
-                    'account_id': service.account_id,
-                    'title': service.title,
-                    'description': service.description,
-                    'price': service.price,
-                    'created_at': service.created_at,
-                    'updated_at': service.updated_at
-                }
-            return None
+    def get_service_by_id(self, service_id: int, fields: Optional[List[str]] = None):
+        """The service as a dict. With fields, only those columns are read, bypassing the cache."""
+        if fields is not None:
+            return self._load_service(service_id, fields)
+        return service_cache.get_or_load(service_id, lambda: self._load_service(service_id))
 
-    def get_services_by_account(self, account_id: int):
-        with get_db_session() as session:
-            services = session.query(Service).filter(Service.account_id == account_id).all()
-            return [{
-                'id': service.id,
-                'account_id': service.account_id,
-                'title': service.title,
-                'description': service.description,
-                'price': service.price,
-                'created_at': service.created_at,
-                'updated_at': service.updated_at
-            } for service in services]
+    def _load_service(self, service_id: int, fields: Optional[List[str]] = None):
+        with get_read_session() as session:
+            row = session.execute(
+                select_fields(Service, fields or SERVICE_FIELDS).where(Service.id == service_id)
+            ).first()
+            return row._asdict() if row else None
+
+    def get_services_by_account(self, account_id: int, fields: Optional[List[str]] = None):
+        with get_read_session() as session:
+            rows = session.execute(
+                select_fields(Service, fields or SERVICE_FIELDS).where(Service.account_id == account_id)
+            )
+            return [row._asdict() for row in rows]
+
+    def get_services_by_ids(self, service_ids: List[int], fields: Optional[List[str]] = None):
+        """
+        Get several services in the order of service_ids. Cached services are
+        taken from the cache and the rest read in one query. With fields, only
+        those columns are read for all of them, bypassing the cache.
+        """
+        if not service_ids:
+            return []
+        if fields is not None:
+            by_id = self._load_services(service_ids, fields)
+        else:
+            by_id = service_cache.get_many(service_ids, self._load_services)
+        return [by_id[service_id] for service_id in service_ids if service_id in by_id]
+
+    def _load_services(self, service_ids: List[int], fields: Optional[List[str]] = None) -> dict:
+        fields = fields or SERVICE_FIELDS
+        with get_read_session() as session:
+            rows = session.execute(
+                select_fields(Service, ['id'] + [field for field in fields if field != 'id'])
+                .where(Service.id.in_(service_ids))
+            )
+            return {row.id: {field: getattr(row, field) for field in fields} for row in rows}
 
     def update_service(self, service_id: int, title: str = None, description: str = None, price: int = None):
         with get_db_session() as session:
@@ -82,8 +131,11 @@ class ServiceService:
                 service.price = price
 
             try:
+                notify_invalidation(session, "services", [service_id])
+                notify_invalidation(session, "profiles", [service.account_id])
+                notify_invalidation(session, "search", ["services"])
                 session.commit()
-                return {
+                result = {
                     'id': service.id,
                     'account_id': service.account_id,
                     'title': service.title,
@@ -92,45 +144,71 @@ class ServiceService:
                     'created_at': service.created_at,
                     'updated_at': service.updated_at
                 }
+                publish("services.updated", service=result)
+                return result
             except IntegrityError:
                 session.rollback()
                 raise ValueError("An error occurred while updating the service")
 
-    def delete_service(self, service_id: int):
+    def delete_service(self, service_id: int, account_id: Optional[int] = None):
+        """Delete a service. When account_id is given, it must own the service."""
         with get_db_session() as session:
             service = session.get(Service, service_id)
             if service:
+                if account_id is not None and service.account_id != account_id:
+                    raise ValueError("Not authorized to delete this service")
                 session.delete(service)
+                notify_invalidation(session, "services", [service_id])
+                # Its reviews go with it
+                notify_invalidation(session, "ratings", rating_keys(service_id, service.account_id))
+                notify_invalidation(session, "profiles", [service.account_id])
+                notify_invalidation(session, "search", ["services", "reviews"])
                 session.commit()
+                publish("services.deleted", service_id=service_id)
                 return True
             return False
 
-    def search_services(self, keyword: str = None, min_price: int = None, max_price: int = None):
-        with get_db_session() as session:
-            query = session.query(Service)
-            
-            if keyword:
-                query = query.filter(
-                    (Service.title.ilike(f'%{keyword}%')) |
-                    (Service.description.ilike(f'%{keyword}%'))
-                )
-            
-            if min_price is not None:
-                query = query.filter(Service.price >= min_price)
-            
-            if max_price is not None:
-                query = query.filter(Service.price <= max_price)
-            
-            services = query.all()
-            return [{
-                'id': service.id,
-                'account_id': service.account_id,
-                'title': service.title,
-                'description': service.description,
-                'price': service.price,
-                'created_at': service.created_at,
-                'updated_at': service.updated_at
-            } for service in services]
+    def iter_services(self, account_id: Optional[int] = None,
+                      batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[dict]:
+        """Yield services one at a time for export, streamed from a server-side cursor"""
+        stmt = select_fields(Service, SERVICE_EXPORT_COLUMNS).order_by(Service.id)
+        if account_id is not None:
+            stmt = stmt.where(Service.account_id == account_id)
+        with get_read_session() as session:
+            result = session.execute(stmt.execution_options(yield_per=batch_size, stream_results=True))
+            for row in result:
+                yield row._asdict()
+
+    def search_services(self, keyword: str = None, min_price: int = None, max_price: int = None,
+                        fields: Optional[List[str]] = None):
+        """
+        Services matching keyword (in title or description) and the price range.
+        The matching ids are cached per normalized query until a service changes;
+        the services themselves come from the service cache.
+        """
+        keyword = keyword.lower() if keyword else None  # ilike ignores case anyway
+        loaded = None
+
+        def load():
+            nonlocal loaded
+            loaded = self._search(keyword, min_price, max_price, fields)
+            if len(loaded) > SEARCH_CACHE_MAX_RESULTS:
+                return None
+            return [service['id'] for service in loaded]
+
+        ids = search_cache.get_or_load(('services', keyword, min_price, max_price), ["services"], load)
+        if loaded is None:
+            return self.get_services_by_ids(ids, fields=fields)
+        return loaded
+
+    def _search(self, keyword: Optional[str], min_price: Optional[int], max_price: Optional[int],
+                fields: Optional[List[str]] = None) -> List[dict]:
+        query = search_statement(
+            tuple(fields or SERVICE_FIELDS), bool(keyword), min_price is not None, max_price is not None
+        )
+        params = {'pattern': f'%{keyword}%', 'min_price': min_price, 'max_price': max_price}
+        with get_read_session() as session:
+            return [row._asdict() for row in session.execute(query, params)]
 
 
 if __name__ == "__main__":
@@ -202,6 +280,23 @@ if __name__ == "__main__":
             deleted = self.service_service.get_service_by_id(service['id'])
             self.assertIsNone(deleted)
 
+        def test_sparse_fields(self):
+            created = self.service_service.create_service(**self.test_service_data)
+            fields = ['id', 'title', 'price']
+            self.assertEqual(
+                self.service_service.get_service_by_id(created['id'], fields=fields),
+                {'id': created['id'], 'title': "Test Service", 'price': 1000}
+            )
+            services = self.service_service.get_services_by_account(self.test_account['id'], fields=['id', 'title'])
+            self.assertEqual(set(services[0]), {'id', 'title'})
+
+            # Projected lookups by id read just those columns, not cached full rows
+            other = self.service_service.create_service(**self.test_service_data)
+            lookups = dict(service_cache.stats())
+            services = self.service_service.get_services_by_ids([other['id'], created['id']], fields=['price'])
+            self.assertEqual(services, [{'price': 1000}, {'price': 1000}])
+            self.assertEqual(service_cache.stats(), lookups)
+
         def test_search_services(self):
             # Create multiple services
             self.service_service.create_service(**self.test_service_data)
@@ -222,4 +317,16 @@ if __name__ == "__main__":
             self.assertEqual(len(results), 1)
             self.assertEqual(results[0]['price'], 5000)
 
+        def test_search_cache(self):
+            service = self.service_service.create_service(**self.test_service_data)
+            self.assertEqual(len(self.service_service.search_services(keyword="test")), 1)
+            hits = search_cache.stats()['hits']
+            results = self.service_service.search_services(keyword="TEST", fields=['id', 'price'])
+            self.assertEqual(results, [{'id': service['id'], 'price': 1000}])
+            self.assertEqual(search_cache.stats()['hits'], hits + 1)
+
+            # A write retires the cached result
+            self.service_service.update_service(service['id'], title="Renamed", description="Other")
+            self.assertEqual(self.service_service.search_services(keyword="test"), [])
+
     unittest.main(verbosity=2)
@@ -0,0 +1,516 @@
+from __future__ import annotations
+
+from src.db import SessionLocal, get_read_session, any_id, id_array
+from src.models import Service
+from src.events import subscribe
+from src.cache import on_invalidation
+from src.lazy import lazy_import
+from sqlalchemy import select
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+import asyncio
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+np = lazy_import("numpy")
+sparse = lazy_import("scipy.sparse")
+
+logger = logging.getLogger(__name__)
+
+SIMILAR_INDEX_PATH = os.getenv("SIMILAR_INDEX_PATH", "var/similar_index.npz")
+SIMILAR_REFRESH_SECONDS = float(os.getenv("SIMILAR_REFRESH_SECONDS", "300"))
+SIMILAR_REBUILD_SECONDS = float(os.getenv("SIMILAR_REBUILD_SECONDS", "86400"))  # Refit vocabulary and IDF at least this often
+SIMILAR_REBUILD_DRIFT = float(os.getenv("SIMILAR_REBUILD_DRIFT", "0.2"))  # Or once this share of services changed since the build
+SIMILAR_MAX_DF = float(os.getenv("SIMILAR_MAX_DF", "0.2"))  # Ignore terms in more than this share of services
+SIMILAR_MIN_DF_CUTOFF = 100  # Never drop terms used by fewer services than this
+SIMILAR_MAX_POSTINGS = int(os.getenv("SIMILAR_MAX_POSTINGS", "10000"))  # Highest-weighted services kept per term
+SIMILAR_TITLE_WEIGHT = 2
+SIMILAR_LOAD_CHUNK = 10000
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]{2,}")
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+class SimilarServiceIndex:
+    """
+    In-process TF-IDF index over service titles and descriptions.
+
+    Vectors are L2-normalized float32 rows, so cosine similarity is a dot product.
+    For scoring, the matrix is also kept as impact-ordered postings in CSC form:
+    each term keeps only its SIMILAR_MAX_POSTINGS highest-weighted services, and
+    terms in more than SIMILAR_MAX_DF of all services are dropped. A query
+    therefore touches a bounded number of postings no matter how many services
+    are indexed. Updates from create/update/delete go into a small pending
+    matrix that is scored directly and merged by the maintenance task. The index
+    is saved to SIMILAR_INDEX_PATH so workers start warm.
+
+    Updates are vectorized against the vocabulary and IDF of the last build, so
+    the maintenance task rebuilds every SIMILAR_REBUILD_SECONDS, or sooner once
+    SIMILAR_REBUILD_DRIFT of the indexed services changed. Deletions reach the
+    index through the "services" cache invalidation as well as the events, so
+    rows removed by cascades in any worker are dropped too.
+    """
+
+    def __init__(self, path: str = SIMILAR_INDEX_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self.vocabulary: Dict[str, int] = {}
+        # Arrays are created by build() or load(), so constructing the index does not import NumPy
+        self.idf: Optional[np.ndarray] = None
+        self.ids: Optional[np.ndarray] = None
+        self.alive: Optional[np.ndarray] = None
+        self.rows: Optional[sparse.csr_matrix] = None
+        self.columns: Optional[sparse.csc_matrix] = None
+        self.positions: Dict[int, int] = {}
+        self.watermark: Optional[datetime] = None
+        self._pending_ids: List[int] = []
+        self._pending_rows: List[sparse.csr_matrix] = []
+        self._pending_matrix: Optional[sparse.csr_matrix] = None
+        self._score_buffer: Optional[np.ndarray] = None
+        self.built_at: Optional[float] = None  # Wall-clock time of the build the vocabulary comes from
+        self._changed = 0  # Services upserted or removed since that build
+        self._dirty = set()  # Service ids invalidated by any worker, checked by catch_up()
+        self._stale = False  # A whole-cache invalidation: diff the indexed ids against the table
+
+        subscribe("services.created", lambda service: self.upsert(service))
+        subscribe("services.updated", lambda service: self.upsert(service))
+        subscribe("services.deleted", lambda service_id: self.remove(service_id))
+        on_invalidation("services", self._invalidated)
+
+    @property
+    def ready(self) -> bool:
+        return len(self.vocabulary) > 0
+
+    def build(self):
+        """Build the index from all services with a streaming query."""
+        document_terms: List[np.ndarray] = []
+        document_counts: List[np.ndarray] = []
+        ids: List[int] = []
+        vocabulary: Dict[str, int] = {}
+        watermark = None
+
+        with get_read_session() as session:
+            result = session.execute(
+                select(Service.id, Service.title, Service.description, Service.updated_at)
+                .execution_options(yield_per=SIMILAR_LOAD_CHUNK)
+            )
+            for service_id, title, description, updated_at in result:
+                counts = self._term_counts(title, description)
+                terms = np.fromiter(
+                    (vocabulary.setdefault(term, len(vocabulary)) for term in counts),
+                    dtype=np.int32, count=len(counts)
+                )
+                document_terms.append(terms)
+                document_counts.append(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+                ids.append(service_id)
+                if updated_at and (watermark is None or updated_at > watermark):
+                    watermark = updated_at
+
+        total = len(ids)
+        lengths = np.fromiter((len(terms) for terms in document_terms), dtype=np.int64, count=total)
+        indptr = np.zeros(total + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.concatenate(document_terms) if total else np.empty(0, dtype=np.int32)
+        tf = np.concatenate(document_counts) if total else np.empty(0, dtype=np.float32)
+
+        df = np.bincount(indices, minlength=len(vocabulary)).astype(np.float32)
+        idf = (np.log((1 + total) / (1 + df)) + 1).astype(np.float32)
+        idf[df > max(SIMILAR_MAX_DF * total, SIMILAR_MIN_DF_CUTOFF)] = 0  # Too common to say anything about similarity
+
+        matrix = sparse.csr_matrix(
+            (tf * idf[indices], indices, indptr),
+            shape=(total, len(vocabulary)), dtype=np.float32
+        )
+        matrix = self._normalize(matrix)
+
+        with self._lock:
+            self.vocabulary = vocabulary
+            self.idf = idf
+            self.ids = np.array(ids, dtype=np.int64)
+            self.alive = np.ones(total, dtype=bool)
+            self.positions = {service_id: row for row, service_id in enumerate(ids)}
+            self.watermark = watermark
+            self._pending_ids = []
+            self._pending_rows = []
+            self._pending_matrix = None
+            self.built_at = time.time()
+            self._changed = 0
+            self._set_rows(matrix)
+        logger.info(f"Similar-services index built: {total} services, {len(vocabulary)} terms")
+
+    def upsert(self, service: dict):
+        """Add or replace one service. Terms unseen at build time are ignored until the next build."""
+        if not self.ready:
+            return
+        vector = self._vectorize(service.get('title'), service.get('description'))
+        with self._lock:
+            self._remove(service['id'])
+            self._pending_ids.append(service['id'])
+            self._pending_rows.append(vector)
+            self._pending_matrix = None
+            self._changed += 1
+            updated_at = service.get('updated_at')
+            if updated_at and (self.watermark is None or updated_at > self.watermark):
+                self.watermark = updated_at
+
+    def remove(self, service_id: int):
+        with self._lock:
+            if self._remove(service_id):
+                self._changed += 1
+
+    def needs_build(self) -> bool:
+        """Whether the vocabulary is missing, too old, or drifted too far to keep updating in place."""
+        with self._lock:
+            if not self.ready or self.built_at is None:
+                return True
+            if time.time() - self.built_at >= SIMILAR_REBUILD_SECONDS:
+                return True
+            return self._changed > SIMILAR_REBUILD_DRIFT * max(len(self.positions), 1)
+
+    def similar(self, service_id: int, limit: int = 10):
+        """Top `limit` (service_id, score) pairs most similar to service_id, best first."""
+        with self._lock:
+            if service_id in self.positions:
+                query = self.rows[self.positions[service_id]]
+            elif service_id in self._pending_ids:
+                query = self._pending_rows[self._pending_ids.index(service_id)]
+            else:
+                return []
+
+            candidates, scores = self._score(query)
+            if self._pending_rows:
+                if self._pending_matrix is None:
+                    self._pending_matrix = sparse.vstack(self._pending_rows, format="csr")
+                pending_scores = (self._pending_matrix @ query.T).toarray().ravel()
+                candidates = np.concatenate([candidates, np.array(self._pending_ids, dtype=np.int64)])
+                scores = np.concatenate([scores, pending_scores.astype(np.float32)])
+
+        keep = (candidates != service_id) & (scores > 0)
+        candidates, scores = candidates[keep], scores[keep]
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(int(candidates[i]), float(scores[i])) for i in order]
+
+    def catch_up(self):
+        """Apply services changed since the watermark, e.g. by other workers or while down."""
+        if not self.ready:
+            return 0
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            stale, self._stale = self._stale, False
+        try:
+            with get_read_session() as session:
+                query = select(Service.id, Service.title, Service.description, Service.updated_at)
+                if self.watermark is not None:
+                    query = query.where(Service.updated_at > self.watermark)
+                rows = session.execute(query.order_by(Service.updated_at)).all()
+                existing = session.scalars(select(Service.id)).all() if stale else None
+            if dirty:
+                # The primary, since a replica may not have replayed the delete yet
+                with SessionLocal() as session:
+                    found = set(session.scalars(
+                        select(Service.id).where(Service.id == any_id('service_ids')),
+                        {'service_ids': id_array(dirty)}
+                    ).all())
+        except Exception:
+            with self._lock:
+                self._dirty.update(dirty)
+                self._stale = self._stale or stale
+            raise
+        for row in rows:
+            self.upsert({'id': row.id, 'title': row.title, 'description': row.description, 'updated_at': row.updated_at})
+        removed = set(dirty) - found if dirty else set()
+        if existing is not None:
+            with self._lock:
+                indexed = set(self.positions) | set(self._pending_ids)
+            removed |= indexed - set(existing)
+        for service_id in removed:
+            self.remove(service_id)
+        return len(rows) + len(removed)
+
+    def merge(self):
+        """Fold pending updates into the main matrix and rebuild the postings."""
+        with self._lock:
+            self._merge()
+
+    def save(self):
+        with self._lock:
+            self._merge()
+            terms = np.empty(len(self.vocabulary), dtype=object)
+            for term, column in self.vocabulary.items():
+                terms[column] = term
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            # Every worker saves; a file of its own keeps one from publishing another's partial write
+            fd, temporary = tempfile.mkstemp(dir=directory, suffix=".npz")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(
+                        f,
+                        data=self.rows.data, indices=self.rows.indices, indptr=self.rows.indptr,
+                        shape=np.array(self.rows.shape), ids=self.ids, alive=self.alive, idf=self.idf,
+                        terms=terms.astype(str),
+                        watermark=np.array([self.watermark.isoformat() if self.watermark else ""]),
+                        built_at=np.array([self.built_at or 0.0]), changed=np.array([self._changed])
+                    )
+                os.replace(temporary, self.path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as saved:
+            matrix = sparse.csr_matrix(
+                (saved['data'], saved['indices'], saved['indptr']), shape=tuple(saved['shape'])
+            )
+            ids = saved['ids']
+            alive = saved['alive']
+            with self._lock:
+                self.vocabulary = {str(term): column for column, term in enumerate(saved['terms'])}
+                self.idf = saved['idf']
+                self.ids = ids
+                self.alive = alive
+                self.positions = {int(ids[row]): row for row in np.flatnonzero(alive)}
+                watermark = str(saved['watermark'][0])
+                self.watermark = datetime.fromisoformat(watermark) if watermark else None
+                self._pending_ids = []
+                self._pending_rows = []
+                self._pending_matrix = None
+                # Files saved before these were recorded count as due for a rebuild
+                self.built_at = (float(saved['built_at'][0]) or None) if 'built_at' in saved.files else None
+                self._changed = int(saved['changed'][0]) if 'changed' in saved.files else 0
+                self._set_rows(matrix)
+        logger.info(f"Similar-services index loaded from {self.path}: {len(self.positions)} services")
+        return True
+
+    async def run_maintenance(self, stop: asyncio.Event):
+        """
+        Load the saved index, then until stop is set periodically catch up and
+        save, rebuilding whenever needs_build() says so, including when the
+        saved or built index is empty.
+        """
+        try:
+            await asyncio.to_thread(self.load)
+        except Exception as e:
+            logger.error(f"Similar-services index load failed: {str(e)}")
+        while not stop.is_set():
+            try:
+                if self.needs_build():
+                    await asyncio.to_thread(self.build)
+                    if self.ready:  # An empty table is rebuilt next time rather than saved
+                        await asyncio.to_thread(self.save)
+                else:
+                    await asyncio.to_thread(self.catch_up)
+                    if self._pending_ids:
+                        await asyncio.to_thread(self.save)
+            except Exception as e:
+                logger.error(f"Similar-services index refresh failed: {str(e)}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=SIMILAR_REFRESH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def _score(self, query: sparse.csr_matrix):
+        """Cosine scores for live indexed services in the postings of the query's terms."""
+        # Caller holds the lock, which also guards the scratch buffers
+        if len(query.indices) == 0 or self.columns.shape[0] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        indptr, indices, data = self.columns.indptr, self.columns.indices, self.columns.data
+        buffer = self._score_buffer
+        postings = [
+            (indices[indptr[term]:indptr[term + 1]], data[indptr[term]:indptr[term + 1]] * weight)
+            for term, weight in zip(query.indices, query.data)
+        ]
+        for rows, weights in postings:
+            # Rows are unique within one term's postings, so fancy += is safe
+            buffer[rows] += weights
+
+        # Read each row's total once: rows already read and reset score zero
+        found_rows, found_scores = [], []
+        for rows, _ in postings:
+            scores = buffer[rows]
+            buffer[rows] = 0
+            first = scores > 0
+            found_rows.append(rows[first])
+            found_scores.append(scores[first])
+        rows = np.concatenate(found_rows)
+        scores = np.concatenate(found_scores)
+        live = self.alive[rows]
+        return self.ids[rows[live]], scores[live]
+
+    def _set_rows(self, matrix: sparse.csr_matrix):
+        # Caller holds the lock
+        self.rows = matrix
+        self.columns = self._postings(matrix)
+        self._score_buffer = np.zeros(matrix.shape[0], dtype=np.float32)
+
+    def _postings(self, matrix: sparse.csr_matrix) -> sparse.csc_matrix:
+        """CSC copy of matrix with each column cut to its SIMILAR_MAX_POSTINGS largest weights."""
+        columns = matrix.tocsc()
+        lengths = np.diff(columns.indptr)
+        if len(lengths) == 0 or lengths.max() <= SIMILAR_MAX_POSTINGS:
+            return columns
+        column_of = np.repeat(np.arange(len(lengths)), lengths)
+        order = np.lexsort((-columns.data, column_of))
+        rank = np.arange(len(order)) - np.repeat(columns.indptr[:-1], lengths)
+        keep = order[rank < SIMILAR_MAX_POSTINGS]
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(np.minimum(lengths, SIMILAR_MAX_POSTINGS), out=indptr[1:])
+        return sparse.csc_matrix(
+            (columns.data[keep], columns.indices[keep], indptr), shape=columns.shape
+        )
+
+    def _invalidated(self, service_ids: Optional[list]):
+        # Runs on the invalidation listener's event loop: only record the work
+        with self._lock:
+            if service_ids is None:
+                self._stale = True
+            else:
+                self._dirty.update(int(service_id) for service_id in service_ids)
+
+    def _remove(self, service_id: int) -> bool:
+        # Caller holds the lock
+        row = self.positions.pop(service_id, None)
+        if row is not None:
+            self.alive[row] = False
+        if service_id in self._pending_ids:
+            position = self._pending_ids.index(service_id)
+            del self._pending_ids[position]
+            del self._pending_rows[position]
+            self._pending_matrix = None
+            return True
+        return row is not None
+
+    def _merge(self):
+        # Caller holds the lock
+        if not self._pending_rows:
+            return
+        start = self.rows.shape[0]
+        blocks = ([self.rows] if start else []) + self._pending_rows
+        self.ids = np.concatenate([self.ids, np.array(self._pending_ids, dtype=np.int64)])
+        self.alive = np.concatenate([self.alive, np.ones(len(self._pending_ids), dtype=bool)])
+        for offset, service_id in enumerate(self._pending_ids):
+            self.positions[service_id] = start + offset
+        self._pending_ids = []
+        self._pending_rows = []
+        self._pending_matrix = None
+        self._set_rows(sparse.vstack(blocks, format="csr", dtype=np.float32))
+
+    def _term_counts(self, title: Optional[str], description: Optional[str]) -> Counter:
+        counts = Counter(tokenize(description))
+        for term in tokenize(title):
+            counts[term] += SIMILAR_TITLE_WEIGHT
+        return counts
+
+    def _vectorize(self, title: Optional[str], description: Optional[str]) -> sparse.csr_matrix:
+        counts = self._term_counts(title, description)
+        known = [(self.vocabulary[term], count) for term, count in counts.items() if term in self.vocabulary]
+        columns = np.array([column for column, _ in known], dtype=np.int32)
+        values = np.array([count for _, count in known], dtype=np.float32) * self.idf[columns]
+        vector = sparse.csr_matrix(
+            (values, columns, np.array([0, len(columns)])),
+            shape=(1, len(self.vocabulary)), dtype=np.float32
+        )
+        return self._normalize(vector)
+
+    def _normalize(self, matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = sparse.csr_matrix(sparse.diags(1 / norms).astype(np.float32) @ matrix, dtype=np.float32)
+        matrix.eliminate_zeros()
+        return matrix
+
+
+if __name__ == "__main__":
+    import unittest
+    import tempfile
+
+    class TestSimilarServiceIndex(unittest.TestCase):
+        def make_index(self, services):
+            index = SimilarServiceIndex(path=os.path.join(tempfile.mkdtemp(), "index.npz"))
+            # Seed the vocabulary from the services, as build() would from the table
+            vocabulary = {}
+            for service in services:
+                for term in index._term_counts(service['title'], service['description']):
+                    vocabulary.setdefault(term, len(vocabulary))
+            index.vocabulary = vocabulary
+            index.idf = np.ones(len(vocabulary), dtype=np.float32)
+            index.ids = np.empty(0, dtype=np.int64)
+            index.alive = np.empty(0, dtype=bool)
+            index._set_rows(sparse.csr_matrix((0, len(vocabulary)), dtype=np.float32))
+            for service in services:
+                index.upsert(service)
+            return index
+
+        def test_similar_ranks_overlap(self):
+            index = self.make_index([
+                {'id': 1, 'title': "Kitchen plumbing", 'description': "Fix leaking kitchen pipes"},
+                {'id': 2, 'title': "Bathroom plumbing", 'description': "Fix leaking bathroom pipes"},
+                {'id': 3, 'title': "Dog walking", 'description': "Daily walks for your dog"},
+            ])
+            result = index.similar(1)
+            self.assertEqual([service_id for service_id, _ in result], [2])
+
+        def test_update_delete_and_persist(self):
+            index = self.make_index([
+                {'id': 1, 'title': "Kitchen plumbing", 'description': "pipes"},
+                {'id': 2, 'title': "Dog walking", 'description': "walks"},
+                {'id': 3, 'title': "Dog grooming", 'description': "baths"},
+            ])
+            index.upsert({'id': 2, 'title': "Kitchen pipes", 'description': "plumbing"})
+            self.assertEqual(index.similar(1)[0][0], 2)
+
+            index.remove(2)
+            self.assertEqual(index.similar(1), [])
+
+            index.save()
+            index.save()
+            self.assertEqual(os.listdir(os.path.dirname(index.path)), ["index.npz"])  # No temporaries left
+            loaded = SimilarServiceIndex(path=index.path)
+            self.assertTrue(loaded.load())
+            self.assertEqual(loaded.similar(3), [])
+            self.assertEqual(sorted(loaded.positions), [1, 3])
+
+        def test_needs_build(self):
+            index = SimilarServiceIndex(path=os.path.join(tempfile.mkdtemp(), "index.npz"))
+            self.assertTrue(index.needs_build())  # Empty, as after a build over no services
+
+            index = self.make_index([
+                {'id': service_id, 'title': f"Service {service_id}", 'description': "plumbing"}
+                for service_id in range(1, 21)
+            ])
+            index.merge()
+            index.built_at, index._changed = time.time(), 0
+            self.assertFalse(index.needs_build())
+            index.upsert({'id': 1, 'title': "Plumbing", 'description': "pipes"})
+            index.remove(2)
+            self.assertEqual(index._changed, 2)
+            self.assertFalse(index.needs_build())
+            index.remove(99)  # Not indexed, so no drift
+            for service_id in range(3, 6):
+                index.remove(service_id)
+            self.assertTrue(index.needs_build())
+
+            index._changed = 0
+            index.built_at -= SIMILAR_REBUILD_SECONDS
+            self.assertTrue(index.needs_build())
+
+        def test_invalidation_marks_work(self):
+            index = SimilarServiceIndex(path=os.path.join(tempfile.mkdtemp(), "index.npz"))
+            index._invalidated([3, "4"])
+            self.assertEqual(index._dirty, {3, 4})
+            self.assertFalse(index._stale)
+            index._invalidated(None)
+            self.assertTrue(index._stale)
+
+    unittest.main(verbosity=2)
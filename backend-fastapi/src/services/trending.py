@@ -0,0 +1,152 @@
+from src.db import get_read_session
+from src.models import Hashtag, HashtagUsageBucket
+from src.events import subscribe
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+import asyncio
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24"))
+TRENDING_WINDOW_HOURS = int(os.getenv("TRENDING_WINDOW_HOURS", "168"))
+TRENDING_TOP_K = int(os.getenv("TRENDING_TOP_K", "100"))
+TRENDING_REFRESH_SECONDS = float(os.getenv("TRENDING_REFRESH_SECONDS", "300"))
+TRENDING_SNAPSHOT_SECONDS = float(os.getenv("TRENDING_SNAPSHOT_SECONDS", "5"))
+
+class TrendingService:
+    """
+    Time-decayed hashtag popularity kept in memory.
+
+    Scores use forward decay: an event at time t adds exp(lambda * (t - landmark)),
+    so existing scores never need rescaling and ranking order is unaffected by the
+    landmark. Scores are reloaded from the hourly usage buckets every
+    TRENDING_REFRESH_SECONDS (picking up writes made by other workers), updated
+    from local hashtag events in between, and the top K are snapshotted so a
+    request only copies a list of at most K entries.
+    """
+
+    def __init__(self, half_life_hours: float = TRENDING_HALF_LIFE_HOURS, top_k: int = TRENDING_TOP_K):
+        self.decay = math.log(2) / (half_life_hours * 3600)
+        self.top_k = top_k
+        self._lock = threading.Lock()
+        self._landmark = time.time()
+        self._scores: Dict[int, float] = {}
+        self._tags: Dict[int, str] = {}
+        self._snapshot: List[Tuple[float, int]] = []
+        self._snapshot_at = 0.0
+        self._dirty = False
+
+        subscribe("hashtags.added", lambda account_id, hashtags: self.record(hashtags, 1))
+        subscribe("hashtags.removed", lambda account_id, hashtags: self.record(hashtags, -1))
+
+    def refresh(self):
+        """Rebuild scores from the usage buckets inside the trending window."""
+        cutoff = datetime.utcnow() - timedelta(hours=TRENDING_WINDOW_HOURS)
+        with get_read_session() as session:
+            rows = session.query(
+                HashtagUsageBucket.hashtag_id,
+                Hashtag.tag,
+                HashtagUsageBucket.bucket_start,
+                HashtagUsageBucket.count
+            ).join(Hashtag, Hashtag.id == HashtagUsageBucket.hashtag_id).filter(
+                HashtagUsageBucket.bucket_start >= cutoff
+            ).all()
+
+        landmark = time.time()
+        now = datetime.utcnow()
+        scores: Dict[int, float] = {}
+        tags: Dict[int, str] = {}
+        for hashtag_id, tag, bucket_start, count in rows:
+            # Bucket times are naive UTC; express them relative to the new landmark
+            age = (now - bucket_start).total_seconds()
+            scores[hashtag_id] = scores.get(hashtag_id, 0.0) + count * math.exp(-self.decay * age)
+            tags[hashtag_id] = tag
+
+        with self._lock:
+            self._landmark = landmark
+            self._scores = scores
+            self._tags = tags
+            self._take_snapshot()
+        return len(scores)
+
+    def record(self, hashtags: List[Tuple[int, str]], delta: int):
+        """Apply a local association change without waiting for the next refresh."""
+        with self._lock:
+            weight = delta * math.exp(self.decay * (time.time() - self._landmark))
+            for hashtag_id, tag in hashtags:
+                self._scores[hashtag_id] = self._scores.get(hashtag_id, 0.0) + weight
+                self._tags[hashtag_id] = tag
+            self._dirty = True
+
+    def trending(self, limit: int = 10):
+        """Top hashtags by decayed score. Costs O(limit) unless a new snapshot is due."""
+        with self._lock:
+            if self._dirty and time.time() - self._snapshot_at >= TRENDING_SNAPSHOT_SECONDS:
+                self._take_snapshot()
+            snapshot = self._snapshot[:limit]
+            tags = self._tags
+            scale = math.exp(-self.decay * (time.time() - self._landmark))
+
+        return [{
+            'id': hashtag_id,
+            'tag': tags[hashtag_id],
+            'score': round(score * scale, 4)
+        } for score, hashtag_id in snapshot]
+
+    async def run_refresher(self, stop: asyncio.Event):
+        """Reload scores from the database until stop is set."""
+        while not stop.is_set():
+            try:
+                count = await asyncio.to_thread(self.refresh)
+                logger.info(f"Trending hashtags refreshed ({count} tags in window)")
+            except Exception as e:
+                logger.error(f"Trending refresh failed: {str(e)}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=TRENDING_REFRESH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def _take_snapshot(self):
+        # Caller holds the lock
+        self._snapshot = heapq.nlargest(
+            self.top_k,
+            ((score, hashtag_id) for hashtag_id, score in self._scores.items() if score > 0)
+        )
+        self._snapshot_at = time.time()
+        self._dirty = False
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class TestTrendingService(unittest.TestCase):
+        def test_recent_activity_ranks_first(self):
+            trending = TrendingService(half_life_hours=1, top_k=2)
+            trending.record([(1, "old")], 3)
+            # Simulate a later event by moving the landmark back two half-lives
+            trending._landmark -= 7200
+            trending.record([(2, "new")], 2)
+            trending.record([(3, "newer")], 1)
+            trending._snapshot_at = 0
+
+            result = trending.trending(limit=10)
+            self.assertEqual([t['tag'] for t in result], ["new", "newer"])
+
+        def test_removal_lowers_score(self):
+            trending = TrendingService(top_k=10)
+            trending.record([(1, "python"), (2, "rust")], 1)
+            trending.record([(1, "python")], 1)
+            trending.record([(1, "python")], -1)
+            trending.record([(2, "rust")], -1)
+            trending._snapshot_at = 0
+
+            result = trending.trending()
+            self.assertEqual([t['tag'] for t in result], ["python"])
+
+    unittest.main(verbosity=2)
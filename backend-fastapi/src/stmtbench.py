@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of the hot lookups' per-query Python overhead.
+
+    python -m src.stmtbench [--calls 2000]
+
+Each lookup runs the code its service method used to run ("before": the ORM
+entity query, or the column select rebuilt per call) and the prebuilt
+statement it runs now ("after"), converting rows to dicts the same way. Both run on
+one open session against the configured database, so the connection and the
+round trip are the same for both and the difference is SQLAlchemy work. A raw
+DB-API query shows the floor.
+"""
+from typing import Callable, List, Tuple
+import argparse
+import time
+
+from src.db import SessionLocal
+from src.fields import select_fields
+from src.models import Account, Hashtag, Review, Service
+from src.services.account import ACCOUNT_BY_USERNAME, ACCOUNT_LOGIN
+from src.services.hashtag import HASHTAG_BY_TAG
+from src.services.review import REVIEW_FIELDS, reviews_by_service_statement
+from src.services.service import SERVICE_FIELDS, search_statement
+
+def per_call(session, fn: Callable, calls: int, rounds: int = 3) -> float:
+    """Best average seconds per call over a few rounds, after a warm-up"""
+    for _ in range(min(calls, 200)):
+        fn(session)
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn(session)
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+def _account_dict(account):
+    return {'id': account.id, 'username': account.username, 'email': account.email} if account else None
+
+def _hashtag_dict(hashtag):
+    return {'id': hashtag.id, 'tag': hashtag.tag, 'created_at': hashtag.created_at} if hashtag else None
+
+def _search_before(session, keyword: str):
+    query = select_fields(Service, SERVICE_FIELDS)
+    query = query.where(
+        (Service.title.ilike(f'%{keyword}%')) |
+        (Service.description.ilike(f'%{keyword}%'))
+    )
+    query = query.where(Service.price >= 0)
+    return [row._asdict() for row in session.execute(query)]
+
+def cases(name: str = "nobody", service_id: int = 1, keyword: str = "design") -> List[Tuple[str, Callable, Callable]]:
+    """
+    (lookup, before, after) pairs. "before" is the code each service method ran
+    before the statements were prebuilt, result handling included; "after" is
+    what it runs now.
+    """
+    def as_dict(row):
+        return row._asdict() if row else None
+
+    return [
+        ("get_account_by_username",
+         lambda s: _account_dict(s.query(Account).filter(Account.username == name).first()),
+         lambda s: as_dict(s.execute(ACCOUNT_BY_USERNAME, {'username': name}).first())),
+        ("login lookup",
+         lambda s: s.query(Account).filter((Account.username == name) | (Account.email == name)).first(),
+         lambda s: s.execute(ACCOUNT_LOGIN, {'login': name}).first()),
+        ("get_hashtag",
+         lambda s: _hashtag_dict(s.query(Hashtag).filter(Hashtag.tag == name).first()),
+         lambda s: as_dict(s.execute(HASHTAG_BY_TAG, {'tag': name}).first())),
+        ("get_reviews_by_service",
+         lambda s: [row._asdict() for row in s.execute(
+             select_fields(Review, REVIEW_FIELDS).where(Review.service_id == service_id)
+         )],
+         lambda s: [row._asdict() for row in s.execute(
+             reviews_by_service_statement(tuple(REVIEW_FIELDS)), {'service_id': service_id}
+         )]),
+        ("search_services",
+         lambda s: _search_before(s, keyword),
+         lambda s: [row._asdict() for row in s.execute(
+             search_statement(tuple(SERVICE_FIELDS), True, True, False),
+             {'pattern': f'%{keyword}%', 'min_price': 0, 'max_price': None}
+         )]),
+    ]
+
+def raw_round_trip(session) -> None:
+    cursor = session.connection().connection.cursor()
+    cursor.execute("SELECT id, username, email FROM accounts WHERE username = %(u)s LIMIT 1", {'u': "nobody"})
+    cursor.fetchall()
+    cursor.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=2000, help="Calls per round")
+    args = parser.parse_args()
+
+    with SessionLocal() as session:
+        floor = per_call(session, raw_round_trip, args.calls)
+        print(f"{'lookup':<26}{'before us':>11}{'after us':>11}{'saved us':>11}")
+        for name, before, after in cases():
+            old = per_call(session, before, args.calls)
+            new = per_call(session, after, args.calls)
+            print(f"{name:<26}{old * 1e6:>11.1f}{new * 1e6:>11.1f}{(old - new) * 1e6:>11.1f}")
+        print(f"{'raw DB-API round trip':<26}{floor * 1e6:>11.1f}")
+
+if __name__ == "__main__":
+    main()